@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Límite de concurrencia adaptativo (AIMD) para el scheduler de admisión.
+
+Señales, evaluadas por ventana:
+- TTFT p90 por encima del objetivo o timeouts: el motor está saturado
+  (prefill de prompts largos, presión de KV cache) -> baja multiplicativa
+- Espera en cola por encima del objetivo con TTFT sano: el límite es el
+  cuello de botella y el motor tiene margen -> suba aditiva
+"""
+import math
+import time
+from collections import deque
+from typing import Deque, Iterable, Optional
+
+def _p90(values: Iterable[float]) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(0.9 * len(ordered)) - 1)]
+
+class AdaptiveConcurrencyLimit:
+    def __init__(self, initial: int, min_limit: int, max_limit: int,
+                 target_ttft: float, target_queue_delay: float,
+                 decrease_factor: float = 0.8, history_size: int = 240, max_samples: int = 4096):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(max_limit, initial))
+        self.target_ttft = target_ttft
+        self.target_queue_delay = target_queue_delay
+        self.decrease_factor = decrease_factor
+        # Acotadas: si update() no corre (ADAPTIVE_CONCURRENCY=false) no crecen sin fin
+        self._ttfts: Deque[float] = deque(maxlen=max_samples)
+        self._queue_waits: Deque[float] = deque(maxlen=max_samples)
+        self._timeouts = 0
+        self.history: deque = deque(maxlen=history_size)
+        self.stats = {"increases": 0, "decreases": 0}
+
+    # --- Muestras del camino caliente (O(1)) ---
+    def record_ttft(self, ttft: float):
+        self._ttfts.append(ttft)
+
+    def record_queue_wait(self, queue_wait: float):
+        self._queue_waits.append(queue_wait)
+
+    def record_timeout(self):
+        self._timeouts += 1
+
+    def update(self, in_flight: int, queued: int) -> int:
+        """Cierra la ventana actual y retorna el nuevo límite"""
+        p90_ttft = _p90(self._ttfts)
+        p90_queue = _p90(self._queue_waits)
+        timeouts = self._timeouts
+        self._ttfts.clear()
+        self._queue_waits.clear()
+        self._timeouts = 0
+
+        previous = self.limit
+        if timeouts or (p90_ttft is not None and p90_ttft > self.target_ttft):
+            self.limit = max(self.min_limit, math.floor(self.limit * self.decrease_factor))
+        else:
+            queue_delayed = p90_queue is not None and p90_queue > self.target_queue_delay
+            # Solo crecer si el límite es lo que está frenando (hay cola o estamos al tope)
+            if queued > 0 or (queue_delayed and in_flight >= self.limit - 1):
+                self.limit = min(self.max_limit, self.limit + 1)
+
+        if self.limit > previous:
+            self.stats["increases"] += 1
+        elif self.limit < previous:
+            self.stats["decreases"] += 1
+        self.history.append({
+            "timestamp": time.time(),
+            "limit": self.limit,
+            "in_flight": in_flight,
+            "queued": queued,
+            "p90_ttft": p90_ttft,
+            "p90_queue_wait": p90_queue,
+            "timeouts": timeouts
+        })
+        return self.limit
+
+    def snapshot(self, history_points: int = 60) -> dict:
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "target_ttft": self.target_ttft,
+            "target_queue_delay": self.target_queue_delay,
+            "history": list(self.history)[-history_points:]
+        }
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Motores de inferencia intercambiables para el servidor (ENGINE_BACKEND)
+- vllm: AsyncLLMEngine real, requiere GPU
+- simulated: motor en CPU que imita el continuous batching de vLLM, para
+  pruebas de carga del servidor sin GPU
+"""
+import os
+import re
+import random
+import asyncio
+import logging
+import zlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("vllm-server")
+
+ENGINE_BACKENDS = ("vllm", "simulated")
+
+# === INTERFAZ COMPATIBLE CON vLLM ===
+@dataclass
+class SimSamplingParams:
+    """Mismos campos que usa el servidor de vllm.SamplingParams"""
+    temperature: float = 1.0
+    max_tokens: int = 16
+    stop: List[str] = field(default_factory=list)
+    repetition_penalty: float = 1.0
+    skip_special_tokens: bool = True
+    top_p: float = 1.0
+    top_k: int = -1
+
+@dataclass
+class SimCompletionOutput:
+    index: int
+    text: str
+    token_ids: List[int]
+    finish_reason: Optional[str] = None
+
+@dataclass
+class SimRequestOutput:
+    request_id: str
+    prompt: str
+    prompt_token_ids: List[int]
+    outputs: List[SimCompletionOutput]
+    finished: bool = False
+    num_cached_tokens: int = 0
+
+class SimTokenizer:
+    """Tokenizador aproximado (palabras y signos) con ids estables"""
+    TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        return [zlib.crc32(tok.encode("utf-8")) % 50000 for tok in self.TOKEN_RE.findall(text)]
+
+# === MOTOR SIMULADO ===
+@dataclass
+class SimulationConfig:
+    prefill_tokens_per_sec: float = 4000.0   # throughput de prefill del batch
+    decode_tokens_per_sec: float = 40.0      # tokens/s de una secuencia sola
+    batch_slowdown: float = 0.03             # cada secuencia extra alarga el paso un 3%
+    mean_output_tokens: int = 120            # media de la longitud de salida (lognormal)
+    output_tokens_sigma: float = 0.6
+    max_num_seqs: int = 32
+    max_num_batched_tokens: int = 4096
+    enable_prefix_caching: bool = True
+    prefix_cache_blocks: int = 8192          # bloques de 16 tokens que entran en el prefix cache
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls, **overrides) -> "SimulationConfig":
+        seed = os.getenv("SIM_SEED")
+        config = cls(
+            prefill_tokens_per_sec=float(os.getenv("SIM_PREFILL_TOKENS_PER_SEC", cls.prefill_tokens_per_sec)),
+            decode_tokens_per_sec=float(os.getenv("SIM_DECODE_TOKENS_PER_SEC", cls.decode_tokens_per_sec)),
+            batch_slowdown=float(os.getenv("SIM_BATCH_SLOWDOWN", cls.batch_slowdown)),
+            mean_output_tokens=int(os.getenv("SIM_MEAN_OUTPUT_TOKENS", cls.mean_output_tokens)),
+            output_tokens_sigma=float(os.getenv("SIM_OUTPUT_TOKENS_SIGMA", cls.output_tokens_sigma)),
+            prefix_cache_blocks=int(os.getenv("SIM_PREFIX_CACHE_BLOCKS", cls.prefix_cache_blocks)),
+            seed=int(seed) if seed else None
+        )
+        for key, value in overrides.items():
+            setattr(config, key, value)
+        return config
+
+SIM_VOCABULARY = (
+    "la universidad ofrece carreras de grado y pregrado en la facultad de ciencias exactas "
+    "las becas se solicitan en marzo con requisitos académicos y socioeconómicos "
+    "para más información consultá la página oficial o escribí a la secretaría"
+).split()
+
+class _SimSequence:
+    def __init__(self, request_id: str, prompt: str, prompt_token_ids: List[int], target_tokens: int):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.prompt_token_ids = prompt_token_ids
+        self.target_tokens = target_tokens
+        self.token_ids: List[int] = []
+        self.num_cached_tokens = 0
+        self.text = ""
+        self.finished = False
+        self.outputs: asyncio.Queue = asyncio.Queue()
+
+PREFIX_BLOCK_SIZE = 16
+
+class SimulatedEngine:
+    """
+    Imita el scheduler de vLLM: cola de espera, hasta max_num_seqs secuencias en
+    ejecución, prefill limitado por max_num_batched_tokens y un paso de decode
+    que se hace más lento cuanto más grande es el batch. Con prefix caching,
+    los bloques completos de prompt ya vistos (encadenados por hash, como en
+    vLLM) no pagan prefill.
+    """
+
+    def __init__(self, config: SimulationConfig):
+        self.config = config
+        self.tokenizer = SimTokenizer()
+        self._rng = random.Random(config.seed)
+        self._waiting: deque = deque()
+        self._running: List[_SimSequence] = []
+        self._sequences: Dict[str, _SimSequence] = {}
+        self._wakeup = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._prefix_blocks: "OrderedDict[int, None]" = OrderedDict()
+        self.stats = {"steps": 0, "generated_tokens": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "aborted": 0}
+        logger.info(f"🧪 Motor simulado: {config}")
+
+    def _sample_output_tokens(self, max_tokens: int) -> int:
+        cfg = self.config
+        mu = max(cfg.mean_output_tokens, 1)
+        sampled = int(self._rng.lognormvariate(0, cfg.output_tokens_sigma) * mu)
+        return max(1, min(max_tokens, sampled))
+
+    async def generate(self, prompt: str, sampling_params, request_id: str):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._step_loop())
+
+        seq = _SimSequence(
+            request_id,
+            prompt,
+            self.tokenizer.encode(prompt),
+            self._sample_output_tokens(sampling_params.max_tokens)
+        )
+        self._sequences[request_id] = seq
+        self._waiting.append(seq)
+        self._wakeup.set()
+
+        try:
+            while True:
+                output = await seq.outputs.get()
+                yield output
+                if output.finished:
+                    return
+        finally:
+            # Igual que vLLM: si el consumidor se va, la secuencia deja de decodificarse
+            if not seq.finished:
+                await self.abort(request_id)
+
+    async def abort(self, request_id: str):
+        seq = self._sequences.pop(request_id, None)
+        if seq is None:
+            return
+        seq.finished = True
+        self.stats["aborted"] += 1
+        if seq in self._running:
+            self._running.remove(seq)
+        else:
+            try:
+                self._waiting.remove(seq)
+            except ValueError:
+                pass
+
+    async def get_tokenizer(self):
+        return self.tokenizer
+
+    def get_stats(self) -> dict:
+        """Estado del scheduler simulado, con los mismos nombres que las stats de vLLM"""
+        cfg = self.config
+        tokens_in_use = sum(len(s.prompt_token_ids) + len(s.token_ids) for s in self._running)
+        total_prompt = self.stats["prompt_tokens"] + self.stats["cached_prompt_tokens"]
+        return {
+            "num_running": len(self._running),
+            "num_waiting": len(self._waiting),
+            "kv_cache_usage": min(1.0, tokens_in_use / (cfg.max_num_seqs * 4096)),
+            "prefix_cache_hit_rate": self.stats["cached_prompt_tokens"] / total_prompt if total_prompt else 0.0
+        }
+
+    async def shutdown(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+
+    def _cached_prefix_tokens(self, token_ids: List[int]) -> int:
+        """Tokens del prompt cubiertos por bloques ya cacheados; registra los bloques nuevos"""
+        if not self.config.enable_prefix_caching:
+            return 0
+        cached = 0
+        block_hash = 0
+        hit = True
+        for start in range(0, len(token_ids) - PREFIX_BLOCK_SIZE + 1, PREFIX_BLOCK_SIZE):
+            block_hash = hash((block_hash, tuple(token_ids[start:start + PREFIX_BLOCK_SIZE])))
+            if hit and block_hash in self._prefix_blocks:
+                self._prefix_blocks.move_to_end(block_hash)
+                cached += PREFIX_BLOCK_SIZE
+                continue
+            hit = False
+            self._prefix_blocks[block_hash] = None
+        while len(self._prefix_blocks) > self.config.prefix_cache_blocks:
+            self._prefix_blocks.popitem(last=False)
+        return cached
+
+    def _admit(self) -> int:
+        """Pasa secuencias de espera a ejecución; retorna los tokens de prefill del paso"""
+        cfg = self.config
+        prefill_tokens = 0
+        while self._waiting and len(self._running) < cfg.max_num_seqs:
+            prompt_tokens = len(self._waiting[0].prompt_token_ids)
+            if prefill_tokens and prefill_tokens + prompt_tokens > cfg.max_num_batched_tokens:
+                break
+            seq = self._waiting.popleft()
+            self._running.append(seq)
+            seq.num_cached_tokens = self._cached_prefix_tokens(seq.prompt_token_ids)
+            self.stats["cached_prompt_tokens"] += seq.num_cached_tokens
+            prefill_tokens += prompt_tokens - seq.num_cached_tokens
+        return prefill_tokens
+
+    async def _step_loop(self):
+        cfg = self.config
+        while True:
+            if not self._waiting and not self._running:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            prefill_tokens = self._admit()
+            batch_size = len(self._running)
+            step_time = (1.0 / cfg.decode_tokens_per_sec) * (1 + cfg.batch_slowdown * (batch_size - 1))
+            step_time += prefill_tokens / cfg.prefill_tokens_per_sec
+            await asyncio.sleep(step_time)
+
+            self.stats["steps"] += 1
+            self.stats["prompt_tokens"] += prefill_tokens
+            for seq in list(self._running):
+                if seq.finished:
+                    continue
+                word = SIM_VOCABULARY[len(seq.token_ids) % len(SIM_VOCABULARY)]
+                seq.text += (" " if seq.text else "") + word
+                seq.token_ids.append(zlib.crc32(word.encode("utf-8")) % 50000)
+                self.stats["generated_tokens"] += 1
+
+                done = len(seq.token_ids) >= seq.target_tokens
+                if done:
+                    seq.finished = True
+                    self._running.remove(seq)
+                    self._sequences.pop(seq.request_id, None)
+                seq.outputs.put_nowait(SimRequestOutput(
+                    request_id=seq.request_id,
+                    prompt=seq.prompt,
+                    prompt_token_ids=seq.prompt_token_ids,
+                    outputs=[SimCompletionOutput(
+                        index=0,
+                        text=seq.text,
+                        token_ids=list(seq.token_ids),
+                        finish_reason="length" if done else None
+                    )],
+                    finished=done,
+                    num_cached_tokens=seq.num_cached_tokens
+                ))
+
+# === ESTADÍSTICAS DEL MOTOR ===
+def engine_stats(engine) -> dict:
+    """
+    num_running / num_waiting / kv_cache_usage / prefix_cache_hit_rate del motor.
+    En vLLM se leen del scheduler del motor V0; los campos que la versión
+    instalada no expone simplemente no aparecen.
+    """
+    if hasattr(engine, "get_stats"):
+        return engine.get_stats()
+
+    stats = {}
+    llm_engine = getattr(engine, "engine", None)
+    schedulers = getattr(llm_engine, "scheduler", None)
+    if not schedulers:
+        return stats
+    if not isinstance(schedulers, (list, tuple)):
+        schedulers = [schedulers]
+    try:
+        stats["num_running"] = sum(len(s.running) for s in schedulers)
+        stats["num_waiting"] = sum(len(s.waiting) for s in schedulers)
+        total_blocks = llm_engine.cache_config.num_gpu_blocks
+        if total_blocks:
+            free_blocks = sum(s.block_manager.get_num_free_gpu_blocks() for s in schedulers)
+            stats["kv_cache_usage"] = 1.0 - free_blocks / (total_blocks * len(schedulers))
+        from vllm.utils import Device
+        rates = [s.get_prefix_cache_hit_rate(Device.GPU) for s in schedulers
+                 if hasattr(s, "get_prefix_cache_hit_rate")]
+        rates = [r for r in rates if r is not None and r >= 0]
+        if rates:
+            stats["prefix_cache_hit_rate"] = sum(rates) / len(rates)
+    except Exception as e:
+        logger.debug(f"Stats del motor no disponibles: {e}")
+    return stats
+
+# === FÁBRICA ===
+def get_sampling_params_class(backend: str):
+    """Clase de SamplingParams del backend (vLLM solo se importa si se usa)"""
+    if backend == "vllm":
+        from vllm.sampling_params import SamplingParams
+        return SamplingParams
+    if backend == "simulated":
+        return SimSamplingParams
+    raise ValueError(f"ENGINE_BACKEND desconocido: {backend} (opciones: {', '.join(ENGINE_BACKENDS)})")
+
+def create_engine(backend: str, engine_args: dict):
+    """Crea el motor del backend elegido con los argumentos de vLLM del servidor"""
+    if backend == "vllm":
+        from vllm.engine.arg_utils import AsyncEngineArgs
+        from vllm.engine.async_llm_engine import AsyncLLMEngine
+        return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**engine_args))
+    if backend == "simulated":
+        return SimulatedEngine(SimulationConfig.from_env(
+            max_num_seqs=engine_args["max_num_seqs"],
+            max_num_batched_tokens=engine_args["max_num_batched_tokens"],
+            enable_prefix_caching=engine_args.get("enable_prefix_caching", False)
+        ))
+    raise ValueError(f"ENGINE_BACKEND desconocido: {backend} (opciones: {', '.join(ENGINE_BACKENDS)})")
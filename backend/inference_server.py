@@ -4,28 +4,73 @@ Servidor de inferencia con vLLM + FastAPI - Versión PRODUCCIÓN
 Con control de concurrencia, backpressure y pooling de recursos
 """
 import os
+import json
+import math
 import logging
 import asyncio
 import time
 import threading
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Request
+from typing import Callable, Dict, List, Optional
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from vllm.engine.arg_utils import AsyncEngineArgs
-from vllm.engine.async_llm_engine import AsyncLLMEngine
-from vllm.sampling_params import SamplingParams
 import uvicorn
 
+from engines import create_engine, engine_stats, get_sampling_params_class
+from metrics import Registry
+from response_cache import ResponseCache, SingleFlight, make_cache_key
+from adaptive_limit import AdaptiveConcurrencyLimit
+from scheduler import PRIORITY_CLASSES, AdmissionRejected, AdmissionScheduler, Ticket
+from prompt_templates import TEMPLATES, TemplateError, apply_chat_template, render_messages
+from prompt_budget import PromptTooLong, TokenCounter, fit_sections
+
 # === CONFIGURACIÓN ===
 MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2-7B-Instruct-AWQ")#"Qwen/Qwen2-7B-Instruc"
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 8000))
+# Motor de inferencia: "vllm" (GPU) o "simulated" (CPU, para pruebas de carga)
+ENGINE_BACKEND = os.getenv("ENGINE_BACKEND", "vllm")
 MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", 32))
+MAX_NUM_SEQS = int(os.getenv("MAX_NUM_SEQS", MAX_CONCURRENT_REQUESTS))
 QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 30.0))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", MAX_CONCURRENT_REQUESTS * 2))
+# Prompts de hasta este largo (saludos, respuestas directas) van en la clase "interactive"
+SHORT_PROMPT_CHARS = int(os.getenv("SHORT_PROMPT_CHARS", 1200))
+MAX_PRIORITY_WAIT = float(os.getenv("MAX_PRIORITY_WAIT", 10.0))
+# Límite de concurrencia adaptativo: MAX_CONCURRENT_REQUESTS es el valor inicial y
+# se mueve entre CONCURRENCY_MIN y CONCURRENCY_MAX (nunca más que MAX_NUM_SEQS)
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", 4))
+CONCURRENCY_MAX = min(int(os.getenv("CONCURRENCY_MAX", MAX_NUM_SEQS)), MAX_NUM_SEQS)
+TARGET_TTFT = float(os.getenv("TARGET_TTFT", 2.0))
+TARGET_QUEUE_DELAY = float(os.getenv("TARGET_QUEUE_DELAY", 0.5))
+ADAPTIVE_INTERVAL = float(os.getenv("ADAPTIVE_INTERVAL", 5.0))
 MODEL_TIMEOUT = float(os.getenv("MODEL_TIMEOUT", 60.0))
 KEEP_ALIVE_TIMEOUT = int(os.getenv("KEEP_ALIVE_TIMEOUT", 120))
+# Deadline del cliente: segundos que le quedan antes de abandonar la solicitud
+DEADLINE_HEADER = "X-Request-Timeout"
+MIN_USEFUL_TIME = float(os.getenv("MIN_USEFUL_TIME", 1.0))
+# Estimación conservadora de tokens/s por secuencia bajo batching, para recortar max_tokens
+DECODE_TOKENS_PER_SEC = float(os.getenv("DECODE_TOKENS_PER_SEC", 20.0))
+MIN_USEFUL_TOKENS = int(os.getenv("MIN_USEFUL_TOKENS", 16))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))
+# Cache de respuestas: solo para temperaturas bajas, donde la respuesta es casi determinista
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 600.0))
+CACHE_MAX_TEMPERATURE = float(os.getenv("CACHE_MAX_TEMPERATURE", 0.3))
+# Ventana de contexto del modelo: prompt + max_tokens tienen que entrar acá
+MAX_MODEL_LEN = int(os.getenv("MAX_MODEL_LEN", 4096))
+TOKENIZE_CACHE_SIZE = int(os.getenv("TOKENIZE_CACHE_SIZE", 4096))
+# /generate_batch: los ítems van en la clase "batch" y no pueden ocupar los
+# últimos BATCH_RESERVED_SLOTS lugares del motor (quedan para el tráfico interactivo)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 256))
+BATCH_MAX_PENDING = int(os.getenv("BATCH_MAX_PENDING", 16))  # ítems de un lote esperando/corriendo a la vez
+BATCH_MAX_PENDING_TOTAL = int(os.getenv("BATCH_MAX_PENDING_TOTAL", 32))  # ídem, sumando todos los lotes (<= BATCH_MAX_QUEUE)
+BATCH_MAX_QUEUE = int(os.getenv("BATCH_MAX_QUEUE", 32))  # cola propia de "batch", aparte de MAX_QUEUE_SIZE
+BATCH_RESERVED_SLOTS = int(os.getenv("BATCH_RESERVED_SLOTS", 4))
+BATCH_QUEUE_TIMEOUT = float(os.getenv("BATCH_QUEUE_TIMEOUT", 300.0))
 
 # === LOGGING ===
 logging.basicConfig(
@@ -34,37 +79,182 @@ logging.basicConfig(
 )
 logger = logging.getLogger("vllm-server")
 
+SamplingParams = get_sampling_params_class(ENGINE_BACKEND)
+
 # === CONTROL DE CONCURRENCIA ===
-semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-request_queue = asyncio.Queue(maxsize=MAX_CONCURRENT_REQUESTS * 2)
+concurrency_limit = AdaptiveConcurrencyLimit(
+    MAX_CONCURRENT_REQUESTS, CONCURRENCY_MIN, CONCURRENCY_MAX, TARGET_TTFT, TARGET_QUEUE_DELAY
+)
+scheduler = AdmissionScheduler(
+    concurrency_limit.limit, MAX_QUEUE_SIZE, MAX_PRIORITY_WAIT,
+    reserved_slots={"batch": BATCH_RESERVED_SLOTS},
+    class_queue_limits={"batch": BATCH_MAX_QUEUE}
+)
+# Ítems de lotes esperando o corriendo entre todos los lotes en curso
+batch_pending = asyncio.Semaphore(BATCH_MAX_PENDING_TOTAL)
+
+async def _adapt_concurrency_loop():
+    """Cada ADAPTIVE_INTERVAL recalcula el límite con las muestras de la ventana"""
+    while True:
+        await asyncio.sleep(ADAPTIVE_INTERVAL)
+        previous = scheduler.limit
+        new_limit = concurrency_limit.update(scheduler.in_flight, scheduler.queued)
+        if new_limit != previous:
+            logger.info(f"🎚️ Límite de concurrencia {previous} → {new_limit}")
+            scheduler.set_limit(new_limit)
+
+# === CACHE Y COALESCENCIA DE SOLICITUDES IDÉNTICAS ===
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+single_flight = SingleFlight()
+
+# Secuencias abortadas en el motor: tokens_wasted = decodificados que nadie leerá,
+# tokens_aborted = presupuesto de max_tokens que se dejó de decodificar
+abort_stats = {
+    "aborted_requests": 0,
+    "aborted_by_reason": {"timeout": 0, "cancelled": 0, "error": 0},
+    "client_disconnects": 0,
+    "deadline_rejections": 0,
+    "tokens_wasted": 0,
+    "tokens_aborted": 0
+}
+
+# === MÉTRICAS (formato de exposición de Prometheus en /metrics) ===
+# Los histogramas y contadores se actualizan en el camino caliente; lo que ya se
+# cuenta en otro lado (scheduler, cache, abortos, motor) se copia al scrapear.
+metrics = Registry()
+requests_total = metrics.counter(
+    "unsa_requests_total", "Solicitudes terminadas por endpoint, clase y código HTTP",
+    ("endpoint", "request_class", "status")
+)
+rejections_total = metrics.counter(
+    "unsa_rejections_total", "Solicitudes rechazadas antes de llegar al motor",
+    ("request_class", "reason")
+)
+timeouts_total = metrics.counter(
+    "unsa_timeouts_total", "Timeouts por etapa (queue = esperando lugar, generation = en el motor)",
+    ("request_class", "stage")
+)
+request_latency = metrics.histogram(
+    "unsa_request_latency_seconds", "Latencia total de la solicitud",
+    ("endpoint", "request_class")
+)
+queue_wait_seconds = metrics.histogram(
+    "unsa_queue_wait_seconds", "Espera en el scheduler de admisión", ("request_class",)
+)
+ttft_seconds = metrics.histogram(
+    "unsa_time_to_first_token_seconds", "Tiempo hasta el primer token (incluye prefill)", ("request_class",)
+)
+inter_token_latency = metrics.histogram(
+    "unsa_inter_token_latency_seconds", "Tiempo entre tokens durante el decode", ("request_class",),
+    buckets=(0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+)
+prompt_tokens = metrics.histogram(
+    "unsa_prompt_tokens", "Tokens del prompt por solicitud", ("request_class",),
+    buckets=(32, 64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096)
+)
+generation_tokens_per_second = metrics.histogram(
+    "unsa_generation_tokens_per_second", "Velocidad de decode por secuencia", ("request_class",),
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100)
+)
+generation_tokens_total = metrics.counter(
+    "unsa_generation_tokens_total", "Tokens generados", ("request_class",)
+)
+context_dropped_tokens_total = metrics.counter(
+    "unsa_context_dropped_tokens_total", "Tokens de contexto descartados para entrar en MAX_MODEL_LEN", ("request_class",)
+)
+tokenizer_cache_lookups_total = metrics.counter(
+    "unsa_tokenizer_cache_lookups_total", "Consultas al cache del tokenizador", ("result",)
+)
+cached_prompt_tokens_total = metrics.counter(
+    "unsa_cached_prompt_tokens_total", "Tokens de prompt servidos desde el prefix cache", ("request_class",)
+)
+aborted_total = metrics.counter("unsa_aborted_requests_total", "Secuencias abortadas en el motor", ("reason",))
+aborted_tokens_total = metrics.counter(
+    "unsa_aborted_tokens_total", "Tokens de secuencias abortadas (wasted = decodificados, aborted = no decodificados)",
+    ("kind",)
+)
+client_disconnects_total = metrics.counter("unsa_client_disconnects_total", "Clientes que cortaron la conexión")
+cache_lookups_total = metrics.counter("unsa_response_cache_lookups_total", "Consultas al cache de respuestas", ("result",))
+cache_evictions_total = metrics.counter("unsa_response_cache_evictions_total", "Entradas desalojadas por LRU")
+coalesced_total = metrics.counter("unsa_coalesced_requests_total", "Solicitudes que compartieron una generación en vuelo")
+in_flight_gauge = metrics.gauge("unsa_in_flight_requests", "Solicitudes admitidas en el motor")
+queued_gauge = metrics.gauge("unsa_queued_requests", "Solicitudes esperando admisión", ("request_class",))
+concurrency_limit_gauge = metrics.gauge("unsa_concurrency_limit", "Límite de concurrencia actual")
+engine_running_gauge = metrics.gauge("unsa_engine_running_seqs", "Secuencias corriendo en el motor")
+engine_waiting_gauge = metrics.gauge("unsa_engine_waiting_seqs", "Secuencias esperando en el scheduler del motor")
+kv_cache_usage_gauge = metrics.gauge("unsa_kv_cache_usage_ratio", "Fracción de bloques de KV cache en uso")
+prefix_cache_hit_rate_gauge = metrics.gauge("unsa_prefix_cache_hit_rate", "Tasa de aciertos del prefix cache del motor")
+
+def _collect_metrics():
+    """Copia los contadores que se llevan en otros módulos justo antes del scrape"""
+    in_flight_gauge.set(scheduler.in_flight)
+    concurrency_limit_gauge.set(scheduler.limit)
+    for request_class, queued in scheduler.snapshot()["queued_by_class"].items():
+        queued_gauge.set(queued, request_class=request_class)
+    for reason, count in abort_stats["aborted_by_reason"].items():
+        aborted_total.set_total(count, reason=reason)
+    aborted_tokens_total.set_total(abort_stats["tokens_wasted"], kind="wasted")
+    aborted_tokens_total.set_total(abort_stats["tokens_aborted"], kind="aborted")
+    client_disconnects_total.set_total(abort_stats["client_disconnects"])
+    cache_lookups_total.set_total(response_cache.stats["hits"], result="hit")
+    cache_lookups_total.set_total(response_cache.stats["misses"], result="miss")
+    cache_evictions_total.set_total(response_cache.stats["evictions"])
+    coalesced_total.set_total(single_flight.stats["coalesced"])
+    token_counter = getattr(app.state, "token_counter", None)
+    if token_counter is not None:
+        tokenizer_cache_lookups_total.set_total(token_counter.stats["hits"], result="hit")
+        tokenizer_cache_lookups_total.set_total(token_counter.stats["misses"], result="miss")
+    
+    engine = getattr(app.state, "engine", None)
+    if engine is None:
+        return
+    stats = engine_stats(engine)
+    for gauge, key in ((engine_running_gauge, "num_running"), (engine_waiting_gauge, "num_waiting"),
+                       (kv_cache_usage_gauge, "kv_cache_usage"),
+                       (prefix_cache_hit_rate_gauge, "prefix_cache_hit_rate")):
+        if stats.get(key) is not None:
+            gauge.set(stats[key])
+
+metrics.add_collector(_collect_metrics)
+
+def _observe_request(endpoint: str, request_class: str, status: int, start: float):
+    requests_total.inc(endpoint=endpoint, request_class=request_class, status=status)
+    request_latency.observe(time.monotonic() - start, endpoint=endpoint, request_class=request_class)
 
 # === INICIALIZAR vLLM ASÍNCRONO ===
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manejar el ciclo de vida de la aplicación"""
-    logger.info("🚀 Inicializando vLLM asíncrono...")
+    logger.info(f"🚀 Inicializando motor asíncrono ({ENGINE_BACKEND})...")
     
     # Configuración optimizada para producción
-    engine_args = AsyncEngineArgs(
+    engine_args = dict(
         model=MODEL_NAME,
         quantization="awq",          # ← Obligatorio para AWQ( si no es GPTQ)
         dtype="float16",              # GPTQ-Int4 usa float16 para pesos no cuantizados
         trust_remote_code=True,       # ← Obligatorio para Qwen
         gpu_memory_utilization=0.85,  # Deja ~2.5 GB libres en A4000 (16 GB)
-        max_model_len=4096,           # o 8192 si necesitas más
+        max_model_len=MAX_MODEL_LEN,  # 4096, o 8192 si necesitas más
         enforce_eager=True,           # recomendado para GPUs de 16 GB
         enable_prefix_caching=True,
-        max_num_seqs=MAX_CONCURRENT_REQUESTS,
+        max_num_seqs=MAX_NUM_SEQS,
         max_num_batched_tokens=4096,  # o 8192 si ajustas memoria
         tensor_parallel_size=1
         )
     
-    app.state.engine = AsyncLLMEngine.from_engine_args(engine_args)
-    logger.info("✅ vLLM inicializado correctamente")
+    app.state.engine = create_engine(ENGINE_BACKEND, engine_args)
+    # Para aplicar el chat template del modelo en /chat
+    app.state.tokenizer = await app.state.engine.get_tokenizer()
+    app.state.token_counter = TokenCounter(app.state.tokenizer, TOKENIZE_CACHE_SIZE)
+    logger.info(f"✅ Motor {ENGINE_BACKEND} inicializado correctamente")
+    
+    adapt_task = asyncio.create_task(_adapt_concurrency_loop()) if ADAPTIVE_CONCURRENCY else None
     
     yield
     
     # Limpiar recursos
+    if adapt_task:
+        adapt_task.cancel()
     logger.info("🛑 Apagando servidor vLLM...")
     try:
         await app.state.engine.shutdown()
@@ -86,91 +276,346 @@ class InferenceRequest(BaseModel):
     user_id: str = "anonymous"
     top_p: float = 0.9
     top_k: int = 50
+    use_cache: bool = True  # False para forzar una generación nueva
+    priority: Optional[str] = None  # interactive | rag | batch (por defecto según el largo del prompt)
 
 class InferenceResponse(BaseModel):
     response: str
     model: str = MODEL_NAME
     tokens_used: int
     processing_time: float
+    cached: bool = False
+    prompt_tokens: Optional[int] = None
+    cached_prompt_tokens: Optional[int] = None  # tokens del prompt que no pagaron prefill (prefix cache)
+    dropped_tokens: Optional[int] = None  # contexto recortado para entrar en MAX_MODEL_LEN (solo /chat)
+    dropped_sections: Optional[int] = None
 
-# === MIDDLEWARE DE CONTROL DE CARGA ===
-@app.middleware("http")
-async def load_control_middleware(request: Request, call_next):
-    """Control de carga y backpressure real"""
-    if request_queue.qsize() >= request_queue.maxsize:
-        logger.warning(f"🚨 Cola llena ({request_queue.qsize()}/{request_queue.maxsize}). Rechazando solicitud.")
-        return JSONResponse(
-            status_code=503,
-            content={"error": "Servicio temporalmente saturado. Intenta nuevamente en unos minutos."}
-        )
-    
-    start_time = time.time()
+class ChatMessage(BaseModel):
+    role: str  # user | assistant
+    content: str
+
+class ChatRequest(BaseModel):
+    """El servidor arma el prompt: plantilla + variables + mensajes (el último es la pregunta)"""
+    template_id: str
+    variables: Dict[str, str] = {}
+    # Variables en secciones ordenadas por relevancia (p. ej. un fragmento por
+    # resultado): el servidor descarta las últimas si el prompt no entra
+    sections: Dict[str, List[str]] = {}
+    messages: List[ChatMessage]
+    temperature: float = 0.2
+    max_tokens: int = 850
+    user_id: str = "anonymous"
+    top_p: float = 0.9
+    top_k: int = 50
+    use_cache: bool = True
+    priority: Optional[str] = None  # por defecto, la clase de la plantilla
+
+# === ADMISIÓN ===
+# Solo las rutas de generación pasan por el scheduler; /health y el resto no esperan en cola
+def _client_deadline(http_request: Request) -> Optional[float]:
+    """Deadline (reloj monotónico) a partir del presupuesto que envía el cliente"""
+    client_budget = http_request.headers.get(DEADLINE_HEADER)
+    if not client_budget:
+        return None
+    try:
+        return time.monotonic() + float(client_budget)
+    except ValueError:
+        logger.warning(f"Header {DEADLINE_HEADER} inválido: {client_budget!r}")
+        return None
+
+def classify_request(request: InferenceRequest) -> str:
+    if request.priority in PRIORITY_CLASSES:
+        return request.priority
+    return "interactive" if len(request.prompt) <= SHORT_PROMPT_CHARS else "rag"
+
+async def _admit(request: InferenceRequest, deadline: Optional[float],
+                 max_queue_wait: float = QUEUE_TIMEOUT) -> Ticket:
+    """Espera lugar en el motor; 503 con Retry-After si no hay chance, 504 si vence la espera"""
+    queue_timeout = max_queue_wait
+    if deadline is not None:
+        # No tiene sentido esperar en cola más de lo que el cliente va a esperar
+        queue_timeout = min(max_queue_wait, deadline - time.monotonic() - MIN_USEFUL_TIME)
+        if queue_timeout <= 0:
+            abort_stats["deadline_rejections"] += 1
+            rejections_total.inc(request_class=classify_request(request), reason="deadline")
+            raise HTTPException(status_code=504, detail="La solicitud llegó sin tiempo suficiente para ser procesada.")
     
+    request_class = classify_request(request)
     try:
-        # Agregar a cola con timeout
-        task = asyncio.current_task()
-        await asyncio.wait_for(request_queue.put(task), QUEUE_TIMEOUT)
-        
-        # Adquirir semáforo con timeout
-        acquired = await asyncio.wait_for(semaphore.acquire(), QUEUE_TIMEOUT)
-        if not acquired:
-            raise asyncio.TimeoutError("Timeout adquiriendo recurso")
-        
-        try:
-            response = await call_next(request)
-        finally:
-            semaphore.release()
-            if not request_queue.empty():
-                request_queue.get_nowait()
-                request_queue.task_done()
-        
-        return response
-        
+        ticket = await scheduler.acquire(request.user_id, request_class, queue_timeout)
+        concurrency_limit.record_queue_wait(ticket.queue_wait)
+        queue_wait_seconds.observe(ticket.queue_wait, request_class=request_class)
+        return ticket
+    except AdmissionRejected as e:
+        rejections_total.inc(request_class=request_class, reason=e.reason)
+        logger.warning(
+            f"🚨 Rechazada [{request_class}] para {request.user_id}: {e.reason} "
+            f"(espera estimada {e.retry_after:.1f}s, en cola {scheduler.queued})"
+        )
+        raise HTTPException(
+            status_code=503,
+            detail="Servicio temporalmente saturado. Intenta nuevamente en unos minutos.",
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
     except asyncio.TimeoutError:
-        logger.error("⏰ Timeout procesando solicitud")
-        return JSONResponse(
+        concurrency_limit.record_queue_wait(queue_timeout)
+        queue_wait_seconds.observe(queue_timeout, request_class=request_class)
+        rejections_total.inc(request_class=request_class, reason="queue_timeout")
+        timeouts_total.inc(request_class=request_class, stage="queue")
+        logger.error(f"⏰ Timeout esperando en cola [{request_class}] para {request.user_id}")
+        raise HTTPException(
             status_code=504,
-            content={"error": "Tiempo de espera excedido. Tu solicitud es importante, intenta nuevamente."}
+            detail="Tiempo de espera excedido. Tu solicitud es importante, intenta nuevamente."
         )
+
+# === HELPERS DE GENERACIÓN ===
+class DeadlineExceeded(Exception):
+    """El deadline del cliente no deja tiempo para una respuesta útil"""
+
+class ClientDisconnected(Exception):
+    """El cliente HTTP cerró la conexión antes de recibir la respuesta"""
+
+def _generation_budget(deadline: Optional[float], requested_tokens: int, request_class: str):
+    """
+    Calcula (timeout, max_tokens) respetando MODEL_TIMEOUT y el deadline del cliente.
+    Si el cliente abandona antes, se recorta max_tokens a lo que alcanza a decodificarse.
+    """
+    if deadline is None:
+        return MODEL_TIMEOUT, requested_tokens
+    
+    remaining = deadline - time.monotonic()
+    timeout = min(MODEL_TIMEOUT, remaining)
+    max_tokens = min(requested_tokens, int(timeout * DECODE_TOKENS_PER_SEC))
+    if timeout < MIN_USEFUL_TIME or max_tokens < MIN_USEFUL_TOKENS:
+        abort_stats["deadline_rejections"] += 1
+        rejections_total.inc(request_class=request_class, reason="deadline")
+        raise DeadlineExceeded()
+    return timeout, max_tokens
+
+def _build_sampling_params(request: InferenceRequest, max_tokens: int) -> SamplingParams:
+    """Parámetros de muestreo comunes a /generate y /generate_stream"""
+    return SamplingParams(
+        temperature=request.temperature,
+        max_tokens=max_tokens,
+        stop=["<|im_end|>", "</s>", "###"],
+        repetition_penalty=1.1,
+        skip_special_tokens=True,
+        top_p=request.top_p,
+        top_k=request.top_k
+    )
+
+def _new_request_id(user_id: str) -> str:
+    return str(time.time()) + "_" + user_id
+
+async def _iterate_with_timeout(results_generator, timeout: float):
+    """Itera el generador de vLLM aplicando un timeout total (no por token)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        try:
+            yield await asyncio.wait_for(anext(results_generator), remaining)
+        except StopAsyncIteration:
+            return
+
+async def _abort_request(request_id: str, reason: str, tokens_generated: int, max_tokens: int):
+    """Libera la secuencia en el motor para no gastar GPU en una respuesta que nadie leerá"""
+    try:
+        await app.state.engine.abort(request_id)
     except Exception as e:
-        logger.error(f"❌ Error en middleware: {e}")
+        logger.error(f"Error abortando {request_id}: {e}")
+    abort_stats["aborted_requests"] += 1
+    abort_stats["aborted_by_reason"][reason] += 1
+    abort_stats["tokens_wasted"] += tokens_generated
+    abort_stats["tokens_aborted"] += max(0, max_tokens - tokens_generated)
+    logger.warning(f"🛑 Abortada {request_id} ({reason}) tras {tokens_generated}/{max_tokens} tokens")
+
+async def _engine_stream(prompt: str, sampling_params: SamplingParams, request_id: str,
+                         timeout: float, request_class: str):
+    """
+    Generador sobre el motor con timeout total. Si no termina normalmente
+    (timeout, cancelación por desconexión o error) aborta la secuencia en vLLM.
+    Registra TTFT, latencia entre tokens y tokens/s de la secuencia.
+    """
+    start = time.monotonic()
+    results_generator = app.state.engine.generate(prompt, sampling_params, request_id=request_id)
+    finished = False
+    tokens_generated = 0
+    first_token_at = last_token_at = None
+    reason = "cancelled"
+    try:
+        async for request_output in _iterate_with_timeout(results_generator, timeout):
+            if request_output.outputs:
+                now = time.monotonic()
+                new_tokens = len(request_output.outputs[0].token_ids) - tokens_generated
+                if first_token_at is None and new_tokens > 0:
+                    first_token_at = now
+                    concurrency_limit.record_ttft(now - start)
+                    ttft_seconds.observe(now - start, request_class=request_class)
+                    prompt_tokens.observe(len(request_output.prompt_token_ids or ()), request_class=request_class)
+                    cached_prompt_tokens_total.inc(
+                        getattr(request_output, "num_cached_tokens", None) or 0, request_class=request_class
+                    )
+                elif new_tokens > 0:
+                    inter_token_latency.observe((now - last_token_at) / new_tokens, request_class=request_class)
+                if new_tokens > 0:
+                    last_token_at = now
+                    tokens_generated += new_tokens
+            finished = request_output.finished
+            yield request_output
+    except asyncio.TimeoutError:
+        reason = "timeout"
+        concurrency_limit.record_timeout()
+        timeouts_total.inc(request_class=request_class, stage="generation")
+        raise
+    except Exception:
+        reason = "error"
         raise
+    finally:
+        generation_tokens_total.inc(tokens_generated, request_class=request_class)
+        if finished and tokens_generated > 1 and last_token_at > first_token_at:
+            generation_tokens_per_second.observe(
+                (tokens_generated - 1) / (last_token_at - first_token_at), request_class=request_class
+            )
+        if not finished:
+            await _abort_request(request_id, reason, tokens_generated, sampling_params.max_tokens)
+
+async def _run_until_disconnect(http_request: Request, coro):
+    """Ejecuta coro cancelándola si el cliente HTTP se desconecta antes de que termine"""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                abort_stats["client_disconnects"] += 1
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+def _cache_key(request: InferenceRequest) -> Optional[str]:
+    """Clave de cache/coalescencia, o None si la solicitud no es cacheable"""
+    if not request.use_cache or request.temperature > CACHE_MAX_TEMPERATURE:
+        return None
+    return make_cache_key(request.prompt, {
+        "model": MODEL_NAME,
+        "temperature": request.temperature,
+        "max_tokens": request.max_tokens,
+        "top_p": request.top_p,
+        "top_k": request.top_k
+    })
+
+def _store_in_cache(cache_key: Optional[str], response_text: str, tokens_used: int, truncated: bool):
+    """Guarda respuestas completas (no las recortadas por el deadline de un cliente)"""
+    if cache_key and response_text and not truncated:
+        response_cache.put(cache_key, {"response": response_text, "tokens_used": tokens_used})
+
+def _ndjson(payload: dict) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse que llama a on_close al terminar de enviarse, aunque el cuerpo nunca empiece"""
+    
+    def __init__(self, content, on_close: Callable[[], None], **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def _prompt_usage(output) -> dict:
+    """Tokens del prompt y cuántos salieron del prefix cache (si el motor lo informa)"""
+    if output is None:
+        return {}
+    prompt_token_ids = getattr(output, "prompt_token_ids", None)
+    return {
+        "prompt_tokens": len(prompt_token_ids) if prompt_token_ids is not None else None,
+        "cached_prompt_tokens": getattr(output, "num_cached_tokens", None)
+    }
 
 # === ENDPOINT DE INFERENCIA OPTIMIZADO ===
 @app.post("/generate", response_model=InferenceResponse)
-async def generate(request: InferenceRequest):
+async def generate(request: InferenceRequest, http_request: Request, response: Response):
     """Endpoint optimizado para chat interactivo - aprovecha continuous batching de vLLM"""
+    return await _generate(request, http_request, response, "generate")
+
+async def _generate(request: InferenceRequest, http_request: Request, response: Response, endpoint: str,
+                    context_report: Optional[dict] = None):
+    """
+    Generación completa con admisión, cache y coalescencia (compartida por /generate y /chat).
+    context_report (dropped_tokens/dropped_sections) se agrega a la respuesta.
+    """
+    context_report = context_report or {}
     start_time = time.time()
+    started = time.monotonic()
+    deadline = _client_deadline(http_request)
+    request_class = classify_request(request)
+    status = 500
     
     try:
         logger.info(f"👤 [Usuario: {request.user_id}] Procesando solicitud...")
         
-        sampling_params = SamplingParams(
-            temperature=request.temperature,
-            max_tokens=request.max_tokens,
-            stop=["<|im_end|>", "</s>", "###"],
-            repetition_penalty=1.1,
-            skip_special_tokens=True,
-            top_p=request.top_p,
-            top_k=request.top_k
-        )
+        cache_key = _cache_key(request)
+        if cache_key:
+            cached = response_cache.get(cache_key)
+            if cached:
+                logger.info(f"♻️ [Usuario: {request.user_id}] Respuesta desde cache")
+                status = 200
+                return InferenceResponse(
+                    response=cached["response"],
+                    tokens_used=cached["tokens_used"],
+                    processing_time=time.time() - start_time,
+                    cached=True,
+                    **context_report
+                )
         
-        # Usar vLLM asíncrono - esto permite continuous batching REAL
-        async def generate_with_timeout():
-            results_generator = app.state.engine.generate(
-                request.prompt,
-                sampling_params,
-                request_id=str(time.time()) + "_" + request.user_id
-            )
-            
-            final_output = None
-            async for request_output in results_generator:
-                final_output = request_output
-            
-            return final_output
+        # Solo se coalescen solicitudes con el presupuesto completo: una que su deadline
+        # obliga a recortar genera sola y no les impone el recorte a las demás
+        _, entry_tokens = _generation_budget(deadline, request.max_tokens, request_class)
+        coalesce = cache_key is not None and entry_tokens == request.max_tokens
         
-        # Ejecutar con timeout
-        output = await asyncio.wait_for(generate_with_timeout(), MODEL_TIMEOUT)
+        # Admisión, generación y liberación del lugar en la misma tarea: si se comparte,
+        # el ticket vive mientras viva la generación, sea quien sea el que la espera
+        async def generate_admitted(budget_deadline: Optional[float]):
+            ticket = await _admit(request, deadline)
+            try:
+                timeout, max_tokens = _generation_budget(budget_deadline, request.max_tokens, request_class)
+                sampling_params = _build_sampling_params(request, max_tokens)
+                request_id = _new_request_id(request.user_id)
+                
+                # Usar vLLM asíncrono - esto permite continuous batching REAL
+                final_output = None
+                async for request_output in _engine_stream(
+                    request.prompt, sampling_params, request_id, timeout, request_class
+                ):
+                    final_output = request_output
+                
+                return final_output, max_tokens, ticket.queue_wait
+            finally:
+                scheduler.release(ticket)
+        
+        # Si el cliente se va, se cancela y se aborta en el motor. Las solicitudes
+        # idénticas en vuelo comparten una sola generación (SingleFlight decide quién
+        # la lanza de forma atómica); cada una espera hasta su propio deadline.
+        shared = False
+        if coalesce:
+            wait_timeout = deadline - time.monotonic() if deadline is not None else None
+            (output, max_tokens, queue_wait), shared = await _run_until_disconnect(
+                http_request,
+                asyncio.wait_for(single_flight.run(cache_key, lambda: generate_admitted(None)), wait_timeout)
+            )
+        else:
+            output, max_tokens, queue_wait = await _run_until_disconnect(
+                http_request, generate_admitted(deadline)
+            )
+        response.headers["X-Queue-Wait"] = f"{queue_wait:.4f}"
         
         if not output or not output.outputs:
             raise ValueError("No se generó respuesta válida")
@@ -178,46 +623,438 @@ async def generate(request: InferenceRequest):
         response_text = output.outputs[0].text.strip()
         tokens_used = len(output.outputs[0].token_ids)
         processing_time = time.time() - start_time
+        if not shared:
+            _store_in_cache(cache_key, response_text, tokens_used, max_tokens < request.max_tokens)
         
-        logger.info(f"✅ [Usuario: {request.user_id}] Respuesta generada ({tokens_used} tokens) en {processing_time:.2f}s")
+        logger.info(
+            f"✅ [Usuario: {request.user_id}] Respuesta generada ({tokens_used} tokens) en {processing_time:.2f}s"
+            + (" (generación compartida)" if shared else "")
+        )
         
+        status = 200
         return InferenceResponse(
             response=response_text,
             tokens_used=tokens_used,
-            processing_time=processing_time
+            processing_time=processing_time,
+            **_prompt_usage(output),
+            **context_report
         )
     
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except DeadlineExceeded:
+        status = 504
+        logger.warning(f"⏳ [Usuario: {request.user_id}] Deadline del cliente insuficiente, rechazada")
+        raise HTTPException(status_code=504, detail="La solicitud llegó sin tiempo suficiente para ser procesada.")
+    except ClientDisconnected:
+        status = 499
+        logger.warning(f"🔌 [Usuario: {request.user_id}] Cliente desconectado, generación abortada")
+        raise HTTPException(status_code=499, detail="Cliente desconectado.")
     except asyncio.TimeoutError:
+        status = 504
         logger.error(f"⏰ [Usuario: {request.user_id}] Timeout en generación de texto")
         raise HTTPException(status_code=504, detail="Tiempo de generación excedido. Intenta con una pregunta más específica.")
     except Exception as e:
         logger.error(f"❌ [Usuario: {request.user_id}] Error en generación: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error procesando solicitud: {str(e)}")
+    finally:
+        _observe_request(endpoint, request_class, status, started)
+
+# === ENDPOINT DE STREAMING ===
+@app.post("/generate_stream")
+async def generate_stream(request: InferenceRequest, http_request: Request):
+    """Streaming NDJSON: una línea por delta a medida que vLLM emite tokens.
+    
+    Cada línea es {"delta": str, "tokens": int}; la última trae "done": true con
+    la respuesta completa, o "error" si la generación falló a mitad de camino.
+    Si el cliente corta la conexión, Starlette cancela el stream y la secuencia
+    se aborta en el motor. Los aciertos de cache se envían en un único delta;
+    el streaming no se coalesce con otras solicitudes en vuelo.
+    """
+    return await _generate_stream(request, http_request, "generate_stream")
+
+async def _generate_stream(request: InferenceRequest, http_request: Request, endpoint: str,
+                           context_report: Optional[dict] = None):
+    context_report = context_report or {}
+    logger.info(f"👤 [Usuario: {request.user_id}] Procesando solicitud en streaming...")
+    started = time.monotonic()
+    deadline = _client_deadline(http_request)
+    request_class = classify_request(request)
+    cache_key = _cache_key(request)
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached:
+        logger.info(f"♻️ [Usuario: {request.user_id}] Stream desde cache")
+        _observe_request(endpoint, request_class, 200, started)
+        
+        async def cached_stream():
+            yield _ndjson({"delta": cached["response"], "tokens": cached["tokens_used"]})
+            yield _ndjson({
+                "done": True,
+                "response": cached["response"],
+                "model": MODEL_NAME,
+                "tokens_used": cached["tokens_used"],
+                "processing_time": 0.0,
+                "time_to_first_token": 0.0,
+                "cached": True,
+                **context_report
+            })
+        
+        return StreamingResponse(cached_stream(), media_type="application/x-ndjson")
+    
+    # El lugar en el motor se toma acá (para poder responder 503/504) y se
+    # libera cuando termina el stream, no cuando se devuelve la respuesta
+    try:
+        ticket = await _admit(request, deadline)
+    except HTTPException as e:
+        _observe_request(endpoint, request_class, e.status_code, started)
+        raise
+    finished = False
+    
+    def finish(status: int):
+        # Una sola vez: lo llaman el final del stream y el cierre de la respuesta
+        nonlocal finished
+        if not finished:
+            finished = True
+            scheduler.release(ticket)
+            _observe_request(endpoint, request_class, status, started)
+    
+    try:
+        timeout, max_tokens = _generation_budget(deadline, request.max_tokens, request_class)
+        sampling_params = _build_sampling_params(request, max_tokens)
+        request_id = _new_request_id(request.user_id)
+    except DeadlineExceeded:
+        finish(504)
+        raise HTTPException(status_code=504, detail="La solicitud llegó sin tiempo suficiente para ser procesada.")
+    except BaseException:
+        finish(500)
+        raise
+    
+    async def event_stream():
+        start_time = time.time()
+        first_token_time = None
+        text = ""
+        tokens_used = 0
+        last_output = None
+        # El código HTTP ya se envió; el estado registrado refleja cómo terminó el stream
+        status = 499
+        try:
+            async for request_output in _engine_stream(
+                request.prompt, sampling_params, request_id, timeout, request_class
+            ):
+                if not request_output.outputs:
+                    continue
+                last_output = request_output
+                completion = request_output.outputs[0]
+                # vLLM entrega el texto acumulado: enviamos solo lo nuevo
+                delta = completion.text[len(text):]
+                text = completion.text
+                tokens_used = len(completion.token_ids)
+                if delta:
+                    if first_token_time is None:
+                        first_token_time = time.time() - start_time
+                    yield _ndjson({"delta": delta, "tokens": tokens_used})
+            
+            processing_time = time.time() - start_time
+            _store_in_cache(cache_key, text.strip(), tokens_used, max_tokens < request.max_tokens)
+            logger.info(
+                f"✅ [Usuario: {request.user_id}] Stream completo ({tokens_used} tokens) "
+                f"en {processing_time:.2f}s, primer token en {first_token_time or 0:.2f}s"
+            )
+            status = 200
+            yield _ndjson({
+                "done": True,
+                "response": text.strip(),
+                "model": MODEL_NAME,
+                "tokens_used": tokens_used,
+                "processing_time": processing_time,
+                "time_to_first_token": first_token_time,
+                **_prompt_usage(last_output),
+                **context_report
+            })
+        except asyncio.TimeoutError:
+            status = 504
+            logger.error(f"⏰ [Usuario: {request.user_id}] Timeout en generación en streaming")
+            yield _ndjson({"done": True, "error": "Tiempo de generación excedido."})
+        except Exception as e:
+            status = 500
+            logger.error(f"❌ [Usuario: {request.user_id}] Error en streaming: {str(e)}", exc_info=True)
+            yield _ndjson({"done": True, "error": f"Error procesando solicitud: {str(e)}"})
+        finally:
+            finish(status)
+    
+    # Si el cliente se desconecta antes de que empiece el cuerpo, el finally
+    # de event_stream no corre nunca: el cierre de la respuesta libera igual
+    return _ClosingStreamingResponse(
+        event_stream(),
+        on_close=lambda: finish(499),
+        media_type="application/x-ndjson",
+        headers={"X-Queue-Wait": f"{ticket.queue_wait:.4f}"}
+    )
+
+# === CHAT CON PLANTILLAS DEL SERVIDOR ===
+def _chat_to_inference(request: ChatRequest):
+    """
+    Renderiza la plantilla con el chat template del modelo y recorta las secciones
+    de contexto hasta que prompt + max_tokens entren en MAX_MODEL_LEN.
+    Retorna (InferenceRequest, reporte de recorte); 422 si la plantilla no aplica,
+    413 si el prompt no entra ni sin contexto.
+    """
+    raw_messages = [m.model_dump() for m in request.messages]
+    
+    def render(section_variables: Dict[str, str]) -> str:
+        variables = {**request.variables, **section_variables}
+        return apply_chat_template(
+            app.state.tokenizer, render_messages(request.template_id, variables, raw_messages)
+        )
+    
+    request_class = request.priority or TEMPLATES.get(request.template_id, TEMPLATES["rag"]).request_class
+    try:
+        prompt, report = fit_sections(
+            app.state.token_counter, render, request.sections, MAX_MODEL_LEN - request.max_tokens
+        )
+    except TemplateError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except PromptTooLong as e:
+        rejections_total.inc(request_class=request_class, reason="prompt_too_long")
+        raise HTTPException(
+            status_code=413,
+            detail=f"El prompt ({e.prompt_tokens} tokens) no entra en el contexto del modelo con max_tokens={request.max_tokens}."
+        )
+    
+    if report["dropped_sections"]:
+        context_dropped_tokens_total.inc(report["dropped_tokens"], request_class=request_class)
+        logger.info(
+            f"✂️ [Usuario: {request.user_id}] Contexto recortado: {report['dropped_sections']} secciones, "
+            f"{report['dropped_tokens']} tokens (prompt final {report['prompt_tokens']} tokens)"
+        )
+    inference_request = InferenceRequest(
+        prompt=prompt,
+        temperature=request.temperature,
+        max_tokens=request.max_tokens,
+        user_id=request.user_id,
+        top_p=request.top_p,
+        top_k=request.top_k,
+        use_cache=request.use_cache,
+        priority=request_class
+    )
+    return inference_request, {"dropped_tokens": report["dropped_tokens"], "dropped_sections": report["dropped_sections"]}
+
+@app.post("/chat", response_model=InferenceResponse)
+async def chat(request: ChatRequest, http_request: Request, response: Response):
+    """Como /generate, pero el prompt lo arma el servidor a partir de una plantilla.
+    
+    El bloque de sistema de cada plantilla es idéntico en todas las solicitudes,
+    así que su prefill sale del prefix cache de vLLM (ver cached_prompt_tokens).
+    """
+    inference_request, context_report = _chat_to_inference(request)
+    return await _generate(inference_request, http_request, response, "chat", context_report)
+
+@app.post("/chat_stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Versión streaming de /chat, con el mismo formato NDJSON que /generate_stream"""
+    inference_request, context_report = _chat_to_inference(request)
+    return await _generate_stream(inference_request, http_request, "chat_stream", context_report)
+
+# === GENERACIÓN POR LOTES ===
+class BatchItem(BaseModel):
+    prompt: str
+    id: Optional[str] = None  # se devuelve tal cual para identificar el resultado
+    temperature: float = 0.2
+    max_tokens: int = 850
+    top_p: float = 0.9
+    top_k: int = 50
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    user_id: str = "batch"
+    use_cache: bool = True
+
+async def _run_batch_item(index: int, item: BatchItem, batch: BatchRequest,
+                          deadline: Optional[float], pending: asyncio.Semaphore) -> dict:
+    """Genera un ítem del lote; los errores se reportan en el resultado, no se propagan"""
+    request = InferenceRequest(
+        prompt=item.prompt,
+        temperature=item.temperature,
+        max_tokens=item.max_tokens,
+        user_id=batch.user_id,
+        top_p=item.top_p,
+        top_k=item.top_k,
+        use_cache=batch.use_cache,
+        priority="batch"
+    )
+    result = {"index": index, "id": item.id}
+    started = time.monotonic()
+    status = 500
+    ticket = None
+    async with pending, batch_pending:
+        try:
+            cache_key = _cache_key(request)
+            cached = response_cache.get(cache_key) if cache_key else None
+            if cached:
+                status = 200
+                return {**result, "response": cached["response"], "tokens_used": cached["tokens_used"],
+                        "processing_time": 0.0, "cached": True}
+            
+            ticket = await _admit(request, deadline, BATCH_QUEUE_TIMEOUT)
+            timeout, max_tokens = _generation_budget(deadline, request.max_tokens, "batch")
+            sampling_params = _build_sampling_params(request, max_tokens)
+            request_id = _new_request_id(f"{batch.user_id}_{index}")
+            output = None
+            async for output in _engine_stream(request.prompt, sampling_params, request_id, timeout, "batch"):
+                pass
+            if not output or not output.outputs:
+                raise ValueError("No se generó respuesta válida")
+            
+            response_text = output.outputs[0].text.strip()
+            tokens_used = len(output.outputs[0].token_ids)
+            _store_in_cache(cache_key, response_text, tokens_used, max_tokens < request.max_tokens)
+            status = 200
+            return {**result, "response": response_text, "tokens_used": tokens_used,
+                    "processing_time": time.monotonic() - started, "queue_wait": ticket.queue_wait,
+                    **_prompt_usage(output)}
+        except HTTPException as e:
+            status = e.status_code
+            return {**result, "status": status, "error": e.detail}
+        except (DeadlineExceeded, asyncio.TimeoutError):
+            status = 504
+            return {**result, "status": status, "error": "Tiempo de generación excedido."}
+        except Exception as e:
+            logger.error(f"❌ [Lote {batch.user_id}] Error en ítem {index}: {str(e)}", exc_info=True)
+            return {**result, "status": status, "error": f"Error procesando solicitud: {str(e)}"}
+        finally:
+            if ticket:
+                scheduler.release(ticket)
+            _observe_request("generate_batch_item", "batch", status, started)
+
+@app.post("/generate_batch")
+async def generate_batch(batch: BatchRequest, http_request: Request):
+    """Genera una lista de prompts aprovechando el continuous batching del motor.
+    
+    Los ítems se admiten con prioridad "batch" (solo usan capacidad sobrante y
+    nunca los últimos BATCH_RESERVED_SLOTS lugares) y hasta BATCH_MAX_PENDING
+    por lote y BATCH_MAX_PENDING_TOTAL entre todos los lotes a la vez. Esperan
+    en una cola propia (BATCH_MAX_QUEUE), así los lotes no llenan la del
+    tráfico interactivo.
+    Responde NDJSON con una línea por ítem en orden de finalización:
+    {"index", "id", "response", "tokens_used", ...} o {"index", "id", "status", "error"};
+    la última línea es {"done": true, "succeeded", "failed", "processing_time"}.
+    Si el cliente corta la conexión se cancelan los ítems pendientes.
+    """
+    if not batch.items:
+        raise HTTPException(status_code=422, detail="El lote no tiene ítems.")
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"El lote supera el máximo de {BATCH_MAX_ITEMS} ítems.")
+    
+    logger.info(f"📦 [Lote {batch.user_id}] {len(batch.items)} ítems")
+    deadline = _client_deadline(http_request)
+    pending = asyncio.Semaphore(BATCH_MAX_PENDING)
+    
+    async def result_stream():
+        started = time.monotonic()
+        tasks = [
+            asyncio.ensure_future(_run_batch_item(index, item, batch, deadline, pending))
+            for index, item in enumerate(batch.items)
+        ]
+        succeeded = failed = 0
+        status = 499
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                if "error" in result:
+                    failed += 1
+                else:
+                    succeeded += 1
+                yield _ndjson(result)
+            
+            processing_time = time.monotonic() - started
+            logger.info(
+                f"✅ [Lote {batch.user_id}] {succeeded} ok, {failed} con error en {processing_time:.2f}s"
+            )
+            status = 200 if failed == 0 else 207
+            yield _ndjson({"done": True, "succeeded": succeeded, "failed": failed, "processing_time": processing_time})
+        finally:
+            # Desconexión del cliente: lo que no terminó se cancela y se aborta en el motor
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            _observe_request("generate_batch", "batch", status, started)
+    
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+# === TOKENIZACIÓN ===
+# Con el tokenizador del motor y sin pasar por el scheduler
+class TokenizeRequest(BaseModel):
+    text: str
+    return_ids: bool = False
+
+class TokenizeBatchRequest(BaseModel):
+    texts: List[str]
+    return_ids: bool = False
+
+@app.post("/tokenize")
+async def tokenize(request: TokenizeRequest):
+    """Cantidad de tokens (y opcionalmente ids) de un texto; los textos repetidos salen del cache"""
+    token_ids = app.state.token_counter.encode(request.text)
+    result = {"tokens": len(token_ids), "max_model_len": MAX_MODEL_LEN}
+    if request.return_ids:
+        result["token_ids"] = list(token_ids)
+    return result
+
+@app.post("/tokenize_batch")
+async def tokenize_batch(request: TokenizeBatchRequest):
+    """Como /tokenize para una lista de textos (p. ej. todos los fragmentos recuperados)"""
+    encoded = [app.state.token_counter.encode(text) for text in request.texts]
+    result = {
+        "tokens": [len(token_ids) for token_ids in encoded],
+        "total": sum(len(token_ids) for token_ids in encoded),
+        "max_model_len": MAX_MODEL_LEN
+    }
+    if request.return_ids:
+        result["token_ids"] = [list(token_ids) for token_ids in encoded]
+    return result
 
 # === HEALTH CHECK MEJORADO ===
 @app.get("/health")
 async def health_check():
     """Health check con información detallada de carga"""
-    queue_load = request_queue.qsize() / request_queue.maxsize * 100 if request_queue.maxsize > 0 else 0
-    semaphore_load = (MAX_CONCURRENT_REQUESTS - semaphore._value) / MAX_CONCURRENT_REQUESTS * 100
+    queue_load = scheduler.queued / scheduler.max_queue * 100 if scheduler.max_queue > 0 else 0
+    concurrency_load = scheduler.in_flight / scheduler.limit * 100 if scheduler.limit > 0 else 0
     
-    status = "healthy" if queue_load < 80 and semaphore_load < 90 else "degraded"
+    status = "healthy" if queue_load < 80 and concurrency_load < 90 else "degraded"
     
     return {
         "status": status,
         "model": MODEL_NAME,
-        "queue_size": request_queue.qsize(),
-        "queue_max": request_queue.maxsize,
+        "queue_size": scheduler.queued,
+        "queue_max": scheduler.max_queue,
         "queue_load_percent": round(queue_load, 1),
-        "concurrent_requests": MAX_CONCURRENT_REQUESTS - semaphore._value,
-        "max_concurrent": MAX_CONCURRENT_REQUESTS,
-        "semaphore_load_percent": round(semaphore_load, 1),
+        "concurrent_requests": scheduler.in_flight,
+        "max_concurrent": scheduler.limit,
+        "concurrency_load_percent": round(concurrency_load, 1),
+        "engine_backend": ENGINE_BACKEND,
+        "scheduler": scheduler.snapshot(),
+        "adaptive_concurrency": {"enabled": ADAPTIVE_CONCURRENCY, **concurrency_limit.snapshot()},
+        "aborts": abort_stats,
+        "response_cache": response_cache.snapshot(),
+        "single_flight": single_flight.snapshot(),
+        "tokenizer_cache": app.state.token_counter.snapshot(),
+        "engine": engine_stats(app.state.engine),
         "version": "2.0",
         "timestamp": time.time()
     }
 
+# === MÉTRICAS PROMETHEUS ===
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Métricas en formato de texto de Prometheus (no pasa por el scheduler)"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    logger.info(f"🔧 Configuración: MAX_CONCURRENT_REQUESTS={MAX_CONCURRENT_REQUESTS}, MODEL_NAME={MODEL_NAME}")
+    logger.info(
+        f"🔧 Configuración: ENGINE_BACKEND={ENGINE_BACKEND}, MAX_CONCURRENT_REQUESTS={MAX_CONCURRENT_REQUESTS}, "
+        f"MAX_NUM_SEQS={MAX_NUM_SEQS}, QUEUE_TIMEOUT={QUEUE_TIMEOUT}, MODEL_NAME={MODEL_NAME}"
+    )
     logger.info(f"🔌 Iniciando servidor en {HOST}:{PORT}")
     uvicorn.run(
         app,
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Generador de carga de lazo abierto para el servidor de inferencia.
+
+Las llegadas son Poisson (no esperan a que terminen las anteriores, como los
+usuarios reales) con una mezcla de prompts cortos (saludos), medianos y largos
+(RAG con muchos fragmentos). Reporta latencia p50/p95/p99, goodput, tasas de
+503/504 y espera en cola (header X-Queue-Wait del servidor).
+
+Por defecto mide el motor: cada prompt es distinto y se pide use_cache=false,
+así ni el cache de respuestas ni la coalescencia de solicitudes iguales
+contestan por él. Con --cache se repiten prompts y se deja usar el cache.
+
+Ejemplo sin GPU:
+    ENGINE_BACKEND=simulated python backend/inference_server.py &
+    python backend/loadgen.py --rate 8 --duration 60 --max-p95 15
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import aiohttp
+
+DEADLINE_HEADER = "X-Request-Timeout"
+
+FRAGMENT = (
+    "Licenciatura en Física. Carrera de grado. Sede: central. Duración: 5 años. "
+    "Formación en investigación básica y aplicada, con salida laboral en docencia e industria. "
+)
+
+# Longitud aproximada en caracteres de cada clase de prompt
+PROMPT_CLASSES = {
+    "short": 60,      # saludo o consulta directa
+    "medium": 1500,   # RAG con pocos fragmentos
+    "long": 6000      # RAG con ~20 fragmentos
+}
+
+QUESTIONS = [
+    "¿Qué becas hay disponibles para estudiantes de exactas?",
+    "¿De qué se trata la carrera?",
+    "¿Cuánto dura y dónde se cursa?",
+    "¿Qué salida laboral tiene?",
+    "¿Cuáles son los requisitos de inscripción?"
+]
+
+def build_prompt(kind: str, rng: random.Random, unique: bool = True) -> str:
+    """unique: agrega variación aleatoria para que dos solicitudes no compartan respuesta"""
+    target = int(PROMPT_CLASSES[kind] * rng.uniform(0.8, 1.2))
+    question = rng.choice(QUESTIONS)
+    if unique:
+        question = f"{question} (consulta {rng.randrange(10 ** 9)})"
+    if kind == "short":
+        return question
+    offset = rng.randrange(len(FRAGMENT)) if unique else 0
+    body = (FRAGMENT * (target // len(FRAGMENT) + 2))[offset:offset + target]
+    return f"INFORMACIÓN DE LA BASE DE DATOS UNSA:\n{body}\n\nPREGUNTA DEL USUARIO: {question}\n\nRESPUESTA:"
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        if name not in PROMPT_CLASSES:
+            raise argparse.ArgumentTypeError(f"Clase de prompt desconocida: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por rango más cercano"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+async def send_request(session, args, kind: str, prompt: str, user_id: str) -> dict:
+    start = time.monotonic()
+    result = {"kind": kind, "status": None, "latency": None, "queue_wait": None, "tokens": 0}
+    try:
+        async with session.post(
+            args.url.rstrip("/") + args.endpoint,
+            json={
+                "prompt": prompt,
+                "user_id": user_id,
+                "max_tokens": args.max_tokens,
+                "temperature": 0.2,
+                "use_cache": args.cache
+            },
+            headers={DEADLINE_HEADER: f"{args.client_timeout:.1f}"}
+        ) as resp:
+            body = await resp.read()
+            result["status"] = resp.status
+            if "X-Queue-Wait" in resp.headers:
+                result["queue_wait"] = float(resp.headers["X-Queue-Wait"])
+            if resp.status == 200:
+                result["tokens"] = json.loads(body).get("tokens_used", 0)
+    except asyncio.TimeoutError:
+        result["status"] = "client_timeout"
+    except aiohttp.ClientError as e:
+        result["status"] = f"error:{type(e).__name__}"
+    result["latency"] = time.monotonic() - start
+    return result
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    timeout = aiohttp.ClientTimeout(total=args.client_timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    tasks = []
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        start = time.monotonic()
+        next_arrival = start
+        while True:
+            next_arrival += rng.expovariate(args.rate)
+            if next_arrival - start >= args.duration:
+                break
+            await asyncio.sleep(max(0.0, next_arrival - time.monotonic()))
+            kind = rng.choices(kinds, weights)[0]
+            user_id = f"load{rng.randrange(args.users)}"
+            tasks.append(asyncio.create_task(
+                send_request(session, args, kind, build_prompt(kind, rng, unique=not args.cache), user_id)
+            ))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start
+
+    return summarize(results, elapsed, args.slo)
+
+def summarize(results: List[dict], elapsed: float, slo: float) -> dict:
+    total = len(results)
+    statuses = Counter(str(r["status"]) for r in results)
+    ok = [r for r in results if r["status"] == 200]
+    latencies = [r["latency"] for r in ok]
+    queue_waits = [r["queue_wait"] for r in results if r["queue_wait"] is not None]
+    good = [r for r in ok if r["latency"] <= slo]
+
+    def pcts(values):
+        return {f"p{p}": percentile(values, p) for p in (50, 95, 99)}
+
+    by_kind = {}
+    for kind in sorted({r["kind"] for r in results}):
+        kind_ok = [r["latency"] for r in ok if r["kind"] == kind]
+        by_kind[kind] = {"sent": sum(1 for r in results if r["kind"] == kind), "ok": len(kind_ok), **pcts(kind_ok)}
+
+    return {
+        "requests": total,
+        "duration_s": elapsed,
+        "offered_rps": total / elapsed if elapsed else 0,
+        "statuses": dict(statuses),
+        "success_rate": len(ok) / total if total else 0,
+        "rate_503": statuses.get("503", 0) / total if total else 0,
+        "rate_504": statuses.get("504", 0) / total if total else 0,
+        "goodput_rps": len(good) / elapsed if elapsed else 0,
+        "slo_s": slo,
+        "latency": pcts(latencies),
+        "queue_wait": pcts(queue_waits),
+        "tokens_per_s": sum(r["tokens"] for r in ok) / elapsed if elapsed else 0,
+        "by_kind": by_kind
+    }
+
+def print_report(report: dict):
+    def fmt(value):
+        return "-" if value is None else f"{value:.2f}s"
+
+    print("📈 Resultado de la prueba de carga")
+    print(f"   Solicitudes: {report['requests']} en {report['duration_s']:.1f}s "
+          f"({report['offered_rps']:.2f} req/s ofrecidas)")
+    print(f"   Estados: {report['statuses']}")
+    print(f"   Éxito: {report['success_rate']:.1%} | 503: {report['rate_503']:.1%} | 504: {report['rate_504']:.1%}")
+    print(f"   Goodput (≤{report['slo_s']:.0f}s): {report['goodput_rps']:.2f} req/s | "
+          f"{report['tokens_per_s']:.1f} tokens/s")
+    lat, qw = report["latency"], report["queue_wait"]
+    print(f"   Latencia p50/p95/p99: {fmt(lat['p50'])} / {fmt(lat['p95'])} / {fmt(lat['p99'])}")
+    print(f"   Espera en cola p50/p95/p99: {fmt(qw['p50'])} / {fmt(qw['p95'])} / {fmt(qw['p99'])}")
+    for kind, stats in report["by_kind"].items():
+        print(f"   [{kind}] {stats['ok']}/{stats['sent']} ok, p50 {fmt(stats['p50'])}, p95 {fmt(stats['p95'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga de lazo abierto (llegadas Poisson)")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", default="/generate")
+    parser.add_argument("--rate", type=float, default=5.0, help="llegadas por segundo")
+    parser.add_argument("--duration", type=float, default=60.0, help="segundos generando llegadas")
+    parser.add_argument("--mix", default="short:0.4,medium:0.3,long:0.3", help="clase:peso,...")
+    parser.add_argument("--users", type=int, default=50, help="usuarios distintos simulados")
+    parser.add_argument("--max-tokens", type=int, default=500)
+    parser.add_argument("--client-timeout", type=float, default=15.0, help="igual que REQUEST_TIMEOUT del bot")
+    parser.add_argument("--slo", type=float, default=15.0, help="latencia máxima para contar en el goodput")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cache", action="store_true",
+                        help="repetir prompts y permitir el cache de respuestas (por defecto se mide el motor)")
+    parser.add_argument("--json", dest="json_out", help="guardar el reporte en este archivo")
+    # Umbrales para CI: el proceso termina con código 1 si alguno se supera
+    parser.add_argument("--max-p95", type=float, help="latencia p95 máxima (s)")
+    parser.add_argument("--max-error-rate", type=float, help="fracción máxima de solicitudes no exitosas")
+    parser.add_argument("--min-goodput", type=float, help="goodput mínimo (req/s)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    p95 = report["latency"]["p95"]
+    if args.max_p95 is not None and (p95 is None or p95 > args.max_p95):
+        failures.append(f"p95 {p95} > {args.max_p95}")
+    if args.max_error_rate is not None and 1 - report["success_rate"] > args.max_error_rate:
+        failures.append(f"error rate {1 - report['success_rate']:.3f} > {args.max_error_rate}")
+    if args.min_goodput is not None and report["goodput_rps"] < args.min_goodput:
+        failures.append(f"goodput {report['goodput_rps']:.2f} < {args.min_goodput}")
+    if failures:
+        print("❌ Umbrales superados: " + "; ".join(failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Conteo de tokens con el tokenizador del motor y recorte de contexto.
+
+- TokenCounter: encode con cache LRU; los fragmentos de la base se repiten
+  mucho entre consultas, así que casi nunca se vuelven a tokenizar
+- fit_sections: descarta las secciones de contexto marcadas (las últimas, que
+  son las menos relevantes) hasta que el prompt entra en el presupuesto
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+class PromptTooLong(Exception):
+    """El prompt no entra en el presupuesto ni sin secciones de contexto"""
+
+    def __init__(self, prompt_tokens: int, budget: int):
+        super().__init__(f"El prompt tiene {prompt_tokens} tokens y el presupuesto es {budget}")
+        self.prompt_tokens = prompt_tokens
+        self.budget = budget
+
+class TokenCounter:
+    def __init__(self, tokenizer, max_entries: int = 4096):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def encode(self, text: str, cache: bool = True) -> Tuple[int, ...]:
+        """Ids sin tokens especiales; cache=False para textos únicos (prompts completos)"""
+        if not cache:
+            return tuple(self.tokenizer.encode(text, add_special_tokens=False))
+        token_ids = self._entries.get(text)
+        if token_ids is not None:
+            self._entries.move_to_end(text)
+            self.stats["hits"] += 1
+            return token_ids
+        self.stats["misses"] += 1
+        token_ids = tuple(self.tokenizer.encode(text, add_special_tokens=False))
+        self._entries[text] = token_ids
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return token_ids
+
+    def count(self, text: str, cache: bool = True) -> int:
+        return len(self.encode(text, cache))
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+def fit_sections(counter: TokenCounter, render: Callable[[Dict[str, str]], str],
+                 sections: Dict[str, List[str]], budget: int, separator: str = "\n") -> Tuple[str, dict]:
+    """
+    render(variables) arma el prompt completo. Cada lista de `sections` viene
+    ordenada por relevancia; se conservan secciones en ese orden mientras
+    entren (una que no entra se saltea, puede entrar otra más corta) y el
+    resto se descarta. Retorna (prompt, reporte con prompt_tokens,
+    dropped_tokens y dropped_sections).
+    """
+    base_tokens = counter.count(render({name: "" for name in sections}), cache=False)
+    if base_tokens > budget:
+        raise PromptTooLong(base_tokens, budget)
+
+    available = budget - base_tokens
+    separator_tokens = counter.count(separator) if separator else 0
+    kept: Dict[str, List[str]] = {}
+    dropped: List[int] = []
+    for name, parts in sections.items():
+        kept[name] = []
+        for part in parts:
+            cost = counter.count(part) + separator_tokens
+            if cost <= available:
+                kept[name].append(part)
+                available -= cost
+            else:
+                dropped.append(cost - separator_tokens)
+
+    # La suma por sección es una aproximación (los bordes pueden tokenizar
+    # distinto): se verifica con el prompt real y se recorta si hace falta
+    while True:
+        prompt = render({name: separator.join(parts) for name, parts in kept.items()})
+        prompt_tokens = counter.count(prompt, cache=False)
+        if prompt_tokens <= budget:
+            break
+        name = next((n for n in reversed(list(kept)) if kept[n]), None)
+        if name is None:
+            raise PromptTooLong(prompt_tokens, budget)
+        dropped.append(counter.count(kept[name].pop()))
+
+    return prompt, {
+        "prompt_tokens": prompt_tokens,
+        "dropped_tokens": sum(dropped),
+        "dropped_sections": len(dropped)
+    }
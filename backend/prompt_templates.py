@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Plantillas de prompt del servidor para /chat y /chat_stream.
+
+El bloque de sistema (identidad + instrucciones) es fijo y va primero, así
+todas las solicitudes de una plantilla comparten el mismo prefijo byte a byte
+y el prefix cache de vLLM se saltea su prefill. Lo variable (contexto
+recuperado, historial y pregunta) va siempre después.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+IDENTITY = "Eres DptoFisicaUNSa, asistente oficial de la Universidad Nacional de Salta (UNSA)."
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    system: str                    # prefijo estático, no admite variables
+    question_label: str
+    context: Optional[str] = None  # bloque de contexto con {variables}, va en el último turno
+    request_class: str = "rag"     # clase de prioridad por defecto en el scheduler
+
+TEMPLATES: Dict[str, PromptTemplate] = {
+    "rag": PromptTemplate(
+        system=(
+            f"{IDENTITY}\n\n"
+            "INSTRUCCIONES:\n"
+            "1. Usa ÚNICAMENTE la información de la base de datos UNSA incluida en el mensaje\n"
+            "2. NO inventes información bajo ninguna circunstancia\n"
+            "3. Sé conciso y directo (3-4 oraciones máximo)\n"
+            "4. Si la información no contiene lo solicitado, di que no tienes esa información específica\n"
+            "5. Incluye URLs o contactos si están en la información\n"
+            "6. Responde en español claro y profesional"
+        ),
+        context="INFORMACIÓN DE LA BASE DE DATOS UNSA:\n{context}",
+        question_label="PREGUNTA DEL USUARIO"
+    ),
+    "explanatory": PromptTemplate(
+        system=(
+            f"{IDENTITY}\n\n"
+            "El usuario realiza una consulta explicativa u orientativa sobre carreras universitarias.\n\n"
+            "INSTRUCCIONES:\n"
+            "- Explicá brevemente de qué se trata cada carrera\n"
+            "- Indicá diferencias de enfoque si las hay (docencia, investigación, práctica)\n"
+            "- Orientá al estudiante según sus intereses\n"
+            "- No inventes información institucional específica\n"
+            "- Usá un tono claro y orientativo (máx. 6–8 oraciones)"
+        ),
+        context="CARRERAS RELACIONADAS:\n{careers}",
+        question_label="PREGUNTA DEL USUARIO"
+    )
+}
+
+class TemplateError(ValueError):
+    """Plantilla inexistente, variables faltantes o mensajes inválidos"""
+
+def render_messages(template_id: str, variables: Dict[str, str], messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Arma la conversación: sistema estático, historial, y el último turno del
+    usuario con el bloque de contexto antes de la pregunta.
+    """
+    template = TEMPLATES.get(template_id)
+    if template is None:
+        raise TemplateError(f"Plantilla desconocida: {template_id} (opciones: {', '.join(TEMPLATES)})")
+    if not messages or messages[-1].get("role") != "user":
+        raise TemplateError("El último mensaje debe ser del usuario")
+    for message in messages:
+        if message.get("role") not in ("user", "assistant"):
+            raise TemplateError(f"Rol no permitido: {message.get('role')}")
+
+    question = messages[-1]["content"].strip()
+    last_turn = f"{template.question_label}: {question}"
+    if template.context:
+        try:
+            context = template.context.format(**variables)
+        except KeyError as e:
+            raise TemplateError(f"Falta la variable {e} para la plantilla {template_id}")
+        last_turn = f"{context}\n\n{last_turn}"
+
+    return [
+        {"role": "system", "content": template.system},
+        *({"role": m["role"], "content": m["content"]} for m in messages[:-1]),
+        {"role": "user", "content": last_turn}
+    ]
+
+def render_chatml(messages: List[Dict[str, str]]) -> str:
+    """Formato ChatML (el de Qwen2), para tokenizadores sin chat template"""
+    turns = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return turns + "<|im_start|>assistant\n"
+
+def apply_chat_template(tokenizer, messages: List[Dict[str, str]]) -> str:
+    """Usa el chat template del modelo si el tokenizador lo tiene"""
+    if getattr(tokenizer, "chat_template", None) and hasattr(tokenizer, "apply_chat_template"):
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return render_chatml(messages)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Cache de respuestas y coalescencia de solicitudes idénticas en vuelo
+- ResponseCache: LRU acotado con TTL para respuestas completas
+- SingleFlight: solicitudes idénticas concurrentes comparten una sola generación
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+def make_cache_key(prompt: str, params: dict) -> str:
+    """Hash estable de (prompt, parámetros de muestreo)"""
+    payload = json.dumps({"prompt": prompt, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """LRU con expiración por TTL; O(1) por operación"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    La primera solicitud con una clave lanza la generación como tarea propia;
+    las idénticas que llegan mientras tanto esperan esa misma tarea. La tarea
+    solo se cancela (y se aborta en el motor) cuando ya no queda nadie esperando,
+    así la desconexión del primer cliente no deja sin respuesta a los demás.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "cancelled": 0}
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Retorna (resultado, compartido) donde compartido indica que se reutilizó otra generación"""
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _task, k=key, f=flight: self._forget(k, f))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["coalesced"] += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self.stats["cancelled"] += 1
+                flight.task.cancel()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight": len(self._flights)}
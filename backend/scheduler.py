@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Scheduler de admisión delante del motor de inferencia
+- Clases de prioridad: interactive (saludos, respuestas directas) > rag > batch
+- Dentro de cada clase, cola justa por user_id (round-robin entre usuarios)
+- Rechazo anticipado cuando la espera estimada supera lo que el cliente va a esperar
+- Lugares reservados: una clase (batch) solo usa la capacidad que sobra
+- Cola propia para las clases con tope (batch): no ocupan el lugar de las demás en max_queue
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+# Orden = prioridad (el primero se despacha antes)
+PRIORITY_CLASSES = ("interactive", "rag", "batch")
+
+class AdmissionRejected(Exception):
+    """Solicitud rechazada sin encolar; retry_after es la sugerencia para el cliente"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class Ticket:
+    __slots__ = ("user_id", "request_class", "enqueued_at", "admitted_at", "released", "future")
+
+    def __init__(self, user_id: str, request_class: str):
+        self.user_id = user_id
+        self.request_class = request_class
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.released = False
+        self.future: Optional[asyncio.Future] = None
+
+    @property
+    def queue_wait(self) -> float:
+        return (self.admitted_at or time.monotonic()) - self.enqueued_at
+
+class AdmissionScheduler:
+    """
+    Limita las solicitudes en el motor a `limit` y decide quién entra cuando se
+    libera un lugar. Cada clase tiene un OrderedDict user_id -> deque de tickets;
+    se atiende al primer usuario y se lo mueve al final, así un usuario muy
+    activo no puede acaparar la cola. Un ticket de menor prioridad que lleva
+    más de `max_priority_wait` esperando pasa adelante para evitar inanición.
+    `reserved_slots[clase]` lugares quedan fuera del alcance de esa clase,
+    así un lote grande nunca ocupa todo el motor (con el motor vacío siempre
+    puede entrar al menos una). Las clases de `class_queue_limits` esperan en
+    una cola con su propio tope y no cuentan para `max_queue`: los lotes no
+    pueden dejar sin cola al tráfico interactivo.
+    """
+
+    def __init__(self, limit: int, max_queue: int, max_priority_wait: float = 10.0,
+                 initial_service_time: float = 5.0, reserved_slots: Optional[Dict[str, int]] = None,
+                 class_queue_limits: Optional[Dict[str, int]] = None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_priority_wait = max_priority_wait
+        self.reserved_slots = reserved_slots or {}
+        self.class_queue_limits = class_queue_limits or {}
+        self.in_flight = 0
+        self._queues: Dict[str, "OrderedDict[str, deque]"] = {c: OrderedDict() for c in PRIORITY_CLASSES}
+        self._queued = {c: 0 for c in PRIORITY_CLASSES}
+        # Media móvil exponencial del tiempo de servicio, para estimar la espera
+        self._service_time = initial_service_time
+        self.stats = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_estimated_wait": 0,
+            "queue_timeouts": 0,
+            "admitted_by_class": {c: 0 for c in PRIORITY_CLASSES}
+        }
+
+    @property
+    def queued(self) -> int:
+        return sum(self._queued.values())
+
+    def _queue_full(self, request_class: str) -> bool:
+        if request_class in self.class_queue_limits:
+            return self._queued[request_class] >= self.class_queue_limits[request_class]
+        shared = sum(n for c, n in self._queued.items() if c not in self.class_queue_limits)
+        return shared >= self.max_queue
+
+    def _class_limit(self, request_class: str) -> int:
+        return max(1, self.limit - self.reserved_slots.get(request_class, 0))
+
+    def estimated_wait(self, request_class: str) -> float:
+        """Espera estimada para una solicitud nueva de esta clase"""
+        rank = PRIORITY_CLASSES.index(request_class)
+        ahead = sum(self._queued[c] for c in PRIORITY_CLASSES[:rank + 1])
+        class_limit = self._class_limit(request_class)
+        excess = self.in_flight + ahead + 1 - class_limit
+        if excess <= 0:
+            return 0.0
+        return math.ceil(excess / class_limit) * self._service_time
+
+    async def acquire(self, user_id: str, request_class: str, timeout: float) -> Ticket:
+        """Espera un lugar en el motor; AdmissionRejected o asyncio.TimeoutError si no llega a tiempo"""
+        ticket = Ticket(user_id, request_class)
+        if self.in_flight < self._class_limit(request_class) and self.queued == 0:
+            self._admit(ticket)
+            return ticket
+
+        estimated = self.estimated_wait(request_class)
+        if self._queue_full(request_class):
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected("queue_full", max(1.0, estimated))
+        if estimated > timeout:
+            self.stats["rejected_estimated_wait"] += 1
+            raise AdmissionRejected("estimated_wait", estimated)
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        self._queues[request_class].setdefault(user_id, deque()).append(ticket)
+        self._queued[request_class] += 1
+        # Puede haber lugar libre reservado para esta clase aunque otras esperen
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+            return ticket
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Se admitió justo al vencer el plazo: devolver el lugar
+                self.release(ticket)
+            else:
+                ticket.future.cancel()
+                self._remove(ticket)
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["queue_timeouts"] += 1
+            raise
+
+    def release(self, ticket: Ticket):
+        if ticket.admitted_at is None or ticket.released:
+            return
+        ticket.released = True
+        service_time = time.monotonic() - ticket.admitted_at
+        self._service_time = 0.9 * self._service_time + 0.1 * service_time
+        self.in_flight -= 1
+        self._dispatch()
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        self._dispatch()
+
+    def _admit(self, ticket: Ticket):
+        ticket.admitted_at = time.monotonic()
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+        self.stats["admitted_by_class"][ticket.request_class] += 1
+
+    def _remove(self, ticket: Ticket):
+        users = self._queues[ticket.request_class]
+        pending = users.get(ticket.user_id)
+        if pending and ticket in pending:
+            pending.remove(ticket)
+            self._queued[ticket.request_class] -= 1
+            if not pending:
+                del users[ticket.user_id]
+
+    def _next_class(self) -> Optional[str]:
+        now = time.monotonic()
+        starving = None
+        for request_class in PRIORITY_CLASSES[1:]:
+            users = self._queues[request_class]
+            if users and self.in_flight < self._class_limit(request_class):
+                head = next(iter(users.values()))[0]
+                if now - head.enqueued_at > self.max_priority_wait:
+                    if starving is None or head.enqueued_at < starving[1]:
+                        starving = (request_class, head.enqueued_at)
+        if starving:
+            return starving[0]
+        for request_class in PRIORITY_CLASSES:
+            if self._queues[request_class] and self.in_flight < self._class_limit(request_class):
+                return request_class
+        return None
+
+    def _dispatch(self):
+        while self.in_flight < self.limit:
+            request_class = self._next_class()
+            if request_class is None:
+                return
+            users = self._queues[request_class]
+            user_id, pending = next(iter(users.items()))
+            ticket = pending.popleft()
+            self._queued[request_class] -= 1
+            if pending:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if ticket.future.done():
+                continue
+            self._admit(ticket)
+            ticket.future.set_result(True)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "limit": self.limit,
+            "queued": self.queued,
+            "queued_by_class": dict(self._queued),
+            "reserved_slots": dict(self.reserved_slots),
+            "max_queue": self.max_queue,
+            "class_queue_limits": dict(self.class_queue_limits),
+            "service_time_ewma": round(self._service_time, 3)
+        }
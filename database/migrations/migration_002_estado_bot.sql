@@ -0,0 +1,116 @@
+-- ====================================================
+-- MIGRACIÓN 002: Estado compartido del bot (STATE_BACKEND=postgres)
+-- ====================================================
+-- Rate limit, anti-spam, usuarios activos y resultados previos de cada
+-- usuario, compartidos entre todos los procesos del bot. Las tablas son
+-- UNLOGGED: no escriben WAL (mucho más baratas de actualizar) y se vacían
+-- si PostgreSQL se cae, lo que para este estado efímero está bien.
+
+SET search_path TO unsa_esquema;
+
+-- Estado genérico por (espacio, clave) con vencimiento
+CREATE UNLOGGED TABLE IF NOT EXISTS bot_estado (
+    espacio TEXT NOT NULL,
+    clave TEXT NOT NULL,
+    valor JSONB NOT NULL,
+    vence TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (espacio, clave)
+);
+
+CREATE INDEX IF NOT EXISTS idx_bot_estado_vence ON bot_estado(vence);
+
+-- Ventana deslizante del rate limit y último mensaje (anti-spam) por usuario
+CREATE UNLOGGED TABLE IF NOT EXISTS bot_limites (
+    usuario TEXT PRIMARY KEY,
+    solicitudes DOUBLE PRECISION[] NOT NULL DEFAULT '{}',  -- epoch de cada solicitud en la ventana
+    ultimo DOUBLE PRECISION NOT NULL DEFAULT 0,            -- epoch del último mensaje atendido
+    vence TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_bot_limites_vence ON bot_limites(vence);
+
+-- Contador de mensajes repartido en 16 filas para que los procesos no
+-- compitan por el lock de una sola
+CREATE UNLOGGED TABLE IF NOT EXISTS bot_contadores (
+    nombre TEXT NOT NULL,
+    particion SMALLINT NOT NULL,
+    valor BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (nombre, particion)
+);
+
+-- Todo el control de un mensaje entrante en una sola ida y vuelta:
+-- rate limit, anti-spam, usuario activo y contador de mensajes.
+-- Devuelve 'ok', 'limit' (excedió el rate limit) o 'spam' (muy seguido).
+-- La hora es la del servidor de base de datos: igual para todos los hosts.
+CREATE OR REPLACE FUNCTION bot_admitir_mensaje(
+    p_usuario TEXT,
+    p_hash TEXT,
+    p_ventana DOUBLE PRECISION,
+    p_max INTEGER,
+    p_intervalo DOUBLE PRECISION,
+    p_ttl_activo DOUBLE PRECISION
+) RETURNS TEXT AS $$
+DECLARE
+    v_ahora DOUBLE PRECISION := extract(epoch FROM clock_timestamp());
+    v_solicitudes DOUBLE PRECISION[];
+    v_ultimo DOUBLE PRECISION;
+BEGIN
+    INSERT INTO bot_limites (usuario, vence)
+    VALUES (p_usuario, clock_timestamp())
+    ON CONFLICT (usuario) DO NOTHING;
+
+    -- El lock de la fila serializa los mensajes del mismo usuario entre procesos
+    SELECT ARRAY(SELECT t FROM unnest(l.solicitudes) AS t WHERE t > v_ahora - p_ventana), l.ultimo
+    INTO v_solicitudes, v_ultimo
+    FROM bot_limites l
+    WHERE l.usuario = p_usuario
+    FOR UPDATE;
+
+    IF cardinality(v_solicitudes) >= p_max THEN
+        UPDATE bot_limites
+        SET solicitudes = v_solicitudes,
+            vence = to_timestamp(v_ahora + GREATEST(p_ventana, p_intervalo))
+        WHERE usuario = p_usuario;
+        RETURN 'limit';
+    END IF;
+
+    -- Como antes, un mensaje descartado por spam también cuenta para el rate limit
+    IF v_ahora - v_ultimo < p_intervalo THEN
+        UPDATE bot_limites
+        SET solicitudes = v_solicitudes || v_ahora,
+            vence = to_timestamp(v_ahora + GREATEST(p_ventana, p_intervalo))
+        WHERE usuario = p_usuario;
+        RETURN 'spam';
+    END IF;
+
+    UPDATE bot_limites
+    SET solicitudes = v_solicitudes || v_ahora,
+        ultimo = v_ahora,
+        vence = to_timestamp(v_ahora + GREATEST(p_ventana, p_intervalo))
+    WHERE usuario = p_usuario;
+
+    INSERT INTO bot_estado (espacio, clave, valor, vence)
+    VALUES ('active_users', p_hash, '1', to_timestamp(v_ahora + p_ttl_activo))
+    ON CONFLICT (espacio, clave) DO UPDATE SET vence = EXCLUDED.vence;
+
+    INSERT INTO bot_contadores (nombre, particion, valor)
+    VALUES ('messages', pg_backend_pid() % 16, 1)
+    ON CONFLICT (nombre, particion) DO UPDATE SET valor = bot_contadores.valor + 1;
+
+    RETURN 'ok';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Limpieza de vencidos (la llama cada proceso del bot periódicamente)
+CREATE OR REPLACE FUNCTION bot_limpiar_estado() RETURNS INTEGER AS $$
+DECLARE
+    v_borrados INTEGER;
+    v_limites INTEGER;
+BEGIN
+    DELETE FROM bot_estado WHERE vence <= clock_timestamp();
+    GET DIAGNOSTICS v_borrados = ROW_COUNT;
+    DELETE FROM bot_limites WHERE vence <= clock_timestamp();
+    GET DIAGNOSTICS v_limites = ROW_COUNT;
+    RETURN v_borrados + v_limites;
+END;
+$$ LANGUAGE plpgsql;
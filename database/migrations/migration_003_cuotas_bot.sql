@@ -0,0 +1,152 @@
+-- ====================================================
+-- MIGRACIÓN 003: Cuotas del bot con token buckets
+-- ====================================================
+-- Reemplaza la ventana deslizante de bot_limites (un arreglo con la hora de
+-- cada solicitud, que se reescribía completo en cada mensaje) por token
+-- buckets de tamaño fijo: (fichas, actualizado) por clave. Los niveles
+-- (global, por usuario, IA por usuario, IA global) son claves distintas.
+
+SET search_path TO unsa_esquema;
+
+CREATE UNLOGGED TABLE IF NOT EXISTS bot_fichas (
+    clave TEXT PRIMARY KEY,
+    fichas DOUBLE PRECISION NOT NULL,
+    actualizado DOUBLE PRECISION NOT NULL,  -- epoch
+    vence TIMESTAMPTZ NOT NULL              -- cuando el bucket se habría llenado: ya no hace falta guardarlo
+);
+
+CREATE INDEX IF NOT EXISTS idx_bot_fichas_vence ON bot_fichas(vence);
+
+-- Consume p_costos[i] de cada bucket, de todos o de ninguno.
+-- niveles: fichas de cada bucket después de la operación; espera: segundos
+-- hasta que alcance (0 si se permitió). p_simular: solo consulta.
+CREATE OR REPLACE FUNCTION bot_tomar_fichas(
+    p_claves TEXT[],
+    p_tasas DOUBLE PRECISION[],
+    p_rafagas DOUBLE PRECISION[],
+    p_costos DOUBLE PRECISION[],
+    p_simular BOOLEAN DEFAULT FALSE
+) RETURNS TABLE (permitido BOOLEAN, niveles DOUBLE PRECISION[], espera DOUBLE PRECISION) AS $$
+DECLARE
+    v_ahora DOUBLE PRECISION := extract(epoch FROM clock_timestamp());
+    v_fichas DOUBLE PRECISION;
+    v_fila RECORD;
+    i INTEGER;
+BEGIN
+    niveles := '{}';
+    espera := 0;
+
+    IF NOT p_simular THEN
+        -- Buckets nuevos llenos; bloqueo en orden de clave para que dos
+        -- procesos con las mismas claves no se traben entre sí
+        INSERT INTO bot_fichas (clave, fichas, actualizado, vence)
+        SELECT t.clave, t.rafaga, v_ahora, clock_timestamp()
+        FROM unnest(p_claves, p_rafagas) AS t(clave, rafaga)
+        ORDER BY t.clave
+        ON CONFLICT (clave) DO NOTHING;
+
+        PERFORM 1 FROM bot_fichas f WHERE f.clave = ANY(p_claves) ORDER BY f.clave FOR UPDATE;
+    END IF;
+
+    FOR i IN 1 .. cardinality(p_claves) LOOP
+        SELECT f.fichas, f.actualizado INTO v_fila FROM bot_fichas f WHERE f.clave = p_claves[i];
+        IF FOUND THEN
+            v_fichas := LEAST(p_rafagas[i], v_fila.fichas + (v_ahora - v_fila.actualizado) * p_tasas[i]);
+        ELSE
+            v_fichas := p_rafagas[i];
+        END IF;
+        niveles := niveles || v_fichas;
+        IF v_fichas < p_costos[i] THEN
+            espera := GREATEST(espera, (p_costos[i] - v_fichas) / p_tasas[i]);
+        END IF;
+    END LOOP;
+
+    permitido := espera = 0;
+    IF permitido AND NOT p_simular THEN
+        FOR i IN 1 .. cardinality(p_claves) LOOP
+            niveles[i] := niveles[i] - p_costos[i];
+            UPDATE bot_fichas f
+            SET fichas = niveles[i],
+                actualizado = v_ahora,
+                vence = to_timestamp(v_ahora + (p_rafagas[i] - niveles[i]) / p_tasas[i])
+            WHERE f.clave = p_claves[i];
+        END LOOP;
+    END IF;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+-- El control de un mensaje entrante pasa a usar los buckets
+DROP FUNCTION IF EXISTS bot_admitir_mensaje(TEXT, TEXT, DOUBLE PRECISION, INTEGER, DOUBLE PRECISION, DOUBLE PRECISION);
+ALTER TABLE bot_limites DROP COLUMN IF EXISTS solicitudes;
+
+-- Anti-spam, cuotas, usuario activo y contador en una sola ida y vuelta.
+-- resultado: 'ok', 'limit' (sin cuota) o 'spam' (muy seguido).
+CREATE OR REPLACE FUNCTION bot_admitir_mensaje(
+    p_usuario TEXT,
+    p_intervalo DOUBLE PRECISION,
+    p_ttl_activo DOUBLE PRECISION,
+    p_claves TEXT[],
+    p_tasas DOUBLE PRECISION[],
+    p_rafagas DOUBLE PRECISION[],
+    p_costos DOUBLE PRECISION[]
+) RETURNS TABLE (resultado TEXT, espera DOUBLE PRECISION) AS $$
+DECLARE
+    v_ahora DOUBLE PRECISION := extract(epoch FROM clock_timestamp());
+    v_ultimo DOUBLE PRECISION;
+    v_permitido BOOLEAN;
+BEGIN
+    INSERT INTO bot_limites (usuario, vence)
+    VALUES (p_usuario, clock_timestamp())
+    ON CONFLICT (usuario) DO NOTHING;
+
+    SELECT l.ultimo INTO v_ultimo FROM bot_limites l WHERE l.usuario = p_usuario FOR UPDATE;
+    IF v_ahora - v_ultimo < p_intervalo THEN
+        resultado := 'spam';
+        espera := p_intervalo - (v_ahora - v_ultimo);
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    -- También si lo frena la cuota: así insistir no genera un aviso por mensaje
+    UPDATE bot_limites
+    SET ultimo = v_ahora,
+        vence = to_timestamp(v_ahora + p_intervalo)
+    WHERE usuario = p_usuario;
+
+    SELECT t.permitido, t.espera INTO v_permitido, espera
+    FROM bot_tomar_fichas(p_claves, p_tasas, p_rafagas, p_costos) AS t;
+    IF NOT v_permitido THEN
+        resultado := 'limit';
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    INSERT INTO bot_estado (espacio, clave, valor, vence)
+    VALUES ('active_users', p_usuario, '1', to_timestamp(v_ahora + p_ttl_activo))
+    ON CONFLICT (espacio, clave) DO UPDATE SET vence = EXCLUDED.vence;
+
+    INSERT INTO bot_contadores (nombre, particion, valor)
+    VALUES ('messages', pg_backend_pid() % 16, 1)
+    ON CONFLICT (nombre, particion) DO UPDATE SET valor = bot_contadores.valor + 1;
+
+    resultado := 'ok';
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bot_limpiar_estado() RETURNS INTEGER AS $$
+DECLARE
+    v_borrados INTEGER;
+    v_limites INTEGER;
+    v_fichas INTEGER;
+BEGIN
+    DELETE FROM bot_estado WHERE vence <= clock_timestamp();
+    GET DIAGNOSTICS v_borrados = ROW_COUNT;
+    DELETE FROM bot_limites WHERE vence <= clock_timestamp();
+    GET DIAGNOSTICS v_limites = ROW_COUNT;
+    DELETE FROM bot_fichas WHERE vence <= clock_timestamp();
+    GET DIAGNOSTICS v_fichas = ROW_COUNT;
+    RETURN v_borrados + v_limites + v_fichas;
+END;
+$$ LANGUAGE plpgsql;
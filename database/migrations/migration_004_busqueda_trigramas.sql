@@ -0,0 +1,49 @@
+-- ====================================================
+-- MIGRACIÓN 004: Búsqueda por trigramas indexada, sin acentos
+-- ====================================================
+-- unaccent() no es IMMUTABLE, así que similarity(unaccent(contenido), ...) e
+-- ILIKE sobre unaccent no pueden usar índices: cada mensaje recorría la tabla
+-- entera. Se guardan columnas normalizadas (minúsculas y sin acentos) que un
+-- trigger mantiene al escribir, con índices GIN gin_trgm_ops que sirven a
+-- LIKE '%término%' y al operador % (similarity >= pg_trgm.similarity_threshold).
+--
+-- Los CREATE INDEX CONCURRENTLY no corren dentro de una transacción: aplicar
+-- con psql sin -1 / --single-transaction. No bloquean las escrituras mientras
+-- se construyen; si uno falla queda INVALID y hay que borrarlo y repetir.
+
+SET search_path TO unsa_esquema, public;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+ALTER TABLE fragmentos_conocimiento ADD COLUMN IF NOT EXISTS contenido_norm TEXT;
+ALTER TABLE fragmentos_conocimiento ADD COLUMN IF NOT EXISTS descripcion_norm TEXT;
+
+-- Misma normalización que hace el retriever con los términos de la consulta
+CREATE OR REPLACE FUNCTION fragmentos_normalizar() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.contenido_norm := lower(unaccent(NEW.contenido));
+    NEW.descripcion_norm := lower(unaccent(NEW.descripcion));
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_fragmentos_normalizar ON fragmentos_conocimiento;
+CREATE TRIGGER trigger_fragmentos_normalizar
+BEFORE INSERT OR UPDATE OF contenido, descripcion ON fragmentos_conocimiento
+FOR EACH ROW
+EXECUTE FUNCTION fragmentos_normalizar();
+
+-- Filas existentes (el trigger solo corre en escrituras nuevas)
+UPDATE fragmentos_conocimiento
+SET contenido_norm = lower(unaccent(contenido)),
+    descripcion_norm = lower(unaccent(descripcion))
+WHERE contenido_norm IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fragmentos_contenido_norm_trgm
+ON fragmentos_conocimiento USING GIN (contenido_norm gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fragmentos_descripcion_norm_trgm
+ON fragmentos_conocimiento USING GIN (descripcion_norm gin_trgm_ops);
+
+ANALYZE fragmentos_conocimiento;
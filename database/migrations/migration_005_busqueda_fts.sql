@@ -0,0 +1,70 @@
+-- ====================================================
+-- MIGRACIÓN 005: Búsqueda de texto completo en español
+-- ====================================================
+-- Columna contenido_tsvector con pesos, mantenida por el mismo trigger que
+-- las columnas normalizadas de la migración 004:
+--   A: nombre del fragmento (la primera oración: "Licenciatura en Física")
+--   B: palabras clave
+--   C: contenido completo
+--   D: descripción
+-- El retriever la consulta con websearch_to_tsquery('spanish', ...) y ordena
+-- por ts_rank_cd; si no hay coincidencias vuelve a los trigramas.
+--
+-- La columna ya existía desde la 001 (sin pesos, la llenaba
+-- trigger_actualizar_tsvector en cada UPDATE): esa función deja de tocarla y
+-- se recalculan todas las filas.
+--
+-- Igual que en la 004, el CREATE INDEX CONCURRENTLY no corre dentro de una
+-- transacción: aplicar con psql sin -1 / --single-transaction.
+
+SET search_path TO unsa_esquema, public;
+
+ALTER TABLE fragmentos_conocimiento ADD COLUMN IF NOT EXISTS contenido_tsvector TSVECTOR;
+
+-- Sin acentos, como los términos que arma el retriever
+CREATE OR REPLACE FUNCTION fragmentos_tsvector(
+    p_contenido TEXT,
+    p_descripcion TEXT,
+    p_palabras_clave VARCHAR[]
+) RETURNS TSVECTOR AS $$
+    SELECT setweight(to_tsvector('spanish', unaccent(split_part(p_contenido, '.', 1))), 'A')
+        || setweight(to_tsvector('spanish', unaccent(coalesce(array_to_string(p_palabras_clave, ' '), ''))), 'B')
+        || setweight(to_tsvector('spanish', unaccent(p_contenido)), 'C')
+        || setweight(to_tsvector('spanish', unaccent(coalesce(p_descripcion, ''))), 'D');
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION fragmentos_normalizar() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.contenido_norm := lower(unaccent(NEW.contenido));
+    NEW.descripcion_norm := lower(unaccent(NEW.descripcion));
+    NEW.contenido_tsvector := fragmentos_tsvector(NEW.contenido, NEW.descripcion, NEW.palabras_clave);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- El trigger de la 001 corre en todo UPDATE (también los de usado_count) y
+-- pisaría el tsvector con pesos: queda solo para la fecha de actualización
+CREATE OR REPLACE FUNCTION actualizar_tsvector() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.fecha_actualizacion = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Ahora también depende de las palabras clave
+DROP TRIGGER IF EXISTS trigger_fragmentos_normalizar ON fragmentos_conocimiento;
+CREATE TRIGGER trigger_fragmentos_normalizar
+BEFORE INSERT OR UPDATE OF contenido, descripcion, palabras_clave ON fragmentos_conocimiento
+FOR EACH ROW
+EXECUTE FUNCTION fragmentos_normalizar();
+
+-- Todas las filas existentes: las que ya tenían tsvector lo tenían sin pesos
+UPDATE fragmentos_conocimiento
+SET contenido_tsvector = fragmentos_tsvector(contenido, descripcion, palabras_clave);
+
+-- El esquema de diseño (schema/indexes.sql) usa este nombre sobre otra expresión
+DROP INDEX CONCURRENTLY IF EXISTS idx_fragmentos_contenido_fts;
+CREATE INDEX CONCURRENTLY idx_fragmentos_contenido_fts
+ON fragmentos_conocimiento USING GIN (contenido_tsvector);
+
+ANALYZE fragmentos_conocimiento;
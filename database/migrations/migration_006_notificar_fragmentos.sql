@@ -0,0 +1,37 @@
+-- ====================================================
+-- MIGRACIÓN 006: Avisos de cambios en fragmentos_conocimiento
+-- ====================================================
+-- Con RETRIEVER_BACKEND=memory cada proceso del bot tiene los fragmentos en
+-- un índice en memoria y escucha el canal fragmentos_cambios (LISTEN). Cada
+-- alta, baja o cambio de contenido avisa el id; el bot relee solo esa fila.
+-- Los UPDATE de usado_count (contadores de uso) no avisan: no cambian lo
+-- que se busca. Un TRUNCATE avisa sin id y el bot recarga todo.
+
+SET search_path TO unsa_esquema, public;
+
+CREATE OR REPLACE FUNCTION fragmentos_notificar() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN
+        PERFORM pg_notify('fragmentos_cambios', json_build_object('op', TG_OP)::text);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('fragmentos_cambios', json_build_object('op', TG_OP, 'id', OLD.id)::text);
+    ELSE
+        PERFORM pg_notify('fragmentos_cambios', json_build_object('op', TG_OP, 'id', NEW.id)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_fragmentos_notificar ON fragmentos_conocimiento;
+CREATE TRIGGER trigger_fragmentos_notificar
+AFTER INSERT OR DELETE
+OR UPDATE OF contenido, categoria, facultad, palabras_clave, descripcion, relevancia
+ON fragmentos_conocimiento
+FOR EACH ROW
+EXECUTE FUNCTION fragmentos_notificar();
+
+DROP TRIGGER IF EXISTS trigger_fragmentos_notificar_truncate ON fragmentos_conocimiento;
+CREATE TRIGGER trigger_fragmentos_notificar_truncate
+AFTER TRUNCATE ON fragmentos_conocimiento
+FOR EACH STATEMENT
+EXECUTE FUNCTION fragmentos_notificar();
@@ -0,0 +1,483 @@
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+
+from .config import logger
+from .inference_router import Backend, InferenceRouter
+
+# El servidor de inferencia aborta en vLLM lo que no alcance a llegar antes de este plazo
+DEADLINE_HEADER = "X-Request-Timeout"
+CHAT_PATH = "/chat"
+CHAT_STREAM_PATH = "/chat_stream"
+# Errores que indican una réplica rota (no saturada): cuentan para sacarla de rotación
+BACKEND_FAILURE_STATUSES = {500, 502}
+# Con menos tiempo que esto no vale la pena otro intento
+MIN_ATTEMPT_TIME = 1.0
+
+class Saturated(Exception):
+    """La réplica respondió 503: está saturada y pidió esperar retry_after segundos"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"saturado, Retry-After {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class AttemptFailed(Exception):
+    """Error de conexión, timeout o 5xx: se puede reintentar en otra réplica"""
+
+class RequestRejected(Exception):
+    """4xx: la solicitud es inválida para el servidor, reintentar no sirve"""
+
+def _parse_retry_after(value: Optional[str], default: float = 5.0) -> float:
+    try:
+        return max(1.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+class CircuitBreaker:
+    """
+    Breaker por réplica.
+    - closed: pasa todo; abre si en la ventana reciente falla al menos
+      `failure_ratio` de las llamadas (con un mínimo de `min_calls`)
+    - open: no se le manda nada hasta `open_until`. Un 503 lo abre en el acto
+      por lo que diga Retry-After, así el bot responde desde la base en vez de
+      sumar carga a un servidor saturado
+    - half_open: deja pasar una sola solicitud de prueba; si sale bien cierra
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_ratio: float = 0.5, window: int = 20,
+                 min_calls: int = 5, open_seconds: float = 15.0):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.open_until = 0.0
+        self._results = deque(maxlen=window)
+        self._probe_in_flight = False
+        self.stats = {"opened": 0, "saturated": 0, "successes": 0, "failures": 0}
+
+    def available(self) -> bool:
+        """Sin efectos: ¿se le puede mandar una solicitud ahora?"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.open_until
+        return not self._probe_in_flight
+
+    def acquire(self):
+        """Marca el inicio de una llamada (en half_open es la única de prueba)"""
+        if self.state == self.OPEN and time.monotonic() >= self.open_until:
+            self.state = self.HALF_OPEN
+            logger.info("🟡 Breaker %s en half-open, probando", self.name)
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self.stats["successes"] += 1
+        self._results.append(True)
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            self._probe_in_flight = False
+            self._results.clear()
+            logger.info("🟢 Breaker %s cerrado", self.name)
+
+    def record_failure(self):
+        self.stats["failures"] += 1
+        self._results.append(False)
+        if self.state == self.HALF_OPEN:
+            self._open(self.open_seconds, "falló la solicitud de prueba")
+            return
+        failures = self._results.count(False)
+        if len(self._results) >= self.min_calls and failures / len(self._results) >= self.failure_ratio:
+            self._open(self.open_seconds, f"{failures}/{len(self._results)} fallas recientes")
+
+    def record_saturated(self, retry_after: float):
+        self.stats["saturated"] += 1
+        self._open(retry_after, "servidor saturado (503)")
+
+    def record_cancelled(self):
+        """Llamada cancelada (p. ej. la que perdió un hedge): no es éxito ni falla"""
+        self._probe_in_flight = False
+
+    def _open(self, seconds: float, reason: str):
+        was_open = self.state == self.OPEN
+        self.state = self.OPEN
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+        self._probe_in_flight = False
+        self._results.clear()
+        if not was_open:
+            self.stats["opened"] += 1
+            logger.warning("🔴 Breaker %s abierto por %.0fs: %s", self.name, seconds, reason)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "state": self.state if self.state != self.OPEN or not self.available() else self.HALF_OPEN,
+            "open_for": max(0.0, round(self.open_until - time.monotonic(), 1)) if self.state == self.OPEN else 0.0
+        }
+
+class InferenceClient:
+    """
+    Cliente HTTP del bot hacia el servidor de inferencia.
+
+    Cada llamada tiene un único deadline total (REQUEST_TIMEOUT) que se reparte
+    entre intentos y se le pasa al servidor. Los reintentos van a otra réplica
+    con backoff exponencial con jitter; un 503 no se reintenta contra la misma
+    réplica (su breaker queda abierto por el Retry-After). Opcionalmente, los
+    prompts cortos se cubren con un hedge: si la primera réplica no respondió
+    en `hedge_delay`, se manda la misma solicitud a otra y gana la primera.
+    """
+
+    def __init__(self, router: InferenceRouter, request_timeout: float, max_attempts: int = 3,
+                 backoff_base: float = 0.5, connector_limit_per_host: int = 64,
+                 keepalive_timeout: float = 60.0, hedge_enabled: bool = False,
+                 hedge_delay: float = 1.0, hedge_max_chars: int = 300,
+                 breaker_options: Optional[dict] = None):
+        self.router = router
+        self.request_timeout = request_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.connector_limit_per_host = connector_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.hedge_enabled = hedge_enabled
+        self.hedge_delay = hedge_delay
+        self.hedge_max_chars = hedge_max_chars
+        self.breaker_options = breaker_options or {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.stats = {
+            "calls": 0, "answered": 0, "unanswered": 0, "retries": 0,
+            "short_circuited": 0, "hedges": 0, "hedges_won": 0
+        }
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            # Conexiones reutilizables hasta lo que el servidor acepta (en motor + en cola).
+            # El keep-alive es menor que el del servidor para que el cierre lo inicie el
+            # cliente y no se reuse una conexión que el servidor acaba de cerrar.
+            connector = aiohttp.TCPConnector(
+                limit=self.connector_limit_per_host * max(1, len(self.router.backends)),
+                limit_per_host=self.connector_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout, connect=5)
+            )
+            logger.info("✅ Sesión HTTP de inferencia inicializada")
+        await self.router.start()
+
+    async def close(self):
+        await self.router.stop()
+        if self.session and not self.session.closed:
+            try:
+                await self.session.close()
+                logger.info("✅ Sesión HTTP cerrada")
+            except Exception as e:
+                logger.error("❌ Error al cerrar sesión HTTP: %s", str(e))
+
+    # ---------- Selección de réplica ----------
+    def breaker(self, backend: Backend) -> CircuitBreaker:
+        breaker = self.breakers.get(backend.base_url)
+        if breaker is None:
+            breaker = self.breakers[backend.base_url] = CircuitBreaker(backend.name, **self.breaker_options)
+        return breaker
+
+    def available(self) -> bool:
+        """¿Hay alguna réplica sana con el breaker cerrado (o lista para probar)?"""
+        now = time.monotonic()
+        return any(
+            b.healthy and b.ejected_until <= now and self.breaker(b).available()
+            for b in self.router.backends
+        )
+
+    def peek(self, user_hash: str) -> Optional[Backend]:
+        """Réplica que atendería ahora al usuario, sin registrar nada"""
+        return self._pick(user_hash, [])
+
+    def _pick(self, user_hash: str, failed: List[Backend], allow_failed: bool = True) -> Optional[Backend]:
+        blocked = [b for b in self.router.backends if not self.breaker(b).available()]
+        backend = self.router.pick(user_hash, exclude=blocked + failed)
+        if backend is None and allow_failed:
+            backend = self.router.pick(user_hash, exclude=blocked)
+        return backend
+
+    def _is_short(self, payload: dict) -> bool:
+        size = sum(len(m.get("content", "")) for m in payload.get("messages", []))
+        size += sum(len(v) for v in payload.get("variables", {}).values())
+        size += sum(len(part) for parts in payload.get("sections", {}).values() for part in parts)
+        return size <= self.hedge_max_chars
+
+    # ---------- Llamada completa ----------
+    def new_deadline(self) -> float:
+        """Deadline total de una respuesta (reloj monotónico), compartido por stream y complete"""
+        return time.monotonic() + self.request_timeout
+
+    async def complete(self, payload: dict, user_hash: str, deadline: Optional[float] = None,
+                       fallback: bool = False) -> str:
+        """
+        Respuesta del LLM, o "" si no llegó dentro del deadline (el bot responde desde la base).
+        deadline: el de un stream que falló antes, para no volver a empezar el plazo.
+        fallback: reintento de un stream sin respuesta; la llamada ya la contó stream().
+        """
+        if not fallback:
+            self.stats["calls"] += 1
+        deadline = deadline if deadline is not None else self.new_deadline()
+        failed: List[Backend] = []
+        hedge = self.hedge_enabled and self._is_short(payload)
+
+        for attempt in range(self.max_attempts):
+            if deadline - time.monotonic() < MIN_ATTEMPT_TIME:
+                break
+            backend = self._pick(user_hash, failed)
+            if backend is None:
+                self.stats["short_circuited"] += 1
+                logger.warning(f"Sin réplicas de IA disponibles para usuario {user_hash} (breakers abiertos)")
+                break
+            if attempt:
+                self.stats["retries"] += 1
+
+            try:
+                if hedge:
+                    answer = await self._hedged(backend, payload, user_hash, deadline)
+                else:
+                    answer = await self._attempt(backend, payload, user_hash, deadline)
+                if answer:
+                    self.stats["answered"] += 1
+                    return answer
+                logger.warning(f"Respuesta vacía de IA en intento {attempt+1}")
+            except Saturated as e:
+                # Sin espera: o hay otra réplica disponible o se cae a la respuesta directa
+                logger.warning(f"Réplica {backend.name} saturada en intento {attempt+1} ({e})")
+                failed.append(backend)
+                continue
+            except RequestRejected as e:
+                logger.warning(f"Solicitud rechazada por {backend.name}: {e}")
+                break
+            except AttemptFailed as e:
+                logger.warning(f"Error con {backend.name} en intento {attempt+1}: {e}")
+                failed.append(backend)
+
+            # Backoff exponencial con jitter completo, sin pasarse del deadline
+            remaining = deadline - time.monotonic() - MIN_ATTEMPT_TIME
+            delay = min(random.uniform(0, self.backoff_base * 2 ** attempt), remaining)
+            if delay > 0 and attempt < self.max_attempts - 1:
+                await asyncio.sleep(delay)
+
+        self.stats["unanswered"] += 1
+        logger.error(f"La IA no respondió a tiempo para usuario {user_hash}")
+        return ""
+
+    async def _hedged(self, first: Backend, payload: dict, user_hash: str, deadline: float) -> str:
+        primary = asyncio.ensure_future(self._attempt(first, payload, user_hash, deadline))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+        second = None if done else self._pick(user_hash, [first], allow_failed=False)
+        if second is None:
+            return await primary
+
+        self.stats["hedges"] += 1
+        hedge = asyncio.ensure_future(self._attempt(second, payload, user_hash, deadline))
+        pending = {primary, hedge}
+        last_error: Optional[Exception] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        answer = task.result()
+                    except (Saturated, AttemptFailed, RequestRejected) as e:
+                        last_error = e
+                        continue
+                    if answer:
+                        if task is hedge:
+                            self.stats["hedges_won"] += 1
+                        return answer
+            if last_error:
+                raise last_error
+            return ""
+        finally:
+            # El perdedor se cancela: al cortar la conexión el servidor aborta su secuencia
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, backend: Backend, payload: dict, user_hash: str, deadline: float) -> str:
+        breaker = self.breaker(backend)
+        breaker.acquire()
+        remaining = max(0.1, deadline - time.monotonic())
+        started = time.monotonic()
+        backend_ok = False
+        tokens = 0
+        self.router.begin(backend)
+        try:
+            async with self.session.post(
+                backend.url(CHAT_PATH),
+                json=payload,
+                # Deadline: el servidor no decodifica más allá de lo que vamos a esperar
+                headers={DEADLINE_HEADER: f"{remaining:.1f}"},
+                timeout=aiohttp.ClientTimeout(total=remaining, connect=min(5, remaining))
+            ) as resp:
+                backend_ok = resp.status not in BACKEND_FAILURE_STATUSES
+                if resp.status == 200:
+                    data = await resp.json()
+                    breaker.record_success()
+                    # Una respuesta del cache no dice nada de la velocidad del motor
+                    tokens = 0 if data.get("cached") else data.get("tokens_used", 0)
+                    self._log_context_trim(data, user_hash)
+                    return data.get("response", "").strip()
+                if resp.status == 503:
+                    retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                    breaker.record_saturated(retry_after)
+                    raise Saturated(retry_after)
+                if 400 <= resp.status < 500:
+                    breaker.record_success()
+                    raise RequestRejected(f"HTTP {resp.status}")
+                breaker.record_failure()
+                raise AttemptFailed(f"HTTP {resp.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            backend_ok = False
+            breaker.record_failure()
+            raise AttemptFailed(f"{type(e).__name__}: {e}")
+        except asyncio.CancelledError:
+            backend_ok = True
+            breaker.record_cancelled()
+            raise
+        finally:
+            self.router.end(backend, time.monotonic() - started, backend_ok, tokens)
+
+    # ---------- Streaming ----------
+    async def stream(self, payload: dict, user_hash: str,
+                     deadline: Optional[float] = None) -> AsyncIterator[dict]:
+        """
+        Eventos NDJSON de /chat_stream ({"delta"}, y al final {"done"} o {"error"}).
+        Si el servidor rechaza la solicitud (503 o 4xx) emite un único
+        {"error", "status"}: reintentarla sin streaming tampoco tendría respuesta.
+        No emite nada si no hay réplica disponible o el stream no pudo abrirse.
+        Usar con contextlib.aclosing para que un corte temprano libere la conexión.
+        """
+        self.stats["calls"] += 1
+        deadline = deadline if deadline is not None else self.new_deadline()
+        remaining = deadline - time.monotonic()
+        if remaining < MIN_ATTEMPT_TIME:
+            return
+        backend = self._pick(user_hash, [])
+        if backend is None:
+            self.stats["short_circuited"] += 1
+            return
+
+        breaker = self.breaker(backend)
+        breaker.acquire()
+        started = time.monotonic()
+        backend_ok = False
+        finished = False
+        answered = False
+        ttft: Optional[float] = None
+        tokens = 0
+        self.router.begin(backend)
+        try:
+            async with self.session.post(
+                backend.url(CHAT_STREAM_PATH),
+                json=payload,
+                # Sin gzip: el compresor retendría los deltas hasta llenar su buffer
+                headers={
+                    "Accept-Encoding": "identity",
+                    DEADLINE_HEADER: f"{remaining:.1f}"
+                },
+                timeout=aiohttp.ClientTimeout(total=remaining, connect=min(5, remaining))
+            ) as resp:
+                backend_ok = resp.status not in BACKEND_FAILURE_STATUSES
+                if resp.status == 503:
+                    breaker.record_saturated(_parse_retry_after(resp.headers.get("Retry-After")))
+                    logger.warning(f"Réplica {backend.name} saturada (streaming)")
+                    yield {"error": f"HTTP {resp.status}", "status": resp.status}
+                    return
+                if resp.status != 200:
+                    logger.warning(f"Error HTTP {resp.status} de {backend.name} en streaming")
+                    if resp.status >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                        yield {"error": f"HTTP {resp.status}", "status": resp.status}
+                    finished = True
+                    return
+
+                async for raw_line in resp.content:
+                    line = raw_line.strip()
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if ttft is None and event.get("delta"):
+                        ttft = time.monotonic() - started
+                    if event.get("done"):
+                        finished = True
+                        if event.get("error"):
+                            breaker.record_failure()
+                        else:
+                            answered = True
+                            breaker.record_success()
+                            self._log_context_trim(event, user_hash)
+                            if not event.get("cached"):
+                                tokens = event.get("tokens_used", 0)
+                    yield event
+                    if finished:
+                        return
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            backend_ok = False
+            if not finished:
+                finished = True
+                breaker.record_failure()
+            logger.warning(f"Streaming interrumpido para usuario {user_hash}: {e}")
+        finally:
+            if not finished:
+                breaker.record_cancelled()
+            self.router.end(backend, time.monotonic() - started, backend_ok,
+                            tokens, ttft if tokens else None)
+            # Solo un "done" sin error es una respuesta (no un error del servidor ni un HTTP != 200)
+            if answered:
+                self.stats["answered"] += 1
+
+    def _log_context_trim(self, data: dict, user_hash: str):
+        """El servidor informa cuánto contexto descartó para que el prompt entre en el modelo"""
+        if data.get("dropped_sections"):
+            logger.info(
+                f"✂️ Contexto recortado para usuario {user_hash}: "
+                f"{data['dropped_sections']} fragmentos, {data.get('dropped_tokens', 0)} tokens"
+            )
+
+    # ---------- Métricas ----------
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "breakers": {b.name: self.breaker(b).snapshot() for b in self.router.backends}
+        }
+
+    def metrics_text(self) -> str:
+        """Contadores y estado de los breakers en formato de texto de Prometheus"""
+        states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+        lines = [
+            "# HELP unsa_bot_inference_calls_total Llamadas del bot al servidor de inferencia por resultado",
+            "# TYPE unsa_bot_inference_calls_total counter"
+        ]
+        for key in ("calls", "answered", "unanswered", "retries", "short_circuited", "hedges", "hedges_won"):
+            lines.append(f'unsa_bot_inference_calls_total{{result="{key}"}} {self.stats[key]}')
+        lines += [
+            "# HELP unsa_bot_breaker_state Estado del breaker por réplica (0 closed, 1 half_open, 2 open)",
+            "# TYPE unsa_bot_breaker_state gauge"
+        ]
+        breakers = self.snapshot()["breakers"]
+        for name, snap in breakers.items():
+            lines.append(f'unsa_bot_breaker_state{{backend="{name}"}} {states[snap["state"]]}')
+        lines += [
+            "# HELP unsa_bot_breaker_events_total Eventos de cada breaker",
+            "# TYPE unsa_bot_breaker_events_total counter"
+        ]
+        for name, snap in breakers.items():
+            for event in ("opened", "saturated", "successes", "failures"):
+                lines.append(f'unsa_bot_breaker_events_total{{backend="{name}",event="{event}"}} {snap[event]}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import time
+from collections import deque
+from typing import Deque, Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from .config import logger
+
+def _percentile(samples: Iterable[float], pct: float) -> Optional[float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+class Backend:
+    """
+    Una réplica del servidor de inferencia y lo que sabemos de ella.
+
+    Para estimar cuánto tardaría una respuesta se guardan por separado el
+    tiempo hasta el primer token y el tiempo por token generado (la duración
+    total depende del largo de cada respuesta). Son muestras con fecha: las
+    de más de `sample_max_age` segundos no cuentan, así una réplica que dejó
+    de recibir solicitudes no queda juzgada por su peor momento.
+    """
+
+    def __init__(self, base_url: str, latency_window: int = 200, sample_max_age: float = 120.0):
+        self.base_url = base_url.rstrip("/")
+        self.healthy = True
+        self.status = "unknown"
+        self.load = 0.0            # (en motor + en cola) / límite, según el último /health
+        self.max_concurrent = 1
+        self.in_flight = 0         # solicitudes nuestras todavía sin respuesta
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.last_health = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.sample_max_age = sample_max_age
+        self._latencies = deque(maxlen=latency_window)
+        self._ttfts: Deque[Tuple[float, float]] = deque(maxlen=latency_window)        # (cuándo, segundos)
+        self._token_times: Deque[Tuple[float, float]] = deque(maxlen=latency_window)  # (cuándo, s/token)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    @property
+    def name(self) -> str:
+        return self.base_url.split("://", 1)[-1]
+
+    @property
+    def score(self) -> float:
+        """Carga estimada: la del último /health más lo que mandamos desde entonces"""
+        return self.load + self.in_flight / max(self.max_concurrent, 1)
+
+    def latency_percentile(self, pct: float) -> Optional[float]:
+        """Duración de las solicitudes completas (solo para mostrar)"""
+        return _percentile(self._latencies, pct)
+
+    def _recent(self, samples: Deque[Tuple[float, float]], pct: float) -> Optional[float]:
+        oldest = time.monotonic() - self.sample_max_age
+        while samples and samples[0][0] < oldest:
+            samples.popleft()
+        return _percentile((value for _, value in samples), pct)
+
+    def ttft_percentile(self, pct: float) -> Optional[float]:
+        """Tiempo hasta el primer token (streaming) de las muestras recientes"""
+        return self._recent(self._ttfts, pct)
+
+    def token_time_percentile(self, pct: float) -> Optional[float]:
+        """Segundos por token generado de las muestras recientes"""
+        return self._recent(self._token_times, pct)
+
+    def record(self, latency: float, tokens: int = 0, ttft: Optional[float] = None):
+        """Una respuesta buena: `tokens` generados y, en streaming, el tiempo al primer token"""
+        now = time.monotonic()
+        self._latencies.append(latency)
+        if ttft is not None:
+            self._ttfts.append((now, ttft))
+        if tokens > 0:
+            self._token_times.append((now, (latency - (ttft or 0.0)) / tokens))
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "status": self.status,
+            "load": round(self.load, 3),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejections": self.ejections,
+            "p50_latency": self.latency_percentile(50),
+            "p95_latency": self.latency_percentile(95),
+            "p95_ttft": self.ttft_percentile(95),
+            "p95_token_time": self.token_time_percentile(95)
+        }
+
+class InferenceRouter:
+    """
+    Reparte las solicitudes del bot entre réplicas del servidor de inferencia.
+
+    - Un loop en segundo plano consulta /health de cada réplica y guarda su carga
+    - pick() elige la réplica preferida del usuario (rendezvous hashing, así el
+      prefix cache de esa réplica ya tiene su conversación) salvo que esté
+      bastante más cargada que la menos cargada
+    - Tras `eject_after` fallas seguidas la réplica sale de la rotación por
+      `eject_seconds` (se duplica en cada expulsión consecutiva) y vuelve sola
+      cuando su /health responde bien
+    """
+
+    def __init__(self, base_urls: List[str], health_interval: float = 5.0,
+                 eject_after: int = 3, eject_seconds: float = 30.0, affinity_slack: float = 0.25):
+        self.backends = [Backend(url) for url in base_urls]
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.affinity_slack = affinity_slack
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=3, connect=2))
+        if self._poll_task is None or self._poll_task.done():
+            await self.refresh()
+            self._poll_task = asyncio.create_task(self._poll_loop())
+            logger.info("✅ Router de inferencia con %d réplicas", len(self.backends))
+
+    async def stop(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+    # ---------- Selección ----------
+    def _affinity(self, user_hash: str, backend: Backend) -> int:
+        digest = hashlib.md5(f"{user_hash}|{backend.base_url}".encode()).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def pick(self, user_hash: str, exclude: Iterable[Backend] = ()) -> Optional[Backend]:
+        """Réplica para esta solicitud, o None si no hay ninguna sana"""
+        now = time.monotonic()
+        excluded = set(exclude)
+        candidates = [
+            b for b in self.backends
+            if b.healthy and b.ejected_until <= now and b not in excluded
+        ]
+        if not candidates:
+            return None
+
+        preferred = max(candidates, key=lambda b: self._affinity(user_hash, b))
+        least_loaded = min(candidates, key=lambda b: b.score)
+        if preferred.score <= least_loaded.score + self.affinity_slack:
+            return preferred
+        return least_loaded
+
+    # ---------- Resultados de solicitudes ----------
+    def begin(self, backend: Backend):
+        backend.in_flight += 1
+        backend.requests += 1
+
+    def end(self, backend: Backend, latency: float, ok: bool,
+            tokens: int = 0, ttft: Optional[float] = None):
+        """tokens/ttft: para la estimación de latencia (0/None si no hubo generación)"""
+        backend.in_flight = max(0, backend.in_flight - 1)
+        if ok:
+            # Una respuesta buena cierra el ciclo de expulsiones: la próxima vuelve a ser corta
+            backend.consecutive_failures = 0
+            backend.ejections = 0
+            backend.record(latency, tokens, ttft)
+            return
+        backend.errors += 1
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.eject_after:
+            self._eject(backend, f"{backend.consecutive_failures} fallas seguidas")
+
+    def _eject(self, backend: Backend, reason: str):
+        if backend.ejected_until > time.monotonic():
+            return
+        backend.ejections += 1
+        # Expulsiones consecutivas más largas para no castigar a una réplica que se está reiniciando
+        duration = min(self.eject_seconds * 2 ** (backend.ejections - 1), 600)
+        backend.ejected_until = time.monotonic() + duration
+        backend.healthy = False
+        logger.warning("🚫 Réplica %s fuera de rotación por %.0fs: %s", backend.name, duration, reason)
+
+    # ---------- Health checks ----------
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("❌ Error en health checks del router: %s", str(e))
+
+    async def refresh(self):
+        await asyncio.gather(*(self._check(b) for b in self.backends))
+
+    async def _check(self, backend: Backend):
+        try:
+            async with self.session.get(backend.url("/health")) as resp:
+                if resp.status != 200:
+                    raise aiohttp.ClientResponseError(
+                        resp.request_info, resp.history, status=resp.status
+                    )
+                data = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            backend.status = "unreachable"
+            if backend.healthy:
+                self._eject(backend, f"/health falló ({type(e).__name__})")
+            return
+
+        backend.last_health = time.monotonic()
+        backend.status = data.get("status", "unknown")
+        backend.max_concurrent = max(1, data.get("max_concurrent", 1))
+        backend.load = (data.get("concurrent_requests", 0) + data.get("queue_size", 0)) / backend.max_concurrent
+        if not backend.healthy and backend.ejected_until <= time.monotonic():
+            backend.healthy = True
+            backend.consecutive_failures = 0
+            logger.info("✅ Réplica %s de vuelta en rotación", backend.name)
+
+    def snapshot(self) -> List[dict]:
+        return [b.snapshot() for b in self.backends]
@@ -0,0 +1,146 @@
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Intenciones con respuesta fija: (patrón sobre el texto normalizado, respuestas que se turnan).
+# El patrón tiene que cubrir el mensaje completo: "hola, ¿hay becas?" no es un saludo,
+# es una consulta y sigue a la búsqueda.
+INTENTS: Dict[str, Tuple[str, List[str]]] = {
+    "greeting": (
+        r"(?:hola+|holis|buenas|buen dia|buenos dias|buenas (?:tardes|noches)|hey|saludos|que tal)"
+        r"(?: (?:como (?:estas|andas|va)|que tal|bot|asistente|gente|unsa))*",
+        [
+            "👋 Hola, soy el Asistente UNSA.\n\n"
+            "Podés preguntarme sobre becas, carreras, inscripciones o trámites.\n"
+            "Usá /help para ver los comandos.",
+            "¡Hola! 😊 ¿En qué te ayudo? Puedo contarte sobre carreras, becas, inscripciones y trámites de la UNSA.",
+            "👋 ¡Buenas! Preguntame lo que necesites sobre la UNSA: carreras, becas, fechas o trámites."
+        ]
+    ),
+    "thanks": (
+        r"(?:(?:ok|oka|listo|genial|perfecto|buenisimo|dale|bueno) )?(?:muchas |mil )?gracias+"
+        r"(?: por (?:la (?:info|informacion|ayuda)|todo|tu ayuda))?(?: (?:genio|crack|bot))?",
+        [
+            "¡De nada! 😊 Si tenés otra consulta, escribime.",
+            "¡Un gusto ayudarte! Cualquier otra duda, acá estoy.",
+            "¡Por nada! 🙌 Éxitos con los trámites."
+        ]
+    ),
+    "goodbye": (
+        r"(?:chau|adios|bye|nos vemos|hasta (?:luego|pronto|manana))(?: (?:gracias|saludos))?",
+        [
+            "¡Hasta luego! 👋 Éxitos en la facultad.",
+            "¡Chau! Cuando necesites algo de la UNSA, escribime."
+        ]
+    ),
+    "help": (
+        r"(?:ayuda|help|menu|comandos|opciones"
+        r"|que (?:podes|puedes|sabes) hacer|como (?:funciona|funcionas|te uso)"
+        r"|que (?:te )?(?:puedo|se puede) preguntar)",
+        [
+            "🤖 Puedo ayudarte con:\n"
+            "• Carreras y programas de estudio\n"
+            "• Información sobre becas\n"
+            "• Fechas de inscripción\n"
+            "• Trámites administrativos\n"
+            "• Contactos y ubicaciones\n\n"
+            "Escribí tu consulta, por ejemplo \"¿Hay becas?\" o \"Carreras de ingeniería\". "
+            "Usá /help para ver los comandos."
+        ]
+    ),
+    "identity": (
+        r"(?:quien|que) (?:sos|eres)(?: vos| tu)?|(?:sos|eres) (?:un |una )?(?:bot|robot|humano|persona|ia)",
+        [
+            "🤖 Soy el Asistente UNSA, un bot que responde con la información cargada en la base "
+            "de la universidad. Para trámites puntuales conviene confirmar en la facultad."
+        ]
+    ),
+    "website": (
+        r"(?:cual es )?(?:la )?(?:pagina|sitio|web|pagina web|sitio web|link|enlace)(?: oficial)?"
+        r"(?: (?:de|del) (?:la )?(?:unsa|universidad|exactas|facultad(?: de exactas)?))?",
+        [
+            "🔗 https://www.unsa.edu.ar\n"
+            "🔗 https://exactas.unsa.edu.ar"
+        ]
+    )
+}
+
+# Preguntas que piden explicar resultados anteriores ("¿de qué se trata?")
+EXPLANATORY_TRIGGERS = (
+    "de que se trata",
+    "de que se tratan",
+    "diferencia",
+    "me conviene",
+    "salida laboral",
+    "orientacion",
+    "perfil",
+    "en que consiste",
+    "que hace"
+)
+
+MAX_INTENT_LEN = 80  # un mensaje más largo es una consulta, no un saludo
+
+_NON_WORD_RE = re.compile(r"[^\w\s]")
+_SPACES_RE = re.compile(r"\s+")
+
+class IntentMatch(NamedTuple):
+    intent: str
+    response: str
+
+class IntentRouter:
+    """
+    Reconoce mensajes que no necesitan ni la base ni la IA (saludos,
+    agradecimientos, ayuda, preguntas frecuentes) con una sola expresión
+    regular compilada: cada intención es un grupo con nombre y el primero
+    que cubre el mensaje completo gana. Las respuestas de cada intención se
+    turnan para no repetir siempre la misma.
+    """
+
+    def __init__(self, intents: Dict[str, Tuple[str, List[str]]] = INTENTS,
+                 explanatory_triggers: Tuple[str, ...] = EXPLANATORY_TRIGGERS):
+        self.responses = {name: responses for name, (_, responses) in intents.items()}
+        self.pattern = re.compile(
+            "|".join(f"(?P<{name}>{pattern})" for name, (pattern, _) in intents.items())
+        )
+        self.explanatory = re.compile("|".join(re.escape(t) for t in explanatory_triggers))
+        self.turns = Counter()
+        self.hits = Counter()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Minúsculas, sin acentos, sin signos ni emojis y con espacios simples"""
+        text = unicodedata.normalize("NFKD", text.lower())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return _SPACES_RE.sub(" ", _NON_WORD_RE.sub(" ", text)).strip()
+
+    def match(self, text: str) -> Optional[IntentMatch]:
+        """Respuesta fija para el mensaje, o None si hay que buscar"""
+        normalized = self.normalize(text) if len(text) <= MAX_INTENT_LEN else ""
+        found = self.pattern.fullmatch(normalized) if normalized else None
+        if found is None:
+            self.hits["none"] += 1
+            return None
+
+        intent = found.lastgroup
+        self.hits[intent] += 1
+        responses = self.responses[intent]
+        response = responses[self.turns[intent] % len(responses)]
+        self.turns[intent] += 1
+        return IntentMatch(intent, response)
+
+    def is_explanatory(self, text: str) -> bool:
+        return self.explanatory.search(self.normalize(text)) is not None
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self.hits)
+
+    def metrics_text(self) -> str:
+        """Mensajes por intención en formato de texto de Prometheus"""
+        lines = [
+            "# HELP unsa_bot_intent_hits_total Mensajes respondidos con una respuesta fija, por intención",
+            "# TYPE unsa_bot_intent_hits_total counter"
+        ]
+        for intent, value in sorted(self.hits.items()):
+            lines.append(f'unsa_bot_intent_hits_total{{intent="{intent}"}} {value}')
+        return "\n".join(lines) + "\n"
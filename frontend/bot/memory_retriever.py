@@ -0,0 +1,433 @@
+import asyncio
+import dataclasses
+import heapq
+import json
+import math
+import re
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import asyncpg
+
+from .config import logger
+from .models import SearchResult, ResponseMode
+from .retriever import FRAGMENT_COLUMNS, PostgresRetriever
+
+# Canal de migration_006_notificar_fragmentos.sql
+NOTIFY_CHANNEL = "fragmentos_cambios"
+
+LOAD_ALL = f"SELECT {FRAGMENT_COLUMNS}, usado_count, relevancia FROM fragmentos_conocimiento"
+LOAD_IDS = LOAD_ALL + " WHERE id = ANY($1::int[])"
+
+# Pesos de cada parte del fragmento, como setweight en contenido_tsvector (migration_005)
+NAME_WEIGHT = 2.0
+KEYWORD_WEIGHT = 2.0
+CONTENT_WEIGHT = 1.0
+DESCRIPTION_WEIGHT = 0.5
+
+# Mismo orden que CARRERA_ORDER del retriever SQL
+CARRERA_WORDS = ("carrera", "licenciatura", "profesorado", "tecnicatura")
+
+MAX_EXPANSIONS = 8  # términos parecidos por término de la consulta
+EXPANSION_CACHE_SIZE = 4096
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def fold(text: str) -> str:
+    """Minúsculas y sin acentos (también ñ -> n, como _remove_accents)"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def trigrams(term: str) -> Set[str]:
+    """Trigramas de una palabra con el mismo relleno que pg_trgm ("  ab", "ab ")"""
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class _Doc(NamedTuple):
+    result: SearchResult
+    usage: int
+    relevance: float
+
+class _Index:
+    """
+    Índice invertido inmutable sobre los fragmentos cargados. Cada recarga arma
+    uno nuevo y lo reemplaza entero, así una búsqueda nunca ve uno a medias.
+
+    Las posting lists son arreglos (array) paralelos de posiciones de fragmento
+    y del aporte BM25 ya calculado de ese término en ese fragmento: buscar es
+    sumar idf * aporte por término. Los términos del vocabulario están además
+    indexados por trigramas para encontrar variantes ("becas"/"beca",
+    "informatica"/"inform") con la similitud de pg_trgm.
+    """
+
+    def __init__(self, docs: List[_Doc], k1: float = 1.2, b: float = 0.75):
+        self.docs = docs
+        self.positions = {d.result.id: pos for pos, d in enumerate(docs)}
+        # Lo único que cambia después de armarlo: se suma con cada búsqueda (count_usage)
+        self.usage = array("q", (d.usage for d in docs))
+        self.carrera_rank = array("b", (self._carrera_rank(d.result.content) for d in docs))
+        self.listed = array("I", (
+            pos for pos, d in enumerate(docs)
+            if any(w in (d.result.category or "").lower() for w in ("carrera", "beca"))
+        ))
+        self.reorder()
+
+        # Frecuencias con peso por fragmento
+        freqs: List[Counter] = []
+        for d in docs:
+            counts = Counter()
+            name = d.result.content.split(".", 1)[0]
+            for text, weight in (
+                (name, NAME_WEIGHT),
+                (" ".join(d.result.keywords), KEYWORD_WEIGHT),
+                (d.result.content, CONTENT_WEIGHT),
+                (d.result.description or "", DESCRIPTION_WEIGHT)
+            ):
+                for token in _TOKEN_RE.findall(fold(text)):
+                    counts[token] += weight
+            freqs.append(counts)
+
+        lengths = [sum(c.values()) for c in freqs]
+        avg_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+
+        self.terms: Dict[str, int] = {}
+        self.postings_docs: List[array] = []
+        self.postings_scores: List[array] = []
+        for pos, counts in enumerate(freqs):
+            length_norm = k1 * (1 - b + b * lengths[pos] / avg_length)
+            for token, tf in counts.items():
+                t = self.terms.get(token)
+                if t is None:
+                    t = self.terms[token] = len(self.postings_docs)
+                    self.postings_docs.append(array("I"))
+                    self.postings_scores.append(array("f"))
+                self.postings_docs[t].append(pos)
+                self.postings_scores[t].append(tf * (k1 + 1) / (tf + length_norm))
+
+        n = len(docs)
+        self.idf = array("d", (
+            math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for p in self.postings_docs
+        ))
+
+        grams: Dict[str, List[int]] = {}
+        self.gram_counts = array("H")
+        for token, t in self.terms.items():
+            token_grams = trigrams(token)
+            self.gram_counts.append(len(token_grams))
+            for g in token_grams:
+                grams.setdefault(g, []).append(t)
+        self.grams = {g: array("I", ts) for g, ts in grams.items()}
+        self._expansions: Dict[Tuple[str, float], List[Tuple[int, float]]] = {}
+
+    def reorder(self):
+        """Rearma los órdenes por uso (top y general) con los contadores actuales"""
+        usage = self.usage
+        self.top = array("I", sorted(range(len(self.docs)), key=lambda i: -usage[i]))
+        self.general = array("I", sorted(
+            self.listed, key=lambda i: (-usage[i], -self.docs[i].relevance)
+        ))
+        self.reordered_at = time.monotonic()
+        self.usage_changed = False
+
+    @staticmethod
+    def _carrera_rank(content: str) -> int:
+        lowered = content.lower()
+        for rank, word in enumerate(CARRERA_WORDS, start=1):
+            if word in lowered:
+                return rank
+        return len(CARRERA_WORDS) + 1
+
+    def expand(self, term: str, threshold: float) -> List[Tuple[int, float]]:
+        """Términos del vocabulario para un término de la consulta: (término, peso)"""
+        key = (term, threshold)
+        cached = self._expansions.get(key)
+        if cached is not None:
+            return cached
+
+        term_grams = trigrams(term)
+        shared = Counter()
+        for g in term_grams:
+            shared.update(self.grams.get(g, ()))
+        similar = []
+        for t, common in shared.items():
+            similarity = common / (len(term_grams) + self.gram_counts[t] - common)
+            if similarity >= threshold:
+                similar.append((t, similarity))
+        exact = self.terms.get(term)
+        if exact is not None:
+            similar = [(t, s) for t, s in similar if t != exact] + [(exact, 1.0)]
+        expansion = heapq.nlargest(MAX_EXPANSIONS, similar, key=lambda x: x[1])
+
+        if len(self._expansions) >= EXPANSION_CACHE_SIZE:
+            self._expansions.clear()
+        self._expansions[key] = expansion
+        return expansion
+
+    def search(self, terms: Iterable[str], is_carrera_query: bool, limit: int,
+               threshold: float) -> List[Tuple[int, float]]:
+        """(posición, score BM25) de los mejores fragmentos"""
+        weights: Dict[int, float] = {}
+        for term in terms:
+            for t, weight in self.expand(fold(term), threshold):
+                if weight > weights.get(t, 0.0):
+                    weights[t] = weight
+
+        scores: Dict[int, float] = {}
+        for t, weight in weights.items():
+            factor = weight * self.idf[t]
+            for pos, partial in zip(self.postings_docs[t], self.postings_scores[t]):
+                scores[pos] = scores.get(pos, 0.0) + factor * partial
+
+        usage = self.usage
+        if is_carrera_query:
+            rank = self.carrera_rank
+            return heapq.nsmallest(limit, scores.items(), key=lambda x: (rank[x[0]], -x[1], -usage[x[0]]))
+        return heapq.nsmallest(limit, scores.items(), key=lambda x: (-x[1], -usage[x[0]]))
+
+class InMemoryRetriever(PostgresRetriever):
+    """
+    Mismo contrato que PostgresRetriever, pero las búsquedas no tocan la base:
+    al conectar carga fragmentos_conocimiento entero en un _Index (BM25 sin
+    acentos más trigramas para variantes) y lo mantiene al día con LISTEN/NOTIFY.
+
+    Cada aviso trae el id del fragmento que cambió; se juntan durante
+    `reload_debounce` segundos (una carga de CSV es una sola recarga), se leen
+    solo esas filas y se rearma el índice a partir de los fragmentos en memoria.
+    Al reconectar el LISTEN se recarga todo, por los avisos perdidos mientras
+    tanto. Si el índice todavía no se pudo cargar, se busca con SQL.
+
+    Los cambios de usado_count no avisan: cada resultado devuelto suma uno
+    también en el índice, y los órdenes por uso (consultas generales o sin
+    términos) se rearman a lo sumo cada `reorder_interval` segundos. Los usos
+    de otros procesos se ven recién en la próxima recarga de esos fragmentos.
+    """
+
+    def __init__(self, db_url: str, reload_debounce: float = 0.5,
+                 k1: float = 1.2, b: float = 0.75, reorder_interval: float = 5.0, **options):
+        super().__init__(db_url, **options)
+        self.reload_debounce = reload_debounce
+        self.reorder_interval = reorder_interval
+        self.k1 = k1
+        self.b = b
+        self.index: Optional[_Index] = None
+        self._docs: Dict[int, _Doc] = {}
+        self._pending_ids: Set[int] = set()
+        self._full_reload = False
+        self._reload_event = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.stats.update({"memory_queries": 0, "reloads": 0, "notifications": 0})
+        self.loaded_at: Optional[float] = None
+        self.build_ms = 0.0
+
+    async def connect(self) -> bool:
+        was_connected = self.connected
+        if not await super().connect():
+            return False
+        if not was_connected:
+            try:
+                await self._load_all()
+            except Exception as e:
+                # Mientras tanto se busca con SQL; _reload_loop reintenta la carga completa
+                logger.error("❌ No se pudo cargar el índice en memoria: %s", str(e))
+                self._full_reload = True
+                self._reload_event.set()
+            if not self._tasks:
+                self._tasks = [
+                    asyncio.create_task(self._listen_loop()),
+                    asyncio.create_task(self._reload_loop())
+                ]
+        return True
+
+    async def disconnect(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await super().disconnect()
+
+    def load_rows(self, rows: Iterable) -> None:
+        """Reemplaza todos los fragmentos (filas con las columnas de LOAD_ALL) y rearma el índice"""
+        self._docs = {r["id"]: self._doc_from_row(r) for r in rows}
+        self._rebuild()
+
+    @staticmethod
+    def _doc_from_row(r) -> _Doc:
+        return _Doc(
+            SearchResult(
+                id=r["id"],
+                content=r["contenido"],
+                category=r["categoria"],
+                faculty=r["facultad"],
+                score=1.0,
+                keywords=list(r["palabras_clave"] or []),
+                description=r["descripcion"]
+            ),
+            r["usado_count"] or 0,
+            r["relevancia"] or 0.0
+        )
+
+    def _rebuild(self):
+        started = time.perf_counter()
+        index = _Index(sorted(self._docs.values(), key=lambda d: d.result.id), self.k1, self.b)
+        self.build_ms = (time.perf_counter() - started) * 1000
+        self.index = index
+        self.loaded_at = time.time()
+        self.stats["fragments"] = len(index.docs)
+        self.stats["reloads"] += 1
+        logger.info(
+            "📚 Índice en memoria: %d fragmentos, %d términos (%.1f ms)",
+            len(index.docs), len(index.terms), self.build_ms
+        )
+
+    async def _load_all(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(LOAD_ALL)
+        self.load_rows(rows)
+
+    async def _load_ids(self, ids: Set[int]):
+        if self.index is None:
+            # Un índice armado solo con estas filas taparía la búsqueda SQL
+            return await self._load_all()
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(LOAD_IDS, list(ids))
+        found = {r["id"]: self._doc_from_row(r) for r in rows}
+        # Los que no volvieron fueron borrados
+        for i in ids - found.keys():
+            self._docs.pop(i, None)
+        self._docs.update(found)
+        self._rebuild()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.stats["notifications"] += 1
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            change = {}
+        if change.get("id") is None:
+            # TRUNCATE o un aviso que no se entiende
+            self._full_reload = True
+        else:
+            self._pending_ids.add(int(change["id"]))
+        self._reload_event.set()
+
+    async def _listen_loop(self):
+        """Conexión propia para LISTEN: el pool hace UNLISTEN * al devolver cada conexión"""
+        delay = 1.0
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.db_url)
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda c: closed.set())
+                await conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+                if not first:
+                    self._full_reload = True
+                    self._reload_event.set()
+                first = False
+                delay = 1.0
+                logger.info("👂 Escuchando cambios de fragmentos (%s)", NOTIFY_CHANNEL)
+                await closed.wait()
+                logger.warning("⚠️ Se perdió la conexión de LISTEN, reintentando")
+            except asyncio.CancelledError:
+                if conn is not None:
+                    await conn.close()
+                raise
+            except Exception as e:
+                logger.warning("⚠️ LISTEN %s falló: %s", NOTIFY_CHANNEL, str(e))
+                first = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    async def _reload_loop(self):
+        while True:
+            await self._reload_event.wait()
+            await asyncio.sleep(self.reload_debounce)
+            self._reload_event.clear()
+            ids, self._pending_ids = self._pending_ids, set()
+            # Sin índice todavía no hay sobre qué aplicar cambios sueltos: se carga todo
+            full, self._full_reload = self._full_reload or self.index is None, False
+            try:
+                if full:
+                    await self._load_all()
+                elif ids:
+                    await self._load_ids(ids)
+            except Exception as e:
+                # Se reintenta junto con los avisos que lleguen mientras tanto (una
+                # carga completa fallida se sigue reintentando hasta que salga)
+                self._pending_ids |= ids
+                self._full_reload |= full
+                logger.warning("⚠️ No se pudo actualizar el índice en memoria: %s", str(e))
+                await asyncio.sleep(5)
+                self._reload_event.set()
+
+    async def retrieve(
+        self, query: str, limit: int = 20
+    ) -> Tuple[str, List[SearchResult], ResponseMode]:
+        index = self.index
+        if index is None:
+            return await super().retrieve(query, limit)
+
+        self.stats["queries"] += 1
+        self.stats["memory_queries"] += 1
+        terms, is_carrera_query = self._clean_query_terms(query)
+
+        if (index.usage_changed
+                and time.monotonic() - index.reordered_at >= self.reorder_interval):
+            index.reorder()
+
+        if self._is_general_list_query(query):
+            hits = [(pos, 1.0) for pos in index.general[:limit]]
+        elif not terms:
+            hits = [(pos, 1.0) for pos in index.top[:limit]]
+        else:
+            hits = index.search(terms, is_carrera_query, limit, self.similarity_threshold)
+            # Score entre 0 y 1, como ts_rank_cd con normalización 32
+            hits = [(pos, score / (score + 1)) for pos, score in hits]
+
+        results = [dataclasses.replace(index.docs[pos].result, score=score) for pos, score in hits]
+        return self._respond(results, is_carrera_query)
+
+    def _respond(
+        self, results: List[SearchResult], is_carrera_query: bool
+    ) -> Tuple[str, List[SearchResult], ResponseMode]:
+        self._count_usage(r.id for r in results)
+        return super()._respond(results, is_carrera_query)
+
+    def _count_usage(self, ids: Iterable[int]):
+        """Lo mismo que suma el UsageCounter, en el índice y en los fragmentos para el próximo rearmado"""
+        index = self.index
+        for i in ids:
+            doc = self._docs.get(i)
+            if doc is None:
+                continue
+            self._docs[i] = doc._replace(usage=doc.usage + 1)
+            pos = index.positions.get(i) if index is not None else None
+            if pos is not None:
+                index.usage[pos] += 1
+                index.usage_changed = True
+
+    async def fetch_by_ids(self, ids: List[int]) -> List[SearchResult]:
+        if self.index is None:
+            return await super().fetch_by_ids(ids)
+        return [dataclasses.replace(self._docs[i].result) for i in ids if i in self._docs]
+
+    def index_snapshot(self) -> Optional[dict]:
+        index = self.index
+        if index is None:
+            return None
+        return {
+            "fragments": len(index.docs),
+            "terms": len(index.terms),
+            "build_ms": self.build_ms,
+            "age": time.time() - self.loaded_at,
+            "reloads": self.stats["reloads"],
+            "notifications": self.stats["notifications"]
+        }
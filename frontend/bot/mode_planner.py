@@ -0,0 +1,111 @@
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional, Set
+
+from .config import logger
+from .inference_client import InferenceClient
+from .models import ResponseMode
+
+@dataclass
+class ModeDecision:
+    mode: ResponseMode
+    max_tokens: int
+    reason: str
+    estimated_latency: Optional[float] = None
+
+class ModePlanner:
+    """
+    Decide cómo responder combinando el modo que sugiere la búsqueda con la
+    carga actual de la GPU.
+
+    La latencia esperada de la réplica que atendería al usuario se estima con
+    sus muestras recientes (p95) como primer token + max_tokens × tiempo por
+    token, escalado por su carga ((en motor + en cola) / límite): con la cola
+    llena a medias, cada solicitud espera media "vuelta" más. Si no entra en
+    el presupuesto se achica max_tokens a lo que entra y, si ni así alcanza,
+    se responde directo desde la base. Sin muestras recientes no hay
+    estimación y se responde con el LLM completo, que vuelve a medir.
+
+    Con carga de `degrade_load` o más la réplica queda degradada (respuestas
+    directas) hasta que su carga baja de `resume_load`; la salida depende solo
+    de la carga porque una réplica degradada no recibe solicitudes que midan
+    su latencia.
+    El estado degradado es de cada réplica: una saturada no frena a los
+    usuarios que atienden las demás, ni la alternancia entre réplicas lo
+    prende y apaga.
+    """
+
+    def __init__(self, client: InferenceClient, latency_budget: float, max_tokens: int = 500,
+                 min_max_tokens: int = 150, degrade_load: float = 1.5, resume_load: float = 0.8):
+        self.client = client
+        self.latency_budget = latency_budget
+        self.max_tokens = max_tokens
+        self.min_max_tokens = min(min_max_tokens, max_tokens)
+        self.degrade_load = degrade_load
+        self.resume_load = resume_load
+        self.degraded: Set[str] = set()   # réplicas (Backend.name) degradadas
+        self.decisions = Counter()
+
+    def plan(self, suggested: ResponseMode, user_hash: str, purpose: str = "rag") -> ModeDecision:
+        """suggested: modo según la búsqueda (o LLM para saludos y explicativas)"""
+        if suggested != ResponseMode.LLM:
+            decision = ModeDecision(suggested, self.max_tokens, "sugerido por la búsqueda")
+            return self._record(decision, user_hash, purpose)
+
+        backend = self.client.peek(user_hash)
+        if backend is None:
+            decision = ModeDecision(ResponseMode.DIRECT, 0, "sin réplicas disponibles")
+            return self._record(decision, user_hash, purpose)
+
+        load = backend.score
+        scale = max(1.0, load)
+        ttft = backend.ttft_percentile(95) or 0.0
+        token_time = backend.token_time_percentile(95)
+        estimate = (ttft + self.max_tokens * token_time) * scale if token_time is not None else None
+        degraded = self._update_degraded(backend.name, load)
+
+        if degraded:
+            decision = ModeDecision(ResponseMode.DIRECT, 0, "degradado por carga", estimate)
+        elif estimate is None or estimate <= self.latency_budget:
+            decision = ModeDecision(ResponseMode.LLM, self.max_tokens, "dentro del presupuesto", estimate)
+        else:
+            # Los tokens que se alcanzan a generar dentro del presupuesto
+            max_tokens = int((self.latency_budget / scale - ttft) / token_time)
+            if max_tokens >= self.min_max_tokens:
+                decision = ModeDecision(ResponseMode.LLM, max_tokens, "respuesta acortada", estimate)
+            else:
+                decision = ModeDecision(ResponseMode.DIRECT, 0, "no entra en el presupuesto", estimate)
+        return self._record(decision, user_hash, purpose, load, ttft, token_time)
+
+    def _update_degraded(self, name: str, load: float) -> bool:
+        """Actualiza y devuelve si la réplica `name` está degradada"""
+        if name not in self.degraded and load >= self.degrade_load:
+            self.degraded.add(name)
+            logger.warning("🔻 GPU %s saturada (carga %.2f): respuestas directas desde la base", name, load)
+        elif name in self.degraded and load < self.resume_load:
+            self.degraded.discard(name)
+            logger.info("🔺 Carga de %s normalizada (%.2f): se vuelve a responder con IA", name, load)
+        return name in self.degraded
+
+    def _record(self, decision: ModeDecision, user_hash: str, purpose: str,
+                load: Optional[float] = None, ttft: Optional[float] = None,
+                token_time: Optional[float] = None) -> ModeDecision:
+        self.decisions[f"{decision.mode.value}:{decision.reason}"] += 1
+        logger.info(
+            "🧭 Modo %s para %s de usuario %s: %s (carga %s, primer token %s, por token %s, "
+            "estimado %s, presupuesto %.1fs, max_tokens %d)",
+            decision.mode.value, purpose, user_hash, decision.reason,
+            f"{load:.2f}" if load is not None else "-",
+            f"{ttft:.2f}s" if ttft is not None else "-",
+            f"{token_time * 1000:.0f}ms" if token_time is not None else "-",
+            f"{decision.estimated_latency:.1f}s" if decision.estimated_latency is not None else "-",
+            self.latency_budget, decision.max_tokens
+        )
+        return decision
+
+    def snapshot(self) -> dict:
+        return {
+            "degraded": sorted(self.degraded),
+            "latency_budget": self.latency_budget,
+            "decisions": dict(self.decisions)
+        }
@@ -0,0 +1,118 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from .config import logger
+from .state_store import ADMITTED, RATE_LIMITED, TOO_FAST, Bucket, StateStore
+
+GLOBAL_KEY = "*"
+
+class RateLimiter:
+    """
+    Cuotas por token bucket en cuatro niveles, guardadas en el StateStore
+    (memoria constante por clave y las claves inactivas vencen solas):
+
+    - mensajes de todo el bot (`global_rate`) y de cada usuario (`user_rate`);
+      todo mensaje admitido paga 1, y una respuesta directa desde la base no
+      paga nada más
+    - respuestas de la IA de cada usuario (`llm_user_rate`) y de todo el bot
+      (`llm_global_rate`); una respuesta paga según su max_tokens, así una
+      acortada por el planificador cuesta menos que una completa, y una que
+      no llegó se devuelve
+
+    Las tasas están en fichas por segundo y las ráfagas en fichas.
+    """
+
+    def __init__(self, store: StateStore, user_rate: float, user_burst: float,
+                 global_rate: float, global_burst: float,
+                 llm_user_rate: float, llm_user_burst: float,
+                 llm_global_rate: float, llm_global_burst: float,
+                 min_interval: float = 1.5, active_ttl: float = 86400):
+        self.store = store
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.llm_user_rate = llm_user_rate
+        self.llm_user_burst = llm_user_burst
+        self.llm_global_rate = llm_global_rate
+        self.llm_global_burst = llm_global_burst
+        self.min_interval = min_interval
+        self.active_ttl = active_ttl
+        self.stats = Counter()
+
+    def _message_buckets(self, user_hash: str, cost: float = 1.0) -> List[Bucket]:
+        return [
+            Bucket(f"msg:{GLOBAL_KEY}", self.global_rate, self.global_burst, cost),
+            Bucket(f"msg:{user_hash}", self.user_rate, self.user_burst, cost)
+        ]
+
+    def _llm_buckets(self, user_hash: str, cost: float = 1.0) -> List[Bucket]:
+        return [
+            Bucket(f"llm:{GLOBAL_KEY}", self.llm_global_rate, self.llm_global_burst, cost),
+            Bucket(f"llm:{user_hash}", self.llm_user_rate, self.llm_user_burst, cost)
+        ]
+
+    async def admit(self, user_hash: str) -> Tuple[str, float]:
+        """(ADMITTED | RATE_LIMITED | TOO_FAST, segundos hasta poder volver a escribir)"""
+        verdict, retry_after = await self.store.admit_message(
+            user_hash, self.min_interval, self.active_ttl, self._message_buckets(user_hash)
+        )
+        self.stats[verdict] += 1
+        if verdict == RATE_LIMITED:
+            logger.info("🎟️ Usuario %s sin cuota de mensajes (%.0fs)", user_hash, retry_after)
+        return verdict, retry_after
+
+    async def charge_llm(self, user_hash: str, cost: float = 1.0) -> bool:
+        """Descuenta una respuesta de la IA; False si el usuario o el bot no tienen cuota"""
+        cost = min(cost, self.llm_user_burst, self.llm_global_burst)
+        result = await self.store.take_tokens(self._llm_buckets(user_hash, cost))
+        if result.allowed:
+            self.stats["llm_granted"] += 1
+        else:
+            self.stats["llm_denied"] += 1
+            logger.info("🎟️ Usuario %s sin cuota de IA (%.0fs)", user_hash, result.retry_after)
+        return result.allowed
+
+    async def refund_llm(self, user_hash: str, cost: float = 1.0):
+        """Devuelve lo cobrado por charge_llm cuando la IA no llegó a responder"""
+        cost = min(cost, self.llm_user_burst, self.llm_global_burst)
+        # Costo negativo: suma fichas, sin pasar de la ráfaga
+        await self.store.take_tokens(self._llm_buckets(user_hash, -cost))
+        self.stats["llm_refunded"] += 1
+
+    async def quota(self, user_hash: str) -> Dict[str, float]:
+        """Fichas disponibles del usuario, sin consumir nada"""
+        result = await self.store.take_tokens(
+            self._message_buckets(user_hash, cost=0.0) + self._llm_buckets(user_hash, cost=0.0),
+            dry_run=True
+        )
+        _, messages, llm_global, llm = result.remaining
+        return {
+            "messages": messages,
+            "messages_burst": self.user_burst,
+            "messages_refill": 1 / self.user_rate,
+            "llm": llm,
+            "llm_burst": self.llm_user_burst,
+            "llm_refill": 1 / self.llm_user_rate,
+            "llm_global": llm_global
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "admitted": self.stats[ADMITTED],
+            "rate_limited": self.stats[RATE_LIMITED],
+            "too_fast": self.stats[TOO_FAST],
+            "llm_granted": self.stats["llm_granted"],
+            "llm_denied": self.stats["llm_denied"],
+            "llm_refunded": self.stats["llm_refunded"]
+        }
+
+    def metrics_text(self) -> str:
+        """Decisiones de cuota en formato de texto de Prometheus"""
+        lines = [
+            "# HELP unsa_bot_quota_decisions_total Mensajes y respuestas de la IA según la cuota",
+            "# TYPE unsa_bot_quota_decisions_total counter"
+        ]
+        for key, value in self.snapshot().items():
+            lines.append(f'unsa_bot_quota_decisions_total{{decision="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
@@ -3,21 +3,105 @@ import asyncio
 import time
 import re
 import logging
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import asyncpg
 from .models import SearchResult, ResponseMode
 from .config import logger
+from .usage_counter import UsageCounter
+
+FRAGMENT_COLUMNS = "id, contenido, categoria, facultad, palabras_clave, descripcion"
+
+# En consultas de carreras ($n = true), primero los fragmentos que son carreras
+CARRERA_ORDER = """
+    CASE WHEN NOT ${carrera} THEN 0
+        WHEN contenido ILIKE '%carrera%' THEN 1
+        WHEN contenido ILIKE '%licenciatura%' THEN 2
+        WHEN contenido ILIKE '%profesorado%' THEN 3
+        WHEN contenido ILIKE '%tecnicatura%' THEN 4
+        ELSE 5
+    END"""
+
+# Consultas de forma fija: los términos viajan como text[], así el texto SQL no
+# cambia con la cantidad de términos. Se preparan una vez por conexión del pool
+# (_prepare_connection) y después salen del caché de sentencias de asyncpg.
+STATEMENTS = {
+    "top": f"""
+        SELECT {FRAGMENT_COLUMNS}
+        FROM fragmentos_conocimiento
+        ORDER BY usado_count DESC
+        LIMIT $1
+    """,
+    "general": f"""
+        SELECT {FRAGMENT_COLUMNS}
+        FROM fragmentos_conocimiento
+        WHERE LOWER(categoria) LIKE ANY(ARRAY['%carrera%', '%beca%'])
+        ORDER BY usado_count DESC, relevancia DESC
+        LIMIT $1
+    """,
+    # $1: términos unidos con "or" para websearch_to_tsquery; ts_rank_cd con
+    # normalización 32 (rank / (rank + 1)) da un score entre 0 y 1
+    "fts": f"""
+        SELECT {FRAGMENT_COLUMNS},
+               ts_rank_cd(contenido_tsvector, consulta, 32) AS score
+        FROM fragmentos_conocimiento, websearch_to_tsquery('spanish', $1) AS consulta
+        WHERE contenido_tsvector @@ consulta
+        ORDER BY {CARRERA_ORDER.format(carrera=2)}, score DESC, usado_count DESC
+        LIMIT $3
+    """,
+    # $1: términos, $2: los mismos como '%término%'. LIKE ANY y % ANY usan los
+    # índices GIN de trigramas (un bitmap scan por elemento del arreglo)
+    "trigram": f"""
+        SELECT {FRAGMENT_COLUMNS},
+               GREATEST(similarity(contenido_norm, ($1::text[])[1]),
+                        COALESCE(similarity(descripcion_norm, ($1::text[])[1]), 0)) AS score
+        FROM fragmentos_conocimiento
+        WHERE contenido_norm LIKE ANY($2::text[]) OR descripcion_norm LIKE ANY($2::text[])
+           OR contenido_norm % ANY($1::text[]) OR descripcion_norm % ANY($1::text[])
+           OR palabras_clave && $1::varchar[]
+        ORDER BY {CARRERA_ORDER.format(carrera=3)}, score DESC, usado_count DESC
+        LIMIT $4
+    """,
+    "by_ids": f"""
+        SELECT {FRAGMENT_COLUMNS}
+        FROM fragmentos_conocimiento
+        WHERE id = ANY($1::int[])
+    """
+}
+
+# Argumentos que no devuelven filas, para preparar cada consulta al abrir la conexión
+WARMUP_ARGS = {
+    "top": (0,),
+    "general": (0,),
+    "fts": ("", False, 0),
+    "trigram": ([], [], False, 0),
+    "by_ids": ([],)
+}
 
 class PostgresRetriever:
-    def __init__(self, db_url: str, debug_mode: bool = False):
+    def __init__(self, db_url: str, debug_mode: bool = False,
+                 usage_flush_interval: float = 5.0, usage_max_pending: int = 500,
+                 similarity_threshold: float = 0.3, fts: bool = True):
         self.db_url = db_url
+        self.similarity_threshold = similarity_threshold
+        # Se confirma al preparar las consultas que exista la columna contenido_tsvector
+        self.fts = fts
+        self.fts_enabled = False
         self.pool = None
         self.connected = False
         self.debug_mode = debug_mode
+        # usado_count se escribe en lote y en segundo plano, fuera del camino de la respuesta
+        self.usage = UsageCounter(
+            lambda: self.pool if self.connected else None,
+            flush_interval=usage_flush_interval,
+            max_pending=usage_max_pending
+        )
         self.stats = {
             "queries": 0,
             "errors": 0,
-            "fragments": 0
+            "fragments": 0,
+            "fts": 0,
+            "fts_fallbacks": 0,
+            "prepared_connections": 0
         }
         self.last_connect_attempt = 0
         self.connect_retry_delay = 2  # segundos entre reintentos
@@ -78,7 +162,10 @@ class PostgresRetriever:
                 self.db_url,
                 min_size=2,
                 max_size=20,
-                command_timeout=30
+                command_timeout=30,
+                # Umbral del operador % de pg_trgm en cada conexión del pool
+                server_settings={"pg_trgm.similarity_threshold": str(self.similarity_threshold)},
+                init=self._prepare_connection
             )
             async with self.pool.acquire() as conn:
                 if self.debug_mode:
@@ -90,7 +177,10 @@ class PostgresRetriever:
                 self.stats["fragments"] = await conn.fetchval(
                     "SELECT COUNT(*) FROM fragmentos_conocimiento"
                 )
+                if self.fts and not self.fts_enabled:
+                    logger.warning("⚠️ Sin contenido_tsvector: búsqueda solo por trigramas (aplicar migration_005)")
                 self.connected = True
+                self.usage.start()
                 logger.info("✅ PostgreSQL conectado | Fragmentos: %d", self.stats["fragments"])
                 return True
         except Exception as e:
@@ -98,10 +188,66 @@ class PostgresRetriever:
             logger.error("❌ PostgreSQL error: %s", str(e))
             return False
 
+    async def _prepare_connection(self, conn):
+        """
+        init del pool: prepara las consultas de STATEMENTS en cada conexión nueva.
+        Se ejecutan con argumentos que no devuelven filas; el parse y el plan
+        quedan en el caché de sentencias de la conexión para los mensajes.
+        """
+        started = time.perf_counter()
+        prepared = []
+        for name, sql in STATEMENTS.items():
+            if name == "fts" and not self.fts:
+                continue
+            try:
+                await conn.fetch(sql, *WARMUP_ARGS[name])
+                prepared.append(name)
+            except asyncpg.PostgresError as e:
+                # Sin migration_005 la de texto completo no existe: se avisa una sola vez al conectar
+                if name != "fts":
+                    logger.warning("⚠️ No se pudo preparar la consulta %s: %s", name, str(e))
+        if self.fts:
+            self.fts_enabled = "fts" in prepared
+        self.stats["prepared_connections"] += 1
+        logger.info(
+            "🧩 Conexión %d: %d consultas preparadas en %.1f ms (%s)",
+            conn.get_server_pid(), len(prepared), (time.perf_counter() - started) * 1000, ", ".join(prepared)
+        )
+
+    async def plan_stats(self) -> dict:
+        """
+        Planes genéricos y a medida de las consultas preparadas en una conexión
+        del pool (pg_prepared_statements es por sesión; PostgreSQL 14+).
+        """
+        if not self.connected:
+            return {}
+        try:
+            async with self.pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    """
+                    SELECT count(*) AS statements,
+                           coalesce(sum(generic_plans), 0)::bigint AS generic_plans,
+                           coalesce(sum(custom_plans), 0)::bigint AS custom_plans
+                    FROM pg_prepared_statements
+                    WHERE statement = ANY($1::text[])
+                    """,
+                    list(STATEMENTS.values())
+                )
+        except Exception as e:
+            logger.debug("No se pudieron leer los planes preparados: %s", str(e))
+            return {}
+        stats = dict(row)
+        logger.info(
+            "🧩 Planes de búsqueda: %d consultas · %d genéricos · %d a medida",
+            stats["statements"], stats["generic_plans"], stats["custom_plans"]
+        )
+        return stats
+
     async def disconnect(self):
         """Cerrar conexión pool al apagar"""
         if self.pool:
             try:
+                await self.usage.stop()
                 await self.pool.close()
                 self.connected = False
                 logger.info("✅ Pool PostgreSQL cerrado")
@@ -192,6 +338,23 @@ class PostgresRetriever:
                  return True
         return False
 
+    async def _search_fts(self, conn, terms: List[str], is_carrera_query: bool, limit: int) -> list:
+        """
+        Búsqueda de texto completo en español sobre contenido_tsvector (migration_005).
+        Los términos van unidos con "or" y ts_rank_cd premia los fragmentos que
+        tienen varios, cercanos y en las partes de más peso (nombre, palabras clave).
+        """
+        return await conn.fetch(STATEMENTS["fts"], " or ".join(terms), is_carrera_query, limit)
+
+    async def _search_trigram(self, conn, terms: List[str], is_carrera_query: bool, limit: int) -> list:
+        """
+        Búsqueda por coincidencia parcial, trigramas y palabras clave (migration_004).
+        Los términos ya vienen en minúsculas y sin acentos, igual que las columnas *_norm.
+        """
+        return await conn.fetch(
+            STATEMENTS["trigram"], terms, [f"%{t}%" for t in terms], is_carrera_query, limit
+        )
+
     async def retrieve(
         self, query: str, limit: int = 20
     ) -> Tuple[str, List[SearchResult], ResponseMode]:
@@ -207,83 +370,17 @@ class PostgresRetriever:
 
             async with self.pool.acquire() as conn:
                 if not terms and not is_general_query:
-                    rows = await conn.fetch(
-                        """
-                        SELECT id, contenido, categoria, facultad, palabras_clave, descripcion -- Añadido descripcion
-                        FROM fragmentos_conocimiento
-                        ORDER BY usado_count DESC
-                        LIMIT $1
-                        """,
-                        limit
-                    )
+                    rows = await conn.fetch(STATEMENTS["top"], limit)
                 elif is_general_query:
                     logger.debug(f"Consulta general detectada: '{query}', buscando carreras o becas...")
-                    rows = await conn.fetch(
-                        """
-                        SELECT id, contenido, categoria, facultad, palabras_clave, descripcion -- Añadido descripcion
-                        FROM fragmentos_conocimiento
-                        WHERE LOWER(categoria) LIKE ANY(ARRAY['%carrera%', '%beca%'])
-                        ORDER BY usado_count DESC, relevancia DESC
-                        LIMIT $1
-                        """,
-                        limit
-                    )
+                    rows = await conn.fetch(STATEMENTS["general"], limit)
                 else:
-                    # --- Lógica de búsqueda principal, ahora incluyendo 'descripcion' ---
-                    similarity_conditions = []
-                    ilike_conditions = []
-                    keyword_conditions = []
-                    params = []
-
-                    for i, term in enumerate(terms):
-                        # ILIKE: Buscar en contenido Y descripcion (si existe y no es NULL)
-                        # La cláusula OR maneja el caso de descripcion NULL
-                        ilike_conditions.append(f"(contenido ILIKE unaccent(${len(params) + 1}) OR (descripcion IS NOT NULL AND descripcion ILIKE unaccent(${len(params) + 1})))")
-                        params.append(f"%{term}%")
-
-                        # Similarity: Calcular similitud en contenido Y descripcion, tomar el máximo
-                        # COALESCE maneja el caso de que descripcion sea NULL, devolviendo 0 para similarity
-                        similarity_conditions.append(f"GREATEST(similarity(unaccent(contenido), unaccent(${len(params) + 1}::text)), COALESCE(similarity(unaccent(descripcion), unaccent(${len(params) + 1}::text)), 0)) > 0.3")
-                        params.append(term)
-
-                        # Keyword: Buscar en palabras_clave
-                        keyword_conditions.append(f"${len(params) + 1} = ANY(palabras_clave)")
-                        params.append(term)
-
-                    all_conditions = " OR ".join(ilike_conditions + similarity_conditions + keyword_conditions)
-
-                    if is_carrera_query:
-                         order_clause = """
-                             CASE
-                                 WHEN contenido ILIKE '%carrera%' THEN 1
-                                 WHEN contenido ILIKE '%licenciatura%' THEN 2
-                                 WHEN contenido ILIKE '%profesorado%' THEN 3
-                                 WHEN contenido ILIKE '%tecnicatura%' THEN 4
-                                 ELSE 5
-                             END,
-                             GREATEST(similarity(unaccent(contenido), unaccent(${len(params) + 1}::text)), COALESCE(similarity(unaccent(descripcion), unaccent(${len(params) + 1}::text)), 0), 0) DESC,
-                             usado_count DESC
-                         """
-                         params.append(terms[0]) # Parámetro para similarity en ORDER BY
-                         similarity_param_index = len(params)
-                    else:
-                        order_clause = "GREATEST(similarity(unaccent(contenido), unaccent(${len(params) + 1}::text)), COALESCE(similarity(unaccent(descripcion), unaccent(${len(params) + 1}::text)), 0), 0) DESC, usado_count DESC"
-                        params.append(terms[0]) # Parámetro para similarity en ORDER BY
-                        similarity_param_index = len(params)
-
-                    params.append(limit)
-
-                    sql = f"""
-                    SELECT id, contenido, categoria, facultad, palabras_clave, descripcion -- Añadido descripcion
-                    FROM fragmentos_conocimiento
-                    WHERE {all_conditions}
-                    ORDER BY {order_clause}
-                    LIMIT ${similarity_param_index}
-                    """
-                    rows = await conn.fetch(sql, *params)
-
-                if not rows:
-                    return "No se encontró información.", [], ResponseMode.FALLBACK
+                    rows = []
+                    if self.fts_enabled:
+                        rows = await self._search_fts(conn, terms, is_carrera_query, limit)
+                        self.stats["fts" if rows else "fts_fallbacks"] += 1
+                    if not rows:
+                        rows = await self._search_trigram(conn, terms, is_carrera_query, limit)
 
                 # Mapear resultados, ahora incluyendo la descripcion
                 results = [
@@ -292,34 +389,68 @@ class PostgresRetriever:
                         content=r["contenido"],
                         category=r["categoria"],
                         faculty=r["facultad"],
-                        score=1.0,
+                        score=r.get("score", 1.0),
                         keywords=r["palabras_clave"] or [],
                         description=r["descripcion"] # <-- Nuevo campo mapeado
                     )
                     for r in rows
                 ]
+                return self._respond(results, is_carrera_query)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error("❌ Retrieve error: %s", str(e))
+            return "Error consultando la base.", [], ResponseMode.FALLBACK
 
-                for r in results:
-                    await conn.execute(
-                        "UPDATE fragmentos_conocimiento SET usado_count = usado_count + 1 WHERE id = $1",
-                        r.id
-                    )
+    def _respond(
+        self, results: List[SearchResult], is_carrera_query: bool
+    ) -> Tuple[str, List[SearchResult], ResponseMode]:
+        """Contexto y modo de respuesta para los fragmentos encontrados"""
+        if not results:
+            return "No se encontró información.", [], ResponseMode.FALLBACK
 
-                context = "\n".join(r.content for r in results)
-                total_len = sum(len(r.content) for r in results)
+        self.usage.add(r.id for r in results)
 
-                if is_carrera_query and total_len < 1200:
-                    mode = ResponseMode.DIRECT
-                elif total_len < 800:
-                    mode = ResponseMode.DIRECT
-                else:
-                    mode = ResponseMode.LLM
+        context = "\n".join(r.content for r in results)
+        total_len = sum(len(r.content) for r in results)
+
+        if is_carrera_query and total_len < 1200:
+            mode = ResponseMode.DIRECT
+        elif total_len < 800:
+            mode = ResponseMode.DIRECT
+        else:
+            mode = ResponseMode.LLM
 
-                return context, results, mode
+        return context, results, mode
+
+    def index_snapshot(self) -> Optional[dict]:
+        """Estado del índice en memoria (solo InMemoryRetriever)"""
+        return None
+
+    async def fetch_by_ids(self, ids: List[int]) -> List[SearchResult]:
+        """Fragmentos por id en el orden pedido (para rearmar resultados guardados en la sesión)"""
+        if not ids or not await self.connect():
+            return []
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(STATEMENTS["by_ids"], list(ids))
         except Exception as e:
             self.stats["errors"] += 1
-            logger.error("❌ Retrieve error: %s", str(e))
-            return "Error consultando la base.", [], ResponseMode.FALLBACK
+            logger.error("❌ Error leyendo fragmentos por id: %s", str(e))
+            return []
+
+        by_id = {
+            r["id"]: SearchResult(
+                id=r["id"],
+                content=r["contenido"],
+                category=r["categoria"],
+                faculty=r["facultad"],
+                score=1.0,
+                keywords=r["palabras_clave"] or [],
+                description=r["descripcion"]
+            )
+            for r in rows
+        }
+        return [by_id[i] for i in ids if i in by_id]
 
     def build_direct_response(self, results: List[SearchResult]) -> str:
         if not results:
@@ -332,3 +463,16 @@ class PostgresRetriever:
                  part += f" [{r.description}]"
             response_parts.append(part)
         return "\n\n".join(response_parts)
+
+def create_retriever(backend: str, db_url: str, **options) -> PostgresRetriever:
+    """Retriever según RETRIEVER_BACKEND"""
+    if backend == "postgres":
+        retriever = PostgresRetriever(db_url, **options)
+    elif backend == "memory":
+        # Importado acá: memory_retriever extiende PostgresRetriever
+        from .memory_retriever import InMemoryRetriever
+        retriever = InMemoryRetriever(db_url, **options)
+    else:
+        raise ValueError(f"RETRIEVER_BACKEND desconocido: {backend} (opciones: postgres, memory)")
+    logger.info("✅ Búsqueda en backend %s", backend)
+    return retriever
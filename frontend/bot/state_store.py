@@ -0,0 +1,406 @@
+import asyncio
+import json
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from typing import Any, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+from .config import logger
+
+# Resultado del control de un mensaje entrante
+ADMITTED, RATE_LIMITED, TOO_FAST = "ok", "limit", "spam"
+
+class Bucket(NamedTuple):
+    """Token bucket: `rate` fichas por segundo hasta `burst`; la operación consume `cost`"""
+    key: str
+    rate: float
+    burst: float
+    cost: float = 1.0
+
+class TokenResult(NamedTuple):
+    allowed: bool
+    remaining: List[float]   # fichas de cada bucket después de la operación
+    retry_after: float       # segundos hasta que alcance (0 si se permitió)
+
+def _refill(state: Optional[Tuple[float, float]], bucket: Bucket, now: float) -> float:
+    """Fichas disponibles; sin estado guardado el bucket está lleno"""
+    if state is None:
+        return bucket.burst
+    tokens, updated = state
+    return min(bucket.burst, tokens + (now - updated) * bucket.rate)
+
+class StateStore(ABC):
+    """
+    Estado por usuario del bot (sesiones, anti-spam, usuarios activos).
+
+    Los valores se guardan por (namespace, key) con TTL y deben ser chicos y
+    serializables (ids, números, tuplas), no objetos completos: así el mismo
+    código sirve para un backend compartido entre procesos.
+    """
+
+    @abstractmethod
+    async def get(self, namespace: str, key: Hashable) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def set(self, namespace: str, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: Hashable):
+        ...
+
+    @abstractmethod
+    async def count(self, namespace: str) -> int:
+        """Entradas vigentes del namespace"""
+
+    @abstractmethod
+    async def take_tokens(self, buckets: Sequence[Bucket], dry_run: bool = False) -> TokenResult:
+        """
+        Consume `cost` de todos los buckets o de ninguno. Cada bucket guarda
+        solo (fichas, actualizado) y vence cuando se habría llenado de nuevo,
+        así las claves inactivas no ocupan lugar. dry_run: solo consulta.
+        """
+
+    @abstractmethod
+    async def admit_message(self, user_hash: str, min_interval: float, active_ttl: float,
+                            buckets: Sequence[Bucket]) -> Tuple[str, float]:
+        """
+        Control completo de un mensaje entrante: anti-spam (`min_interval`
+        entre mensajes), cuotas (`buckets`), usuario activo y contador de
+        mensajes. Devuelve (ADMITTED | RATE_LIMITED | TOO_FAST, segundos de espera).
+        """
+
+    @abstractmethod
+    async def message_count(self) -> int:
+        ...
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    def snapshot(self) -> dict:
+        ...
+
+def _sizeof(value: Any) -> int:
+    """Tamaño aproximado en bytes: el objeto y, si es una colección plana, sus elementos"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+class MemoryStateStore(StateStore):
+    """
+    Estado en memoria del proceso, acotado: a lo sumo `max_entries` entradas
+    (se desaloja la menos usada) y cada una vence a su TTL. Los vencidos se
+    descartan al leerlos y en un barrido cada `sweep_interval` segundos.
+    """
+
+    def __init__(self, max_entries: int = 50000, default_ttl: float = 3600.0,
+                 sweep_interval: float = 60.0):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.sweep_interval = sweep_interval
+        # (namespace, key) -> (vence, valor, bytes)
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[float, Any, int]]" = OrderedDict()
+        self._per_namespace = Counter()
+        self._bytes = 0
+        self._last_sweep = time.monotonic()
+        self.messages = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def _remove(self, entry_key: Tuple[str, Hashable]):
+        _, _, size = self._entries.pop(entry_key)
+        self._per_namespace[entry_key[0]] -= 1
+        self._bytes -= size
+
+    def _sweep(self, now: float):
+        expired = [k for k, (expires_at, _, _) in self._entries.items() if expires_at <= now]
+        for entry_key in expired:
+            self._remove(entry_key)
+        self.stats["expirations"] += len(expired)
+        self._last_sweep = now
+
+    async def get(self, namespace: str, key: Hashable) -> Optional[Any]:
+        entry_key = (namespace, key)
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(entry_key)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(entry_key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    async def set(self, namespace: str, key: Hashable, value: Any, ttl: Optional[float] = None):
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._sweep(now)
+
+        entry_key = (namespace, key)
+        if entry_key in self._entries:
+            self._remove(entry_key)
+        size = _sizeof(key) + _sizeof(value)
+        self._entries[entry_key] = (now + (ttl if ttl is not None else self.default_ttl), value, size)
+        self._per_namespace[namespace] += 1
+        self._bytes += size
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    async def delete(self, namespace: str, key: Hashable):
+        if (namespace, key) in self._entries:
+            self._remove((namespace, key))
+
+    async def count(self, namespace: str) -> int:
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._sweep(now)
+        return self._per_namespace[namespace]
+
+    async def take_tokens(self, buckets: Sequence[Bucket], dry_run: bool = False) -> TokenResult:
+        now = time.time()
+        levels = [_refill(await self.get("tokens", b.key), b, now) for b in buckets]
+        retry_after = max(((b.cost - tokens) / b.rate for b, tokens in zip(buckets, levels) if tokens < b.cost),
+                          default=0.0)
+        if retry_after or dry_run:
+            return TokenResult(not retry_after, levels, retry_after)
+        remaining = []
+        for b, tokens in zip(buckets, levels):
+            left = min(b.burst, tokens - b.cost)  # costo negativo: devolución
+            await self.set("tokens", b.key, (left, now), ttl=(b.burst - left) / b.rate)
+            remaining.append(left)
+        return TokenResult(True, remaining, 0.0)
+
+    async def admit_message(self, user_hash: str, min_interval: float, active_ttl: float,
+                            buckets: Sequence[Bucket]) -> Tuple[str, float]:
+        now = time.time()
+        last = await self.get("last_message", user_hash) or 0
+        if now - last < min_interval:
+            return TOO_FAST, min_interval - (now - last)
+        # También si lo frena la cuota: así insistir no genera un aviso por mensaje
+        await self.set("last_message", user_hash, now, ttl=min_interval)
+
+        result = await self.take_tokens(buckets)
+        if not result.allowed:
+            return RATE_LIMITED, result.retry_after
+        await self.set("active_users", user_hash, 1, ttl=active_ttl)
+        self.messages += 1
+        return ADMITTED, 0.0
+
+    async def message_count(self) -> int:
+        return self.messages
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "backend": "memory",
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            # Incluye el overhead aproximado del OrderedDict por entrada
+            "bytes": self._bytes + len(self._entries) * 100,
+            "namespaces": {ns: n for ns, n in self._per_namespace.items() if n},
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+class PostgresStateStore(StateStore):
+    """
+    Estado compartido entre procesos y hosts, en tablas UNLOGGED de PostgreSQL
+    (migraciones 002 y 003). Usa el pool de asyncpg del retriever.
+
+    Cada operación es una sola sentencia: upserts atómicos para escribir y
+    `bot_admitir_mensaje` para todo el control de un mensaje entrante. Si la
+    base no responde, las lecturas devuelven None y los mensajes se admiten
+    (mejor un rate limit flojo un rato que un bot mudo).
+    """
+
+    def __init__(self, retriever, sweep_interval: float = 60.0, default_ttl: float = 3600.0):
+        self.retriever = retriever
+        self.sweep_interval = sweep_interval
+        self.default_ttl = default_ttl
+        self._sweeper: Optional[asyncio.Task] = None
+        self.entries = 0
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "errors": 0}
+
+    @property
+    def pool(self):
+        return self.retriever.pool if self.retriever.connected else None
+
+    def _error(self, operation: str, e: Exception):
+        self.stats["errors"] += 1
+        logger.warning("⚠️ Estado en PostgreSQL: error en %s: %s", operation, str(e))
+
+    async def start(self):
+        if self.pool is None:
+            logger.error("❌ STATE_BACKEND=postgres sin conexión a la base: el estado no se compartirá")
+        else:
+            try:
+                if not await self.pool.fetchval("SELECT to_regproc('bot_tomar_fichas') IS NOT NULL"):
+                    logger.error("❌ Falta el esquema del estado: aplicar database/migrations/migration_002_estado_bot.sql"
+                                 " y migration_003_cuotas_bot.sql")
+            except Exception as e:
+                self._error("start", e)
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def _sweep_loop(self):
+        """Borra vencidos y actualiza tamaño para /diagnose"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            if self.pool is None:
+                continue
+            try:
+                async with self.pool.acquire() as conn:
+                    self.stats["expirations"] += await conn.fetchval("SELECT bot_limpiar_estado()")
+                    self.entries, self.bytes = await conn.fetchrow(
+                        "SELECT (SELECT COUNT(*) FROM bot_estado) + (SELECT COUNT(*) FROM bot_limites)"
+                        " + (SELECT COUNT(*) FROM bot_fichas), pg_total_relation_size('bot_estado')"
+                        " + pg_total_relation_size('bot_limites') + pg_total_relation_size('bot_fichas')"
+                    )
+            except Exception as e:
+                self._error("limpieza", e)
+
+    async def get(self, namespace: str, key: Hashable) -> Optional[Any]:
+        if self.pool is None:
+            return None
+        try:
+            raw = await self.pool.fetchval(
+                "SELECT valor FROM bot_estado WHERE espacio = $1 AND clave = $2 AND vence > now()",
+                namespace, str(key)
+            )
+        except Exception as e:
+            self._error("get", e)
+            return None
+        if raw is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return json.loads(raw)
+
+    async def set(self, namespace: str, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if self.pool is None:
+            return
+        try:
+            await self.pool.execute(
+                """
+                INSERT INTO bot_estado (espacio, clave, valor, vence)
+                VALUES ($1, $2, $3::jsonb, now() + make_interval(secs => $4))
+                ON CONFLICT (espacio, clave) DO UPDATE
+                SET valor = EXCLUDED.valor, vence = EXCLUDED.vence
+                """,
+                namespace, str(key), json.dumps(value), float(ttl if ttl is not None else self.default_ttl)
+            )
+        except Exception as e:
+            self._error("set", e)
+
+    async def delete(self, namespace: str, key: Hashable):
+        if self.pool is None:
+            return
+        try:
+            await self.pool.execute(
+                "DELETE FROM bot_estado WHERE espacio = $1 AND clave = $2", namespace, str(key)
+            )
+        except Exception as e:
+            self._error("delete", e)
+
+    async def count(self, namespace: str) -> int:
+        if self.pool is None:
+            return 0
+        try:
+            return await self.pool.fetchval(
+                "SELECT COUNT(*) FROM bot_estado WHERE espacio = $1 AND vence > now()", namespace
+            )
+        except Exception as e:
+            self._error("count", e)
+            return 0
+
+    @staticmethod
+    def _bucket_args(buckets: Sequence[Bucket]) -> tuple:
+        return (
+            [b.key for b in buckets],
+            [float(b.rate) for b in buckets],
+            [float(b.burst) for b in buckets],
+            [float(b.cost) for b in buckets]
+        )
+
+    async def take_tokens(self, buckets: Sequence[Bucket], dry_run: bool = False) -> TokenResult:
+        if self.pool is None:
+            return TokenResult(True, [b.burst for b in buckets], 0.0)
+        try:
+            row = await self.pool.fetchrow(
+                "SELECT permitido, niveles, espera FROM bot_tomar_fichas($1, $2, $3, $4, $5)",
+                *self._bucket_args(buckets), dry_run
+            )
+        except Exception as e:
+            self._error("take_tokens", e)
+            return TokenResult(True, [b.burst for b in buckets], 0.0)
+        return TokenResult(row["permitido"], list(row["niveles"]), row["espera"])
+
+    async def admit_message(self, user_hash: str, min_interval: float, active_ttl: float,
+                            buckets: Sequence[Bucket]) -> Tuple[str, float]:
+        if self.pool is None:
+            return ADMITTED, 0.0
+        try:
+            row = await self.pool.fetchrow(
+                "SELECT resultado, espera FROM bot_admitir_mensaje($1, $2, $3, $4, $5, $6, $7)",
+                user_hash, float(min_interval), float(active_ttl), *self._bucket_args(buckets)
+            )
+        except Exception as e:
+            self._error("admit_message", e)
+            return ADMITTED, 0.0
+        return row["resultado"], row["espera"]
+
+    async def message_count(self) -> int:
+        if self.pool is None:
+            return 0
+        try:
+            return await self.pool.fetchval(
+                "SELECT COALESCE(SUM(valor), 0)::bigint FROM bot_contadores WHERE nombre = 'messages'"
+            )
+        except Exception as e:
+            self._error("message_count", e)
+            return 0
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "backend": "postgres",
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+def create_state_store(backend: str, retriever=None, **options) -> StateStore:
+    """Backend del estado según STATE_BACKEND"""
+    if backend == "memory":
+        store = MemoryStateStore(**options)
+    elif backend == "postgres":
+        if retriever is None:
+            raise ValueError("STATE_BACKEND=postgres necesita el retriever (pool de asyncpg)")
+        options.pop("max_entries", None)  # el tamaño lo acota el TTL, no un máximo de entradas
+        store = PostgresStateStore(retriever, **options)
+    else:
+        raise ValueError(f"STATE_BACKEND desconocido: {backend} (opciones: memory, postgres)")
+    logger.info("✅ Estado del bot en backend %s", backend)
+    return store
@@ -0,0 +1,323 @@
+import asyncio
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Optional
+
+import httpx
+from telegram import Bot, Message
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from ..config import logger
+
+ANSWER, EDIT, ACTION = 0, 1, 2           # prioridad: menor sale primero
+KIND_NAMES = {ANSWER: "answer", EDIT: "edit", ACTION: "action"}
+TYPING_TTL = 4.5                         # Telegram muestra "escribiendo..." unos 5s
+MAX_SEND_ATTEMPTS = 3
+# Errores de httpx que ocurren antes de mandar el pedido: Telegram nunca lo recibió
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+def _not_sent(error: NetworkError) -> bool:
+    return isinstance(error.__cause__, NOT_SENT_ERRORS)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Segundos hasta tener un token (0 si ya hay)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        """Sin envíos recientes que recordar: recrearlo daría lo mismo"""
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+class _Item:
+    __slots__ = ("kind", "chat_id", "payload", "future", "enqueued_at", "attempts")
+
+    def __init__(self, kind: int, chat_id: int, payload: dict):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.payload = payload
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Quien encola y no espera el resultado no debe generar "exception was never retrieved"
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class _ChatQueue:
+    def __init__(self, rate: float, burst: float):
+        self.items: Deque[_Item] = deque()
+        self.typing: Optional[_Item] = None
+        self.last_typing = 0.0
+        self.bucket = TokenBucket(rate, burst)
+        self.blocked_until = 0.0
+        self.busy = False
+
+    def head(self) -> Optional[_Item]:
+        # Con una respuesta pendiente la acción "escribiendo" ya no aporta nada
+        return self.items[0] if self.items else self.typing
+
+class Outbox:
+    """
+    Cola de salida hacia Telegram. Los handlers encolan y siguen; un único
+    dispatcher envía respetando un token bucket global (~30 msg/s por bot) y
+    otro por chat (~1 msg/s), de a un envío por chat para mantener el orden.
+
+    - Prioridad: respuestas, después ediciones de streaming, después acciones
+    - Una edición pendiente del mismo mensaje se reemplaza por la más nueva
+    - "Escribiendo..." se descarta si ya hay uno pendiente o se mandó hace poco
+    - RetryAfter frena ese chat lo que pida Telegram y se reintenta el envío
+    - Un mensaje nuevo se reintenta por red solo si el pedido no llegó a salir
+      (un TimedOut puede haberse entregado igual); ediciones y acciones siempre
+    """
+
+    def __init__(self, global_rate: float = 25.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_in_flight: int = 16, latency_window: int = 500):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_in_flight = max_in_flight
+        self.bot: Optional[Bot] = None
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._pending_edits: Dict[tuple, _Item] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sends: set = set()
+        self.pending = 0
+        self.stats = Counter()
+        self._latencies = deque(maxlen=latency_window)
+
+    async def start(self, bot: Bot):
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch_loop())
+            logger.info("✅ Outbox de Telegram iniciado")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Envía lo pendiente (hasta drain_timeout) y detiene el dispatcher"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + drain_timeout
+        while (self.pending or self._sends) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            logger.warning(f"⚠️ Outbox detenido con {self.pending} envíos pendientes")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        for chat in self._chats.values():
+            for item in list(chat.items) + ([chat.typing] if chat.typing else []):
+                item.future.cancel()
+        self._chats.clear()
+        self._pending_edits.clear()
+        self.pending = 0
+
+    # ---------- Encolar ----------
+    def _chat(self, chat_id: int) -> _ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(self.chat_rate, self.chat_burst)
+        return chat
+
+    def _enqueue(self, item: _Item) -> asyncio.Future:
+        chat = self._chat(item.chat_id)
+        if item.kind == ACTION:
+            chat.typing = item
+        else:
+            if chat.typing is not None:
+                # Ya hay algo para mostrar: el "escribiendo..." pendiente sobra
+                chat.typing.future.cancel()
+                chat.typing = None
+                self.pending -= 1
+                self.stats["dropped_actions"] += 1
+            chat.items.append(item)
+        self.pending += 1
+        self._wakeup.set()
+        return item.future
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Encola un mensaje; el future resuelve al Message enviado"""
+        return self._enqueue(_Item(ANSWER, chat_id, {"text": text, **kwargs}))
+
+    def edit_message(self, message: Message, text: str, **kwargs) -> asyncio.Future:
+        """Encola la edición; si ya había una pendiente del mismo mensaje, solo se actualiza el texto"""
+        key = (message.chat_id, message.message_id)
+        pending = self._pending_edits.get(key)
+        if pending is not None and not pending.future.done():
+            pending.payload.update(text=text, **kwargs)
+            self.stats["merged_edits"] += 1
+            return pending.future
+        item = _Item(EDIT, message.chat_id, {"message_id": message.message_id, "text": text, **kwargs})
+        self._pending_edits[key] = item
+        return self._enqueue(item)
+
+    def send_typing(self, chat_id: int):
+        chat = self._chat(chat_id)
+        if chat.typing is not None or chat.items or time.monotonic() - chat.last_typing < TYPING_TTL:
+            self.stats["dropped_actions"] += 1
+            return
+        self._enqueue(_Item(ACTION, chat_id, {"action": ChatAction.TYPING}))
+
+    # ---------- Dispatcher ----------
+    def _next_ready(self, now: float):
+        """(chat, item) a enviar ahora, o (None, segundos hasta el próximo elegible)"""
+        best = None
+        next_at = None
+        idle = []
+        for chat_id, chat in self._chats.items():
+            item = chat.head()
+            if chat.busy:
+                continue
+            if item is None:
+                # Borrarlo antes perdería la pausa de un RetryAfter o los envíos recientes del bucket
+                if now - chat.last_typing >= TYPING_TTL and now >= chat.blocked_until and chat.bucket.full(now):
+                    idle.append(chat_id)
+                continue
+            ready_at = max(chat.blocked_until, now + chat.bucket.wait_time(now))
+            if ready_at > now:
+                next_at = ready_at if next_at is None else min(next_at, ready_at)
+                continue
+            key = (item.kind, item.enqueued_at)
+            if best is None or key < best[0]:
+                best = (key, chat, item)
+        for chat_id in idle:
+            del self._chats[chat_id]
+        if best is None:
+            return None, (next_at - now if next_at is not None else None)
+        return (best[1], best[2]), 0.0
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = None
+            if len(self._sends) < self.max_in_flight:
+                ready, wait = self._next_ready(now)
+                if ready is not None:
+                    global_wait = self.global_bucket.wait_time(now)
+                    if global_wait > 0:
+                        await asyncio.sleep(global_wait)
+                        continue
+                    chat, item = ready
+                    self.global_bucket.take(now)
+                    chat.bucket.take(now)
+                    chat.busy = True
+                    if item.kind == ACTION:
+                        chat.typing = None
+                    else:
+                        chat.items.popleft()
+                    task = asyncio.create_task(self._send(chat, item))
+                    self._sends.add(task)
+                    task.add_done_callback(self._sends.discard)
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, chat: _ChatQueue, item: _Item):
+        requeue = False
+        try:
+            item.attempts += 1
+            if item.kind == ANSWER:
+                result = await self.bot.send_message(chat_id=item.chat_id, **item.payload)
+            elif item.kind == EDIT:
+                self._pending_edits.pop((item.chat_id, item.payload["message_id"]), None)
+                result = await self.bot.edit_message_text(chat_id=item.chat_id, **item.payload)
+            else:
+                result = await self.bot.send_chat_action(chat_id=item.chat_id, **item.payload)
+                chat.last_typing = time.monotonic()
+            self.stats[f"sent_{KIND_NAMES[item.kind]}"] += 1
+            self._latencies.append(time.monotonic() - item.enqueued_at)
+            item.future.set_result(result)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+            chat.blocked_until = time.monotonic() + retry_after
+            self.stats["retry_after"] += 1
+            logger.warning(f"🚦 Flood control de Telegram: chat en pausa {retry_after:.0f}s")
+            requeue = item.kind != ACTION and item.attempts < MAX_SEND_ATTEMPTS
+            if not requeue:
+                self.stats["failed"] += 1
+                item.future.set_exception(e)
+        except (BadRequest, Forbidden) as e:
+            # Mensaje idéntico, chat bloqueado, etc.: reintentar no cambia nada
+            self.stats["failed"] += 1
+            logger.debug(f"Envío descartado por Telegram: {e}")
+            item.future.set_exception(e)
+        except NetworkError as e:
+            chat.blocked_until = time.monotonic() + item.attempts
+            # Reenviar un mensaje que quizás llegó lo duplicaría; editar dos veces es inocuo
+            retriable = item.kind == EDIT or (item.kind == ANSWER and _not_sent(e))
+            requeue = retriable and item.attempts < MAX_SEND_ATTEMPTS
+            if not requeue:
+                self.stats["failed"] += 1
+                logger.warning(f"❌ No se pudo enviar a Telegram: {e}")
+                item.future.set_exception(e)
+        finally:
+            if requeue:
+                # Vuelve al frente para no romper el orden del chat
+                chat.items.appendleft(item)
+                if item.kind == EDIT:
+                    self._pending_edits[(item.chat_id, item.payload["message_id"])] = item
+            else:
+                self.pending -= 1
+                if not item.future.done():
+                    item.future.cancel()
+            chat.busy = False
+            self._wakeup.set()
+
+    # ---------- Métricas ----------
+    def _percentile(self, pct: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "queued": self.pending - len(self._sends),
+            "in_flight": len(self._sends),
+            "chats": len(self._chats),
+            "p50_send_latency": self._percentile(50),
+            "p95_send_latency": self._percentile(95)
+        }
+
+    def metrics_text(self) -> str:
+        """Cola y latencia de envío en formato de texto de Prometheus"""
+        snap = self.snapshot()
+        lines = [
+            "# HELP unsa_bot_outbox_events_total Envíos a Telegram por resultado",
+            "# TYPE unsa_bot_outbox_events_total counter"
+        ]
+        for key, value in sorted(self.stats.items()):
+            lines.append(f'unsa_bot_outbox_events_total{{event="{key}"}} {value}')
+        lines += [
+            "# HELP unsa_bot_outbox_queued Envíos esperando turno",
+            "# TYPE unsa_bot_outbox_queued gauge",
+            f"unsa_bot_outbox_queued {snap['queued']}",
+            "# HELP unsa_bot_outbox_send_latency_seconds Desde que se encola hasta que Telegram confirma",
+            "# TYPE unsa_bot_outbox_send_latency_seconds summary"
+        ]
+        for quantile, pct in (("0.5", 50), ("0.95", 95)):
+            value = self._percentile(pct)
+            if value is not None:
+                lines.append(f'unsa_bot_outbox_send_latency_seconds{{quantile="{quantile}"}} {value:.4f}')
+        return "\n".join(lines) + "\n"
@@ -4,61 +4,131 @@ Bot UNSA - VERSIÓN FINAL MODULAR del 06/2/26,estamos lejos aun
 """
 
 import asyncio
-import aiohttp
 import hashlib
+import math
 import time
 import re
 import signal
 import sys
 from collections import defaultdict
-from typing import Optional
+from contextlib import aclosing
+from typing import Dict, List, Optional, Tuple
 
 from telegram import Update
-from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
 # Importaciones desde los módulos
 from ..config import (
-    TOKEN, DEBUG_MODE, INFERENCE_API_URL, DATABASE_URL,
+    TOKEN, TELEGRAM_BASE_URL, DEBUG_MODE, INFERENCE_API_URLS, DATABASE_URL,
+    USAGE_FLUSH_INTERVAL, USAGE_FLUSH_MAX_PENDING, RETRIEVER_SIMILARITY_THRESHOLD, RETRIEVER_FTS,
+    RETRIEVER_BACKEND, RETRIEVER_RELOAD_DEBOUNCE,
     REQUEST_TIMEOUT, RETRY_ATTEMPTS, RETRY_DELAY,
-    RATE_LIMIT_WINDOW, RATE_LIMIT_MAX_REQUESTS,
+    RATE_LIMIT_WINDOW, RATE_LIMIT_MAX_REQUESTS, RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST,
+    MIN_MESSAGE_INTERVAL, LLM_USER_QUOTA, LLM_QUOTA_WINDOW, LLM_GLOBAL_RATE, LLM_GLOBAL_BURST,
+    STATE_BACKEND, STATE_MAX_ENTRIES, SESSION_TTL, ACTIVE_USER_TTL,
+    LLM_STREAMING, STREAM_EDIT_INTERVAL, STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS,
+    ROUTER_HEALTH_INTERVAL, ROUTER_EJECT_AFTER_FAILURES, ROUTER_EJECT_SECONDS, ROUTER_AFFINITY_SLACK,
+    INFERENCE_CONNECTOR_LIMIT, INFERENCE_KEEPALIVE_TIMEOUT,
+    BREAKER_FAILURE_RATIO, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_OPEN_SECONDS,
+    LLM_HEDGING, HEDGE_DELAY, HEDGE_MAX_PROMPT_CHARS,
+    LLM_MAX_TOKENS, LLM_MIN_MAX_TOKENS, LLM_LATENCY_BUDGET, PLANNER_DEGRADE_LOAD, PLANNER_RESUME_LOAD,
+    BOT_UPDATE_WORKERS, BOT_UPDATE_QUEUE_SIZE, BOT_MAX_CHAT_BACKLOG,
+    OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_MAX_IN_FLIGHT,
+    BOT_RUN_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_REGISTER, WEBHOOK_MAX_QUEUE, WEBHOOK_DRAIN_TIMEOUT,
     logger
 )
 from ..models import ResponseMode, SearchResult
-from ..utils import RateLimiter, anonymize_message, escape_md
-from ..retriever import PostgresRetriever
+from ..utils import anonymize_message, escape_md
+from ..retriever import PostgresRetriever, create_retriever
+from ..state_store import RATE_LIMITED, TOO_FAST, create_state_store
+from ..rate_limiter import RateLimiter
+from ..intents import IntentRouter
+from ..inference_router import InferenceRouter
+from ..inference_client import InferenceClient
+from ..mode_planner import ModeDecision, ModePlanner
+from .outbox import Outbox
+from .update_processor import ChatSerializingProcessor
+from .webhook import WebhookServer
+
+# Fin de oración: a partir de acá ya vale la pena mostrar el primer mensaje
+SENTENCE_END_RE = re.compile(r"[.!?…:](\s|$)|\n")
+TELEGRAM_MAX_MESSAGE_LEN = 4096
 
 class BotManager:
     def __init__(self, retriever: PostgresRetriever):
         self.retriever = retriever
         self.start_time = time.time()
-        self.user_stats = {"messages": 0, "users": set()}
-        self.last_message_time = {}
-        self.limiter = RateLimiter(RATE_LIMIT_WINDOW, RATE_LIMIT_MAX_REQUESTS)
-        self.session: Optional[aiohttp.ClientSession] = None
+        # Rate limit, anti-spam, usuarios activos y resultados previos: acotado y con
+        # vencimiento; con STATE_BACKEND=postgres se comparte entre procesos
+        self.state = create_state_store(STATE_BACKEND, retriever=retriever, max_entries=STATE_MAX_ENTRIES)
+        self.limiter = RateLimiter(
+            self.state,
+            user_rate=RATE_LIMIT_MAX_REQUESTS / RATE_LIMIT_WINDOW,
+            user_burst=RATE_LIMIT_MAX_REQUESTS,
+            global_rate=RATE_LIMIT_GLOBAL_RATE,
+            global_burst=RATE_LIMIT_GLOBAL_BURST,
+            llm_user_rate=LLM_USER_QUOTA / LLM_QUOTA_WINDOW,
+            llm_user_burst=LLM_USER_QUOTA,
+            llm_global_rate=LLM_GLOBAL_RATE,
+            llm_global_burst=LLM_GLOBAL_BURST,
+            min_interval=MIN_MESSAGE_INTERVAL,
+            active_ttl=ACTIVE_USER_TTL
+        )
         self.stop_event = asyncio.Event()
-        self.last_results_by_user = {}
-
-    async def init_session(self):
-        """Inicializa la sesión HTTP persistente"""
-        if self.session is None or self.session.closed:
-            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=5)
-            self.session = aiohttp.ClientSession(timeout=timeout)
-            logger.info("✅ Sesión HTTP inicializada")
-
-    async def close_session(self):
-        """Cerrar sesión HTTP limpiamente"""
-        if self.session and not self.session.closed:
-            try:
-                await self.session.close()
-                logger.info("✅ Sesión HTTP cerrada")
-            except Exception as e:
-                logger.error("❌ Error al cerrar sesión HTTP: %s", str(e))
+        self.intents = IntentRouter()
+        router = InferenceRouter(
+            INFERENCE_API_URLS,
+            health_interval=ROUTER_HEALTH_INTERVAL,
+            eject_after=ROUTER_EJECT_AFTER_FAILURES,
+            eject_seconds=ROUTER_EJECT_SECONDS,
+            affinity_slack=ROUTER_AFFINITY_SLACK
+        )
+        self.router = router
+        self.inference = InferenceClient(
+            router,
+            request_timeout=REQUEST_TIMEOUT,
+            max_attempts=RETRY_ATTEMPTS + 1,
+            backoff_base=RETRY_DELAY,
+            connector_limit_per_host=INFERENCE_CONNECTOR_LIMIT,
+            keepalive_timeout=INFERENCE_KEEPALIVE_TIMEOUT,
+            hedge_enabled=LLM_HEDGING,
+            hedge_delay=HEDGE_DELAY,
+            hedge_max_chars=HEDGE_MAX_PROMPT_CHARS,
+            breaker_options={
+                "failure_ratio": BREAKER_FAILURE_RATIO,
+                "window": BREAKER_WINDOW,
+                "min_calls": BREAKER_MIN_CALLS,
+                "open_seconds": BREAKER_OPEN_SECONDS
+            }
+        )
+        self.planner = ModePlanner(
+            self.inference,
+            latency_budget=LLM_LATENCY_BUDGET,
+            max_tokens=LLM_MAX_TOKENS,
+            min_max_tokens=LLM_MIN_MAX_TOKENS,
+            degrade_load=PLANNER_DEGRADE_LOAD,
+            resume_load=PLANNER_RESUME_LOAD
+        )
+        self.outbox = Outbox(
+            global_rate=OUTBOX_GLOBAL_RATE,
+            chat_rate=OUTBOX_CHAT_RATE,
+            chat_burst=OUTBOX_CHAT_BURST,
+            max_in_flight=OUTBOX_MAX_IN_FLIGHT
+        )
+        self.update_processor = ChatSerializingProcessor(
+            BOT_UPDATE_WORKERS,
+            max_queued=BOT_UPDATE_QUEUE_SIZE,
+            max_chat_backlog=BOT_MAX_CHAT_BACKLOG,
+            notify=self.outbox.send_message
+        )
 
     async def close_resources(self):
         """Cierra todos los recursos limpiamente"""
         tasks = [
-            self.close_session(),
+            self.outbox.stop(),
+            self.state.close(),
+            self.inference.close(),
             self.retriever.disconnect()
         ]
 
@@ -68,73 +138,175 @@ class BotManager:
         except Exception as e:
             logger.error("❌ Error al cerrar recursos: %s", str(e))
 
+    def metrics_text(self) -> str:
+        """Métricas del bot para el /metrics del servidor webhook"""
+        return (
+            self.inference.metrics_text()
+            + self.intents.metrics_text()
+            + self.limiter.metrics_text()
+            + self.update_processor.metrics_text()
+            + self.outbox.metrics_text()
+        )
+
     def signal_handler(self):
         """Manejador de señales para cierre limpio"""
         logger.info("🛑 Recibida señal de parada, cerrando recursos...")
         self.stop_event.set()
 
-    def _build_prompt(self, question: str, context: str) -> str:
-        """Construye el prompt para el LLM - RESTAURADO EXACTAMENTE"""
-        return f"""Eres DptoFisicaUNSa, asistente oficial de la Universidad Nacional de Salta (UNSA).
-INFORMACIÓN DE LA BASE DE DATOS UNSA:
-{context}
-
-INSTRUCCIONES:
-1. Usa ÚNICAMENTE la información proporcionada arriba
-2. NO inventes información bajo ninguna circunstancia
-3. Sé conciso y directo (3-4 oraciones máximo)
-4. Si la información no contiene lo solicitado, di que no tienes esa información específica
-5. Incluye URLs o contactos si están en la información
-6. Responde en español claro y profesional
-
-PREGUNTA DEL USUARIO: {question}
-
-RESPUESTA BREVE Y PRECISA:"""
-
-    async def _call_llm(self, prompt: str, user_hash: str) -> str:
-        """Llama al servicio de IA con reintentos automáticos"""
-        max_retries = RETRY_ATTEMPTS
-        base_delay = RETRY_DELAY
-
-        for attempt in range(max_retries + 1):
-            try:
-                if self.session is None or self.session.closed:
-                    await self.init_session()
-
-                async with self.session.post(
-                    INFERENCE_API_URL,
-                    json={
-                        "prompt": prompt,
-                        "user_id": user_hash,
-                        "max_tokens": 500,
-                        "temperature": 0.2
-                    }
-                ) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        answer = data.get("response", "").strip()
-                        if answer:
-                            return answer
-                        logger.warning(f"Respuesta vacía de IA en intento {attempt+1}")
-                    else:
-                        logger.warning(f"Error HTTP {resp.status} en intento {attempt+1}")
-
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                logger.warning(f"Error de conexión en intento {attempt+1}: {e}")
-
-            # Si no es el último intento, esperar antes de reintentar
-            if attempt < max_retries:
-                delay = base_delay * (attempt + 1)  # Backoff exponencial
-                logger.info(f"Esperando {delay:.1f}s antes de reintento {attempt+2}/{max_retries+1}")
-                await asyncio.sleep(delay)
-
-        # Si todos los intentos fallan
-        logger.error(f"Todos los intentos de conexión a IA fallaron para usuario {user_hash}")
-        return ""
+    def _chat_payload(self, template_id: str, question: str, user_hash: str,
+                      sections: Optional[Dict[str, List[str]]] = None,
+                      max_tokens: int = LLM_MAX_TOKENS, **variables) -> dict:
+        """
+        Solicitud para /chat: las instrucciones viven en el servidor (backend/prompt_templates.py)
+        como prefijo fijo, así el prefix cache de vLLM no vuelve a hacer su prefill.
+        template_id: "rag" (context) o "explanatory" (careers)
+        sections: variables en partes ordenadas por relevancia; el servidor descarta
+        las últimas si el prompt no entra en la ventana del modelo
+        max_tokens: el que eligió el planificador según la carga
+        """
+        return {
+            "template_id": template_id,
+            "variables": variables,
+            "sections": sections or {},
+            "messages": [{"role": "user", "content": question}],
+            "user_id": user_hash,
+            "max_tokens": max_tokens,
+            "temperature": 0.2
+        }
+
+    async def _stream_llm(self, update: Update, payload: dict, user_hash: str,
+                          deadline: float) -> Tuple[str, bool]:
+        """
+        Consume /chat_stream y va mostrando la respuesta en Telegram.
+        Publica un mensaje con la primera oración y agrupa los deltas siguientes
+        en ediciones espaciadas STREAM_EDIT_INTERVAL segundos.
+        Si Telegram no acepta el primer mensaje se deja de editar y el texto
+        completo se manda como respuesta común al terminar.
+        Retorna (texto mostrado o "" si no llegó a publicarse nada, vale la pena
+        reintentar sin streaming: False si el servidor rechazó la solicitud).
+        """
+        text = ""
+        shown = ""
+        message = None
+        publish = True
+        last_edit = 0.0
+
+        async with aclosing(self.inference.stream(payload, user_hash, deadline)) as events:
+            async for event in events:
+                if event.get("error"):
+                    logger.warning(f"Error del servidor en streaming: {event['error']}")
+                    if event.get("status"):
+                        # 503 o 4xx: el servidor ya contestó, /chat diría lo mismo
+                        return "", False
+                    break
+                if event.get("done"):
+                    text = event.get("response", text)
+                    break
+
+                text += event.get("delta", "")
+                now = time.monotonic()
+                if message is None:
+                    if publish and (SENTENCE_END_RE.search(text)
+                                    or len(text) >= STREAM_FIRST_MESSAGE_MAX_WAIT_CHARS):
+                        shown = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
+                        sent = self._reply(update, shown)
+                        # wait() no propaga el error ni la cancelación del future
+                        await asyncio.wait((sent,))
+                        if sent.cancelled() or sent.exception():
+                            logger.warning(f"No se pudo publicar el streaming para usuario {user_hash}, "
+                                           "se enviará la respuesta completa al final")
+                            publish = False
+                        else:
+                            message = sent.result()
+                        last_edit = now
+                elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                    shown = self._edit_streamed(message, text, shown)
+                    last_edit = now
+
+        text = text.strip()
+        if message is None:
+            if not text:
+                return "", True
+            self._reply(update, text[:TELEGRAM_MAX_MESSAGE_LEN])
+            return text, True
+
+        self._edit_streamed(message, text, shown)
+        return text, True
+
+    def _reply(self, update: Update, text: str, **kwargs) -> asyncio.Future:
+        """Encola la respuesta en el outbox; hay que esperar el future solo si se necesita el Message"""
+        return self.outbox.send_message(update.effective_chat.id, text, **kwargs)
+
+    def _edit_streamed(self, message, text: str, shown: str) -> str:
+        """Encola la edición solo si cambió (Telegram rechaza ediciones idénticas)"""
+        new_text = text.strip()[:TELEGRAM_MAX_MESSAGE_LEN]
+        if not new_text or new_text == shown:
+            return shown
+        # Si la edición anterior todavía no salió, el outbox la reemplaza por esta
+        self.outbox.edit_message(message, new_text)
+        return new_text
+
+    async def _reply_llm(self, update: Update, payload: dict, user_hash: str) -> bool:
+        """
+        Responde con la IA (en streaming si está habilitado). False si no hubo respuesta.
+        Stream y reintento sin streaming comparten un único deadline: el usuario nunca
+        espera más que REQUEST_TIMEOUT en total.
+        La cuota que cobró _plan se devuelve si no hubo respuesta.
+        """
+        answered = False
+        try:
+            answered = await self._generate_llm(update, payload, user_hash)
+            return answered
+        finally:
+            if not answered:
+                await self.limiter.refund_llm(user_hash, payload["max_tokens"] / LLM_MAX_TOKENS)
+
+    async def _generate_llm(self, update: Update, payload: dict, user_hash: str) -> bool:
+        deadline = self.inference.new_deadline()
+        if LLM_STREAMING:
+            text, retry = await self._stream_llm(update, payload, user_hash, deadline)
+            if text:
+                return True
+            if not retry:
+                return False
+            logger.info(f"Streaming sin respuesta para usuario {user_hash}, reintentando sin streaming")
+
+        answer = await self.inference.complete(payload, user_hash, deadline, fallback=LLM_STREAMING)
+        if answer:
+            self._reply(update, answer)
+            return True
+        return False
+
+    async def _previous_results(self, user_hash: str) -> List[SearchResult]:
+        """Resultados de la consulta anterior del usuario (para preguntas de seguimiento)"""
+        ids = await self.state.get("results", user_hash)
+        return await self.retriever.fetch_by_ids(ids) if ids else []
+
+    async def _plan(self, suggested: ResponseMode, user_hash: str, purpose: str = "rag") -> ModeDecision:
+        """Modo de respuesta según la carga de la GPU y la cuota de IA del usuario"""
+        decision = self.planner.plan(suggested, user_hash, purpose=purpose)
+        if decision.mode != ResponseMode.LLM:
+            return decision
+        # Una respuesta acortada por el planificador descuenta menos cuota
+        if not await self.limiter.charge_llm(user_hash, decision.max_tokens / LLM_MAX_TOKENS):
+            return ModeDecision(ResponseMode.DIRECT, 0, "sin cuota de IA")
+        return decision
+
+    async def _reply_planned(self, update: Update, template_id: str, question: str, user_hash: str,
+                             sections: Optional[Dict[str, List[str]]] = None, **variables) -> bool:
+        """Responde con la IA si el planificador y la cuota lo permiten"""
+        decision = await self._plan(ResponseMode.LLM, user_hash, purpose=template_id)
+        if decision.mode != ResponseMode.LLM:
+            return False
+        payload = self._chat_payload(
+            template_id, question, user_hash, sections, max_tokens=decision.max_tokens, **variables
+        )
+        return await self._reply_llm(update, payload, user_hash)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # RESTAURADO: Mensaje exacto original
-        await update.message.reply_text(
+        self._reply(
+            update,
             "👋 *Bienvenido al Asistente UNSA*\n\n"
             "*¿En qué puedo ayudarte?*\n"
             "• Carreras y programas de estudio\n"
@@ -154,12 +326,14 @@ RESPUESTA BREVE Y PRECISA:"""
 
     async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # RESTAURADO: Mensaje exacto original
-        await update.message.reply_text(
+        self._reply(
+            update,
             "🤖 *Asistente UNSA*\n\n"
             "*Comandos disponibles:*\n"
             "/start – Mensaje de bienvenida\n"
             "/help – Esta ayuda\n"
             "/stats – Estadísticas del bot\n"
+            "/quota – Tu cuota disponible\n"
             "/diagnose – Estado del sistema\n\n"
             "*También podés escribir tu consulta directamente.*\n"
             "Ejemplos:\n"
@@ -170,25 +344,6 @@ RESPUESTA BREVE Y PRECISA:"""
             parse_mode="Markdown"
         )
 
-    # Para semántica
-    EXPLANATORY_TRIGGERS = {
-        "de que se trata",
-        "de qué se trata",
-        "de que se tratan",
-        "diferencia",
-        "me conviene",
-        "salida laboral",
-        "orientacion",
-        "orientación",
-        "perfil",
-        "en que consiste",
-        "qué hace"
-    }
-
-    def is_explanatory_question(self, msg: str) -> bool:
-        msg = msg.lower()
-        return any(t in msg for t in self.EXPLANATORY_TRIGGERS)
-
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Verificar si debemos detener el procesamiento
         if self.stop_event.is_set():
@@ -196,98 +351,43 @@ RESPUESTA BREVE Y PRECISA:"""
 
         msg = update.message.text.strip()
         user_id = update.effective_user.id
+        user_hash = hashlib.md5(str(user_id).encode()).hexdigest()[:8]
 
-        # Rate limiting
-        if not self.limiter.is_allowed(user_id):
-            await update.message.reply_text(
+        # Anti-spam y cuotas de mensajes (usuario y global) en una sola consulta
+        verdict, retry_after = await self.limiter.admit(user_hash)
+        if verdict == RATE_LIMITED:
+            self._reply(
+                update,
                 "⏳ Has excedido el límite de solicitudes. "
-                "Por favor, espera unos minutos antes de volver a intentarlo."
+                f"Podés volver a escribir en {max(1, math.ceil(retry_after))} segundos. "
+                "Usá /quota para ver tu cuota."
             )
             return
-
-        # Anti-spam: mínimo 1.5 segundos entre mensajes
-        now = time.time()
-        last = self.last_message_time.get(user_id, 0)
-        if now - last < 1.5:
+        if verdict == TOO_FAST:
             return
-        self.last_message_time[user_id] = now
-
-        user_hash = hashlib.md5(str(user_id).encode()).hexdigest()[:8]
-        self.user_stats["users"].add(user_hash)
-        self.user_stats["messages"] += 1
 
         # Logging anónimo
         logger.info("📩 Usuario %s: %s", user_hash, anonymize_message(msg))
 
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action=ChatAction.TYPING
-        )
-        # ================= SALUDOS → IA DIRECTO =================
-
-        GREETINGS = {"hola", "buenas", "buen", "hey", "saludos"}
-
-        msg = update.message.text.strip()
-        msg_norm = re.sub(r"[^\w\s]", "", msg.lower())
-        tokens = msg_norm.split()
-
-        is_greeting = any(t in GREETINGS for t in tokens)
-
-        if is_greeting:
-            prompt = f"""Eres DptoFisicaUNSa, asistente oficial de la Universidad Nacional de Salta (UNSA).
-
-                    El usuario solo está saludando.
-
-                        INSTRUCCIONES:
-                                - Responde con un saludo breve y cordial (1 o 2 oraciones).
-                                - Invita a hacer una consulta sobre becas, carreras, inscripciones o trámites.
-                                - No inventes información.
-                                - Usa español claro y profesional.
-
-                                SALUDO DEL USUARIO: {msg}
-
-                                RESPUESTA:"""
-
-            answer = await self._call_llm(prompt, user_hash)
-
-            if answer:
-                await update.message.reply_text(answer)
-            else:
-                await update.message.reply_text(
-                    "👋 Hola, soy el Asistente UNSA.\n\n"
-                    "Podés preguntarme sobre becas, carreras, inscripciones o trámites.\n"
-                    "Usá /help para ver los comandos."
-                )
-
+        # ================= SALUDOS, AYUDA, GRACIAS → RESPUESTA FIJA =================
+        # Sin base ni IA: el mensaje completo tiene que ser la intención ("hola" sí, "hola, ¿hay becas?" no)
+        canned = self.intents.match(msg)
+        if canned:
+            self._reply(update, canned.response)
             return  # CORTA ACÁ, NO VA A LA BASE
 
-        # ================= SEMÁNTICA SIN NUEVA BÚSQUEDA =================
-        if self.is_explanatory_question(msg):
-            prev_results = self.last_results_by_user.get(user_hash)
+        self.outbox.send_typing(update.effective_chat.id)
+        explanatory = self.intents.is_explanatory(msg)
 
+        # ================= SEMÁNTICA SIN NUEVA BÚSQUEDA =================
+        # Una sola lectura: la reusa la respuesta explicativa de después de la búsqueda
+        prev_results = await self._previous_results(user_hash) if explanatory else []
+        if explanatory:
             if prev_results:
                 careers_list = "\n".join(
                     f"- {r.content}" for r in prev_results)
 
-                prompt = f"""Eres DptoFisicaUNSa, asistente oficial de la Universidad Nacional de Salta (UNSA).
-                El usuario pide una explicación/orientación sobre carreras universitarias.
-                Carreras disponibles:
-                    {careers_list}
-
-                    INSTRUCCIONES:
-                        - Explicá brevemente de qué se trata cada carrera
-                        - Marcá diferencias de enfoque (docencia, investigación, práctica)
-                        - Orientá según intereses del estudiante
-                        - NO inventes datos institucionales
-                        - Usá un tono claro y orientativo
-                        - Máximo 6–8 oraciones
-                    PREGUNTA DEL USUARIO:
-                        {msg}
-                    RESPUESTA:"""
-
-                answer = await self._call_llm(prompt, user_hash)
-                if answer:
-                    await update.message.reply_text(answer)
+                if await self._reply_planned(update, "explanatory", msg, user_hash, careers=careers_list):
                     return
 
         #  Recién acá consultar la base
@@ -305,18 +405,18 @@ RESPUESTA BREVE Y PRECISA:"""
             # part += f"Keywords: {', '.join(res.keywords)}\n"
             part += "---\n" # Separador entre resultados
             detailed_context_parts.append(part)
-
-        detailed_context = "\n".join(detailed_context_parts)
+        # Se envían como secciones: el servidor recorta las menos relevantes si no entran
         # ==============================================================
 
         # Guardar resultados recientes si parecen carreras
         if results and any("Carrera" in r.content for r in results):
-            self.last_results_by_user[user_hash] = results
+            # Solo los ids: el contenido se relee de la base si hace falta
+            await self.state.set("results", user_hash, tuple(r.id for r in results), ttl=SESSION_TTL)
+            prev_results = results  # lo que se acaba de guardar, sin releerlo
 
         # Mejora la conversacion de carreras
         # ===== RESPUESTA SEMÁNTICA EXPLICATIVA =====
-        if self.is_explanatory_question(msg):
-            prev_results = self.last_results_by_user.get(user_hash)
+        if explanatory:
             if prev_results:
                 # --- NUEVA LÓGICA DE FILTRADO ---
                 # Solo incluimos en la lista lo que coincida con palabras clave de la pregunta actual
@@ -335,72 +435,50 @@ RESPUESTA BREVE Y PRECISA:"""
                 careers_list = "\n".join(f"- {r.content}" for r in filtered_careers)
                 # --------------------------------
 
-                prompt = f"""Eres DptoFisicaUNSa, asistente oficial de la Universidad Nacional de Salta (UNSA).
-                El usuario realiza una consulta explicativa u orientativa sobre carreras universitarias.
-                Carreras relacionadas.
-                {careers_list}
-
-                INSTRUCCIONES:
-                    - Explicá brevemente de qué se trata cada carrera
-                    - Indicá diferencias de enfoque si las hay
-                    - Orientá al estudiante según intereses (docencia, investigación, práctica)
-                    - No inventes información institucional específica
-                    - Usá un tono claro y orientativo (máx. 6–8 oraciones)
-
-                PREGUNTA DEL USUARIO:
-                    {msg}
-                RESPUESTA:"""
-                answer = await self._call_llm(prompt, user_hash)
-                if answer:
-                    await update.message.reply_text(answer)
+                if await self._reply_planned(update, "explanatory", msg, user_hash, careers=careers_list):
                     return
 
         if mode == ResponseMode.FALLBACK:
-            await update.message.reply_text(
+            self._reply(
+                update,
                 "No tengo información específica sobre eso.\nVisitá https://www.unsa.edu.ar  "
             )
             return
 
+        # El modo de la búsqueda se ajusta a la carga de la GPU (queda registrado en el log)
+        decision = await self._plan(mode, user_hash)
+
         #####Respuesta semantica de la IA a las carreras
         if mode == ResponseMode.DIRECT:
             #NUEVO: si es pregunta explicativa, usar IA
-            if self.is_explanatory_question(msg):
+            if explanatory:
                 careers_list = "\n".join(
                     f"- {r.content}" for r in results
                     )
-                prompt = f"""Eres DptoFisicaUNSa, asistente oficial de la Universidad Nacional de Salta (UNSA).
-                El usuario hace una consulta explicativa/orientativa.
-                Carreras encontradas:
-                    {careers_list}
-
-                    INSTRUCCIONES:
-                        - Explicá brevemente de qué se trata cada carrera
-                        - Indicá diferencias de enfoque si las hay
-                        - Orientá al estudiante según intereses (docencia, investigación, práctica)
-                        - No inventes información institucional específica
-                        - Usá un tono claro y orientativo (máx. 6–8 oraciones)
-                    PREGUNTA DEL USUARIO:
-                        {msg}
-
-                    RESPUESTA:"""
-
-                answer = await self._call_llm(prompt, user_hash)
-
-                if answer:
-                    await update.message.reply_text(answer)
+                if await self._reply_planned(update, "explanatory", msg, user_hash, careers=careers_list):
                     return
             #comportamiento original
             response = self.retriever.build_direct_response(results)
-            await update.message.reply_text(response)
+            self._reply(update, response)
             return
 
-        try:
-            # CAMBIADO: Usar detailed_context que incluye la descripcion
-            prompt = self._build_prompt(msg, detailed_context)
-            answer = await self._call_llm(prompt, user_hash)
+        if decision.mode == ResponseMode.DIRECT:
+            # GPU sin margen para responder dentro del presupuesto: directo desde la base
+            self._reply(
+                update,
+                f"{escape_md(self.retriever.build_direct_response(results))}\n\n"
+                "_Información obtenida directamente de la base de datos_",
+                parse_mode="Markdown"
+            )
+            return
 
-            if answer:
-                await update.message.reply_text(answer)
+        try:
+            # CAMBIADO: Usar el contexto detallado que incluye la descripcion
+            payload = self._chat_payload(
+                "rag", msg, user_hash, sections={"context": detailed_context_parts},
+                max_tokens=decision.max_tokens
+            )
+            if await self._reply_llm(update, payload, user_hash):
                 return
 
             # Si falló la IA, usar respuesta directa con notificación
@@ -410,7 +488,7 @@ RESPUESTA BREVE Y PRECISA:"""
                 f"{escape_md(self.retriever.build_direct_response(results))}\n\n"
                 "_Información obtenida directamente de la base de datos_"
             )
-            await update.message.reply_text(fallback_response, parse_mode="Markdown")
+            self._reply(update, fallback_response, parse_mode="Markdown")
 
         except Exception as e:
             logger.error("❌ API error: %s", str(e))
@@ -419,7 +497,7 @@ RESPUESTA BREVE Y PRECISA:"""
                 f"{escape_md(self.retriever.build_direct_response(results))}\n\n"
                 "_Información obtenida directamente de la base de datos_"
             )
-            await update.message.reply_text(fallback_response, parse_mode="Markdown")
+            self._reply(update, fallback_response, parse_mode="Markdown")
 
     async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         r = self.retriever.stats
@@ -428,7 +506,8 @@ RESPUESTA BREVE Y PRECISA:"""
         hours, remainder = divmod(int(uptime), 3600)
         minutes, _ = divmod(remainder, 60)
 
-        await update.message.reply_text(
+        self._reply(
+            update,
             f"📊 *Estadísticas*\n\n"
             f"*Uptime:* {hours}h {minutes}m\n"
             f"*Base de datos:*\n"
@@ -436,9 +515,28 @@ RESPUESTA BREVE Y PRECISA:"""
             f"• Fragmentos: {r['fragments']}\n"
             f"• Errores: {r['errors']}\n\n"
             f"*Usuarios:*\n"
-            f"• Únicos: {len(self.user_stats['users'])}\n"
-            f"• Mensajes: {self.user_stats['messages']}\n\n"
-            f"*Rate Limit:* {RATE_LIMIT_MAX_REQUESTS} solicitudes por {RATE_LIMIT_WINDOW} segundos",
+            f"• Activos ({ACTIVE_USER_TTL / 3600:.0f}h): {await self.state.count('active_users')}\n"
+            f"• Mensajes: {await self.state.message_count()}\n\n"
+            f"*Rate Limit:* {RATE_LIMIT_MAX_REQUESTS} solicitudes por {RATE_LIMIT_WINDOW} segundos"
+            f" · IA {LLM_USER_QUOTA:.0f} respuestas por {LLM_QUOTA_WINDOW / 3600:.0f}h",
+            parse_mode="Markdown"
+        )
+
+    async def quota(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_hash = hashlib.md5(str(update.effective_user.id).encode()).hexdigest()[:8]
+        q = await self.limiter.quota(user_hash)
+
+        def fmt_refill(seconds: float) -> str:
+            return f"{seconds:.0f}s" if seconds < 120 else f"{seconds / 60:.0f} min"
+
+        self._reply(
+            update,
+            "🎟️ *Tu cuota*\n\n"
+            f"*Mensajes:* {math.floor(q['messages'])} de {q['messages_burst']:.0f}"
+            f" (se recupera 1 cada {fmt_refill(q['messages_refill'])})\n"
+            f"*Respuestas con IA:* {math.floor(q['llm'])} de {q['llm_burst']:.0f}"
+            f" (se recupera 1 cada {fmt_refill(q['llm_refill'])})\n\n"
+            "Sin cuota de IA igual te respondo con la información de la base.",
             parse_mode="Markdown"
         )
 
@@ -446,34 +544,83 @@ RESPUESTA BREVE Y PRECISA:"""
         r = self.retriever.stats
 
         db_status = "🟢 Conectado" if self.retriever.connected else "🔴 Error"
-        ia_status = "🟢 OK"
 
+        def fmt_seconds(value: Optional[float]) -> str:
+            return f"{value:.1f}s" if value is not None else "-"
+
+        # Estado fresco de cada réplica (el router también lo actualiza en segundo plano)
         try:
-            if self.session is None or self.session.closed:
-                await self.init_session()
-
-            # Construir URL de health basada en la variable de entorno
-            base_url = INFERENCE_API_URL.rsplit('/', 1)[0]
-            health_url = f"{base_url}/health"
-
-            async with self.session.get(health_url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    status_msg = data.get("status", "unknown")
-                    queue_load = data.get("queue_load_percent", 0)
-                    ia_status = f"🟢 {status_msg} - {queue_load}% cola"
-                else:
-                    ia_status = f"🔴 Error HTTP {resp.status}"
+            await self.router.refresh()
         except Exception as e:
-            ia_status = f"🔴 Sin conexión: {str(e)[:50]}"
+            logger.warning(f"No se pudo refrescar el estado de las réplicas: {e}")
+
+        client = self.inference.snapshot()
+        backend_lines = []
+        for b in self.router.snapshot():
+            icon = "🟢" if b["healthy"] and b["status"] == "healthy" else ("🟡" if b["healthy"] else "🔴")
+            p95 = fmt_seconds(b["p95_latency"])
+            ttft = fmt_seconds(b["p95_ttft"])
+            name = b["url"].split("://", 1)[-1]
+            breaker = client["breakers"].get(name, {})
+            breaker_state = breaker.get("state", "closed").replace("_", "-")
+            if breaker_state == "open":
+                breaker_state = f"open ({breaker['open_for']:.0f}s)"
+            backend_lines.append(
+                f"{icon} `{name}` {b['status']} - {b['load'] * 100:.0f}% carga\n"
+                f"   p95 {p95} · primer token {ttft} · errores {b['errors']}/{b['requests']} · expulsiones {b['ejections']}\n"
+                f"   breaker {breaker_state} · aperturas {breaker.get('opened', 0)}"
+            )
+        ia_status = "\n".join(backend_lines) or "🔴 Sin réplicas configuradas"
+        ia_status += (
+            f"\n• Respondidas: {client['answered']}/{client['calls']}"
+            f" · reintentos {client['retries']} · sin réplica {client['short_circuited']}"
+        )
+        if LLM_HEDGING:
+            ia_status += f"\n• Hedges: {client['hedges']} (ganados {client['hedges_won']})"
+        planner = self.planner.snapshot()
+        ia_status += (
+            f"\n• Modo: {'🔻 directo desde la base en ' + ', '.join(planner['degraded']) if planner['degraded'] else 'IA'}"
+            f" · presupuesto {planner['latency_budget']:.0f}s"
+        )
+        updates = self.update_processor.snapshot()
+        outbox = self.outbox.snapshot()
+        state = self.state.snapshot()
+        usage = self.retriever.usage.snapshot()
+        plans = await self.retriever.plan_stats()
+        index = self.retriever.index_snapshot()
+        index_line = (
+            f"• Índice en memoria: {index['fragments']} fragmentos · {index['terms']} términos"
+            f" · recargas {index['reloads']} (última hace {index['age']:.0f}s)\n"
+            if index else ""
+        )
+        quota = self.limiter.snapshot()
+        intents = self.intents.snapshot()
+        canned = sum(n for intent, n in intents.items() if intent != "none")
+        total = canned + intents.get("none", 0)
 
-        await update.message.reply_text(
+        self._reply(
+            update,
             "🩺 *Diagnóstico del sistema*\n\n"
             f"*PostgreSQL:* {db_status}\n"
-            f"• Fragmentos: {r['fragments']}\n\n"
-            f"*Servicio de IA:* {ia_status}\n\n"
+            f"• Fragmentos: {r['fragments']}\n"
+            f"• Usos por guardar: {usage['pending']} · lotes {usage['flushes']} · errores {usage['errors']}\n"
+            f"• Búsquedas: texto completo {r['fts']} · a trigramas {r['fts_fallbacks']}"
+            f" · planes genéricos {plans.get('generic_plans', '-')}/a medida {plans.get('custom_plans', '-')}\n"
+            f"{index_line}\n"
+            f"*Servicio de IA:*\n{ia_status}\n\n"
+            f"*Respuestas fijas:* {canned}/{total} mensajes"
+            + "".join(f" · {intent} {n}" for intent, n in sorted(intents.items()) if intent != "none")
+            + "\n"
+            f"*Updates:* {updates['running']}/{updates['workers']} en curso, {updates['queued']} en cola\n"
+            f"• p95 handler {fmt_seconds(updates['p95_latency'])} · p95 espera {fmt_seconds(updates['p95_queue_wait'])}"
+            f" · descartados {updates['dropped']} · por cola llena {updates['overloaded']}\n"
+            f"*Envíos a Telegram:* {outbox['queued']} en cola · p95 {fmt_seconds(outbox['p95_send_latency'])}"
+            f" · flood control {outbox.get('retry_after', 0)}\n"
+            f"*Estado:* {state['entries']} entradas ({state['backend']})"
+            f" · {state['bytes'] / 1024:.0f} KB · desalojos {state['evictions']}\n\n"
             f"*Modo debug:* {'🟢 ON' if DEBUG_MODE else '⚫ OFF'}\n"
-            f"*Rate limit:* {RATE_LIMIT_MAX_REQUESTS} solicitudes/{RATE_LIMIT_WINDOW}s\n"
+            f"*Rate limit:* {RATE_LIMIT_MAX_REQUESTS} solicitudes/{RATE_LIMIT_WINDOW}s"
+            f" · limitados {quota['rate_limited']} · IA sin cuota {quota['llm_denied']}/{quota['llm_granted'] + quota['llm_denied']}\n"
             f"*Timeout IA:* {REQUEST_TIMEOUT}s",
             parse_mode="Markdown"
         )
@@ -487,7 +634,19 @@ async def main_async():
 
     try:
         # Inicializar componentes
-        retriever = PostgresRetriever(DATABASE_URL, debug_mode=DEBUG_MODE)
+        options = {}
+        if RETRIEVER_BACKEND == "memory":
+            options["reload_debounce"] = RETRIEVER_RELOAD_DEBOUNCE
+        retriever = create_retriever(
+            RETRIEVER_BACKEND,
+            DATABASE_URL,
+            debug_mode=DEBUG_MODE,
+            usage_flush_interval=USAGE_FLUSH_INTERVAL,
+            usage_max_pending=USAGE_FLUSH_MAX_PENDING,
+            similarity_threshold=RETRIEVER_SIMILARITY_THRESHOLD,
+            fts=RETRIEVER_FTS,
+            **options
+        )
         manager = BotManager(retriever)
 
         # Registrar señales de sistema
@@ -497,34 +656,39 @@ async def main_async():
         # Conectar a bases de datos y servicios
         await asyncio.gather(
             retriever.connect(),
-            manager.init_session(),
+            manager.inference.start(),
             return_exceptions=True
         )
-
-        app = Application.builder().token(TOKEN).build()
+        await manager.state.start()
+
+        # Varios estudiantes a la vez: una llamada lenta a la IA no frena a los demás chats
+        builder = (
+            Application.builder()
+            .token(TOKEN)
+            .base_url(f"{TELEGRAM_BASE_URL}/bot")
+            .base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+            .concurrent_updates(manager.update_processor)
+        )
+        if BOT_RUN_MODE == "webhook":
+            # Los updates llegan por el servidor embebido, no hace falta el Updater
+            builder = builder.updater(None)
+        app = builder.build()
+        await manager.outbox.start(app.bot)
 
         app.add_handler(CommandHandler("start", manager.start))
         app.add_handler(CommandHandler("help", manager.help))
         app.add_handler(CommandHandler("stats", manager.stats))
+        app.add_handler(CommandHandler("quota", manager.quota))
         app.add_handler(CommandHandler("diagnose", manager.diagnose))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manager.handle_message))
 
         logger.info("🤖 Bot UNSA iniciado correctamente")
         logger.info("💡 Usa /diagnose para verificar el estado del sistema")
 
-        # Iniciar polling
-        async with app:
-            await app.initialize()
-            await app.start()
-            await app.updater.start_polling(drop_pending_updates=True)
-
-            # Esperar señal de parada
-            await manager.stop_event.wait()
-
-            # Cerrar recursos
-            await app.updater.stop()
-            await app.stop()
-            await app.shutdown()
+        if BOT_RUN_MODE == "webhook":
+            await run_webhook(app, manager)
+        else:
+            await run_polling(app, manager)
 
     except Exception as e:
         logger.error("❌ Error fatal en main_async: %s", str(e))
@@ -536,6 +700,57 @@ async def main_async():
         if manager:
             await manager.close_resources()
 
+async def run_polling(app: Application, manager: BotManager):
+    async with app:
+        await app.initialize()
+        await app.start()
+        await app.updater.start_polling(drop_pending_updates=True)
+
+        # Esperar señal de parada
+        await manager.stop_event.wait()
+
+        # Cerrar recursos
+        await app.updater.stop()
+        await app.stop()
+        await manager.outbox.stop()
+        await app.shutdown()
+
+async def run_webhook(app: Application, manager: BotManager):
+    server = WebhookServer(
+        app,
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        path=WEBHOOK_PATH,
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        # Que Telegram reintente (503) antes de que el update processor tenga que descartar
+        max_queue=min(WEBHOOK_MAX_QUEUE, manager.update_processor.capacity),
+        pending=lambda: manager.update_processor.pending,
+        metrics=manager.metrics_text
+    )
+    async with app:
+        await app.initialize()
+        await app.start()
+        await server.start()
+        if WEBHOOK_REGISTER:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True,
+                max_connections=min(100, BOT_UPDATE_WORKERS * 2)
+            )
+            logger.info(f"✅ Webhook registrado en {WEBHOOK_URL}")
+
+        # Esperar señal de parada
+        await manager.stop_event.wait()
+
+        # Se deja de aceptar updates, se terminan los aceptados y recién ahí se cierra.
+        # El webhook queda registrado: Telegram reintenta contra la próxima instancia.
+        await server.stop(WEBHOOK_DRAIN_TIMEOUT)
+        await app.stop()
+        await manager.outbox.stop()
+        await app.shutdown()
+
 def main():
     try:
         asyncio.run(main_async())
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+from ..config import logger
+
+class ChatSerializingProcessor(BaseUpdateProcessor):
+    """
+    Procesa updates en paralelo (hasta `workers` handlers a la vez) pero de
+    a uno por chat, así las respuestas a un mismo estudiante salen en orden.
+
+    python-telegram-bot crea una tarea por update apenas lo recibe, así que
+    los límites se aplican al entrar (process_update), antes de cualquier
+    espera: con `workers + max_queued` updates pendientes (en curso +
+    esperando) o con `max_chat_backlog` pendientes en el chat, el update se
+    descarta con un aviso y su tarea termina enseguida. El semáforo de
+    workers se toma recién después del lock del chat, para que un chat con
+    mensajes encolados no ocupe workers mientras espera.
+    """
+
+    def __init__(self, workers: int, max_queued: int, max_chat_backlog: int = 3,
+                 notify: Optional[Callable[[int, str], Any]] = None, latency_window: int = 500):
+        super().__init__(max_concurrent_updates=workers + max_queued)
+        self.workers = workers
+        self.capacity = workers + max_queued
+        self.max_chat_backlog = max_chat_backlog
+        # notify(chat_id, texto): por dónde avisar del backlog (el outbox del bot)
+        self.notify = notify
+        self._worker_slots = asyncio.Semaphore(workers)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_pending: Dict[int, int] = {}
+        self.pending = 0
+        self.running = 0
+        self.stats = {"processed": 0, "dropped": 0, "overloaded": 0}
+        self._latencies = deque(maxlen=latency_window)
+        self._waits = deque(maxlen=latency_window)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_id(self, update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Cuenta y limita el update antes de esperar nada (reemplaza al semáforo de PTB)"""
+        chat_id = self._chat_id(update)
+        if self.pending >= self.capacity:
+            coroutine.close()
+            self.stats["overloaded"] += 1
+            logger.warning(f"⏳ Update descartado: {self.pending} updates pendientes")
+            await self._notify(update, chat_id, "⏳ Hay muchas consultas en este momento, "
+                                                "probá de nuevo en unos segundos.")
+            return
+        if chat_id is not None and self._chat_pending.get(chat_id, 0) >= self.max_chat_backlog:
+            coroutine.close()
+            self.stats["dropped"] += 1
+            logger.warning(f"⏳ Update descartado: el chat ya tiene {self.max_chat_backlog} pendientes")
+            await self._notify(update, chat_id, "⏳ Todavía estoy respondiendo tus mensajes anteriores, "
+                                                "esperá un momento.")
+            return
+
+        if chat_id is not None:
+            self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+        self.pending += 1
+        try:
+            await self.do_process_update(update, coroutine)
+        finally:
+            self.pending -= 1
+            if chat_id is not None:
+                self._chat_pending[chat_id] -= 1
+                if not self._chat_pending[chat_id]:
+                    del self._chat_pending[chat_id]
+                    self._chat_locks.pop(chat_id, None)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = self._chat_id(update)
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock()) if chat_id is not None else nullcontext()
+        queued_at = time.monotonic()
+        async with lock, self._worker_slots:
+            started = time.monotonic()
+            self._waits.append(started - queued_at)
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.stats["processed"] += 1
+                self._latencies.append(time.monotonic() - started)
+
+    async def _notify(self, update: object, chat_id: Optional[int], text: str):
+        if chat_id is None:
+            return
+        if self.notify:
+            self.notify(chat_id, text)
+            return
+        message = update.effective_message if isinstance(update, Update) else None
+        if message is None:
+            return
+        try:
+            await message.reply_text(text)
+        except TelegramError as e:
+            logger.debug(f"No se pudo avisar del descarte: {e}")
+
+    @staticmethod
+    def _percentile(samples: deque, pct: float) -> Optional[float]:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self.pending - self.running,
+            "busy_chats": len(self._chat_pending),
+            "p50_latency": self._percentile(self._latencies, 50),
+            "p95_latency": self._percentile(self._latencies, 95),
+            "p95_queue_wait": self._percentile(self._waits, 95)
+        }
+
+    def metrics_text(self) -> str:
+        """Cola, handlers en curso y latencia en formato de texto de Prometheus"""
+        snap = self.snapshot()
+        lines = [
+            "# HELP unsa_bot_updates_total Updates procesados o descartados (backlog del chat o cola llena)",
+            "# TYPE unsa_bot_updates_total counter",
+            f'unsa_bot_updates_total{{result="processed"}} {snap["processed"]}',
+            f'unsa_bot_updates_total{{result="dropped"}} {snap["dropped"]}',
+            f'unsa_bot_updates_total{{result="overloaded"}} {snap["overloaded"]}',
+            "# HELP unsa_bot_updates_running Handlers ejecutándose",
+            "# TYPE unsa_bot_updates_running gauge",
+            f"unsa_bot_updates_running {snap['running']}",
+            "# HELP unsa_bot_updates_queued Updates esperando su chat o un worker",
+            "# TYPE unsa_bot_updates_queued gauge",
+            f"unsa_bot_updates_queued {snap['queued']}",
+            "# HELP unsa_bot_handler_latency_seconds Latencia de los handlers (ventana reciente)",
+            "# TYPE unsa_bot_handler_latency_seconds summary"
+        ]
+        for quantile, pct in (("0.5", 50), ("0.95", 95)):
+            value = self._percentile(self._latencies, pct)
+            if value is not None:
+                lines.append(f'unsa_bot_handler_latency_seconds{{quantile="{quantile}"}} {value:.4f}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,126 @@
+import asyncio
+import hmac
+import json
+import time
+from typing import Callable, Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from ..config import logger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookServer:
+    """
+    Servidor HTTP embebido para el modo webhook.
+
+    Telegram (o el proxy reverso delante) hace POST de cada update a `path`.
+    Se valida el secret token, se encola el update en la Application y se
+    responde 200 enseguida: el procesamiento sigue en el update processor,
+    así Telegram no reintenta por lentitud de la IA. Con `max_queue` updates
+    sin terminar (los de la cola de PTB más los que tiene el update processor,
+    que la vacía enseguida) o durante el drenado se responde 503 y Telegram
+    reintenta más tarde (o el balanceador manda el update a otra instancia).
+    """
+
+    def __init__(self, application: Application, secret_token: str, path: str,
+                 listen: str = "127.0.0.1", port: int = 8443, max_queue: int = 256,
+                 pending: Optional[Callable[[], int]] = None,
+                 metrics: Optional[Callable[[], str]] = None):
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self.listen = listen
+        self.port = port
+        self.max_queue = max_queue
+        # Updates ya sacados de la cola pero todavía en proceso (backpressure y drenado)
+        self.pending = pending or (lambda: 0)
+        self.metrics = metrics
+        self.accepting = False
+        self.runner: Optional[web.AppRunner] = None
+        self.stats = {"received": 0, "rejected_secret": 0, "rejected_busy": 0, "invalid": 0}
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 * 1024)
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        if self.metrics:
+            app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+        self.accepting = True
+        logger.info(f"🌐 Webhook escuchando en http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self, drain_timeout: float = 30.0):
+        """Deja de aceptar updates y espera a que terminen los ya aceptados"""
+        self.accepting = False
+        deadline = time.monotonic() + drain_timeout
+        while time.monotonic() < deadline:
+            queued = self.application.update_queue.qsize()
+            pending = self.pending()
+            if not queued and not pending:
+                break
+            logger.info(f"⏳ Drenando webhook: {queued} en cola, {pending} en proceso")
+            await asyncio.sleep(0.5)
+        else:
+            logger.warning("⚠️ Drenado del webhook incompleto: se cierra igual")
+        if self.runner:
+            await self.runner.cleanup()
+            logger.info("✅ Servidor webhook detenido")
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        # Comparación en tiempo constante: el path puede filtrarse en logs del proxy, el secret no
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            self.stats["rejected_secret"] += 1
+            return web.Response(status=403)
+        if not self.accepting or self.backlog() >= self.max_queue:
+            self.stats["rejected_busy"] += 1
+            return web.Response(status=503, headers={"Retry-After": "5"})
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError, KeyError) as e:
+            self.stats["invalid"] += 1
+            logger.warning(f"Update inválido en el webhook: {e}")
+            return web.Response(status=400)
+
+        self.stats["received"] += 1
+        await self.application.update_queue.put(update)
+        return web.Response(status=200)
+
+    def backlog(self) -> int:
+        """Updates aceptados que todavía no terminaron"""
+        return self.application.update_queue.qsize() + self.pending()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        # 503 mientras drena: el balanceador deja de mandar tráfico a esta instancia
+        status = 200 if self.accepting else 503
+        return web.json_response({
+            "status": "healthy" if self.accepting else "draining",
+            "update_queue": self.application.update_queue.qsize(),
+            "pending": self.pending(),
+            "backlog": self.backlog(),
+            "max_queue": self.max_queue,
+            **self.stats
+        }, status=status)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        lines = [
+            "# HELP unsa_bot_webhook_updates_total Updates recibidos por el webhook por resultado",
+            "# TYPE unsa_bot_webhook_updates_total counter"
+        ]
+        for key, value in self.stats.items():
+            lines.append(f'unsa_bot_webhook_updates_total{{result="{key}"}} {value}')
+        lines += [
+            "# HELP unsa_bot_webhook_backlog Updates aceptados sin terminar (cola de PTB + update processor)",
+            "# TYPE unsa_bot_webhook_backlog gauge",
+            f"unsa_bot_webhook_backlog {self.backlog()}"
+        ]
+        return web.Response(
+            text="\n".join(lines) + "\n" + self.metrics(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8", "Cache-Control": "no-store"}
+        )
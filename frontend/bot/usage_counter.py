@@ -0,0 +1,94 @@
+import asyncio
+from collections import Counter
+from typing import Callable, Iterable, Optional
+
+from .config import logger
+
+class UsageCounter:
+    """
+    Contador de usos de fragmentos con escritura diferida.
+
+    `add` solo suma en memoria: la respuesta al usuario no espera ninguna
+    escritura. En segundo plano los deltas acumulados se escriben con un
+    único UPDATE sobre unnest(ids, deltas) cada `flush_interval` segundos, o
+    antes si se juntan `max_pending` fragmentos distintos. Cada fila caliente
+    se bloquea una vez por ventana en lugar de una vez por búsqueda.
+    """
+
+    def __init__(self, pool: Callable[[], Optional[object]], flush_interval: float = 5.0,
+                 max_pending: int = 500):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = Counter()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"flushes": 0, "rows": 0, "errors": 0}
+
+    def add(self, ids: Iterable[int]):
+        self.pending.update(ids)
+        if len(self.pending) >= self.max_pending:
+            self._full.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """
+        Detiene el flush periódico y escribe lo pendiente. No cancela el loop:
+        un UPDATE cancelado a mitad de camino perdería el lote que ya sacó de pending.
+        """
+        if self._task:
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            if self._stopping:
+                break
+            await self.flush()
+
+    async def flush(self):
+        pool = self.pool()
+        if not self.pending or pool is None:
+            return
+        batch, self.pending = self.pending, Counter()
+        # Ordenados por id: dos procesos que escriben a la vez bloquean las filas en el mismo orden
+        ids = sorted(batch)
+        try:
+            await pool.execute(
+                """
+                UPDATE fragmentos_conocimiento f
+                SET usado_count = f.usado_count + d.delta
+                FROM unnest($1::int[], $2::int[]) AS d(id, delta)
+                WHERE f.id = d.id
+                """,
+                ids,
+                [batch[i] for i in ids]
+            )
+        except asyncio.CancelledError:
+            self.pending.update(batch)
+            raise
+        except Exception as e:
+            # Se reintenta en la próxima ventana junto con lo nuevo
+            self.pending.update(batch)
+            self.stats["errors"] += 1
+            logger.warning("⚠️ No se pudieron guardar %d contadores de uso: %s", len(batch), str(e))
+            return
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(ids)
+        logger.debug("Contadores de uso guardados: %d fragmentos", len(ids))
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending": len(self.pending)}
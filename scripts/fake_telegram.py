@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Telegram falso para probar el bot sin la API real.
+
+Implementa lo mínimo de la Bot API que usa el bot (getMe, setWebhook,
+deleteWebhook, getUpdates, sendMessage, editMessageText, sendChatAction) y
+genera mensajes de estudiantes simulados. Si el bot registró un webhook, los
+updates se envían por POST con el secret token (como Telegram); si no, se
+entregan por getUpdates (modo polling). Al final reporta la latencia del ack
+del webhook y el tiempo hasta la primera respuesta de cada mensaje.
+
+Ejemplo en modo webhook (sin GPU):
+    ENGINE_BACKEND=simulated python backend/inference_server.py &
+    python scripts/fake_telegram.py --port 8081 --messages 200 --chats 50 --rate 10 &
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081 BOT_RUN_MODE=webhook \\
+        WEBHOOK_URL=http://127.0.0.1:8443/telegram/webhook WEBHOOK_SECRET_TOKEN=prueba \\
+        python run_bot.py
+
+El bot descarta mensajes de un mismo usuario separados por menos de 1.5s:
+conviene que haya bastantes chats para la tasa pedida.
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+QUESTIONS = [
+    "Hola",
+    "¿Hay becas para estudiantes de exactas?",
+    "Carreras de ingeniería",
+    "¿Cuándo son las inscripciones 2026?",
+    "Contacto de la facultad de exactas",
+    "¿De qué se trata la licenciatura en física?",
+    "Requisitos para el comedor universitario",
+]
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por rango más cercano"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+class FakeTelegram:
+    def __init__(self, args):
+        self.args = args
+        self.webhook_url: Optional[str] = None
+        self.secret_token = ""
+        self.webhook_ready = asyncio.Event()
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.next_message_id = 1
+        # Por chat: momentos de envío de los mensajes todavía sin respuesta
+        self.outstanding: Dict[int, deque] = defaultdict(deque)
+        self.reply_latencies: List[float] = []
+        self.ack_latencies: List[float] = []
+        self.ack_statuses = Counter()
+        self.api_calls = Counter()
+        self.last_send: Dict[int, float] = {}
+        self.flood_rejections = 0
+
+    # ---------- Bot API ----------
+    async def handle_api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.api_calls[method] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": False, "error_code": 404, "description": f"Not Found: {method}"}, status=404)
+        if method in ("sendMessage", "editMessageText") and self._flooding(int(params["chat_id"])):
+            self.flood_rejections += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            }, status=429)
+        return web.json_response({"ok": True, "result": await handler(params)})
+
+    def _flooding(self, chat_id: int) -> bool:
+        """Flood control como el de Telegram: mensajes a un mismo chat más seguido que --flood-interval"""
+        if not self.args.flood_interval:
+            return False
+        now = time.monotonic()
+        if now - self.last_send.get(chat_id, 0.0) < self.args.flood_interval:
+            return True
+        self.last_send[chat_id] = now
+        return False
+
+    async def api_getMe(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "UNSA Fake", "username": "unsa_fake_bot"}
+
+    async def api_setWebhook(self, params):
+        self.webhook_url = params.get("url")
+        self.secret_token = params.get("secret_token", "")
+        self.webhook_ready.set()
+        print(f"🌐 Webhook registrado: {self.webhook_url}")
+        return True
+
+    async def api_deleteWebhook(self, params):
+        self.webhook_url = None
+        return True
+
+    async def api_getUpdates(self, params):
+        timeout = float(params.get("timeout", 0) or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.1)))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def api_sendChatAction(self, params):
+        return True
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params["chat_id"])
+        pending = self.outstanding.get(chat_id)
+        if pending:
+            self.reply_latencies.append(time.monotonic() - pending.popleft())
+        return self._bot_message(chat_id, params.get("text", ""))
+
+    async def api_editMessageText(self, params):
+        return self._bot_message(int(params["chat_id"]), params.get("text", ""))
+
+    def _bot_message(self, chat_id: int, text: str) -> dict:
+        self.next_message_id += 1
+        return {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "UNSA Fake"},
+            "text": text
+        }
+
+    # ---------- Estudiantes simulados ----------
+    def _user_update(self, update_id: int, chat_id: int, text: str) -> dict:
+        self.next_message_id += 1
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": self.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Estudiante"},
+                "text": text
+            }
+        }
+
+    async def deliver(self, session: aiohttp.ClientSession, update: dict, chat_id: int):
+        self.outstanding[chat_id].append(time.monotonic())
+        if not self.webhook_url:
+            await self.updates.put(update)
+            return
+        start = time.monotonic()
+        try:
+            async with session.post(
+                self.webhook_url,
+                json=update,
+                headers={SECRET_HEADER: self.secret_token}
+            ) as resp:
+                self.ack_statuses[resp.status] += 1
+                if resp.status != 200:
+                    # Telegram reintentaría; acá solo se cuenta como no entregado
+                    self.outstanding[chat_id].pop()
+        except aiohttp.ClientError as e:
+            self.ack_statuses[type(e).__name__] += 1
+            self.outstanding[chat_id].pop()
+        self.ack_latencies.append(time.monotonic() - start)
+
+    async def run_senders(self):
+        args = self.args
+        if args.wait_webhook:
+            print("⏳ Esperando a que el bot registre el webhook...")
+            await self.webhook_ready.wait()
+        else:
+            await asyncio.sleep(args.warmup)
+
+        rng = random.Random(args.seed)
+        chats = [100000 + i for i in range(args.chats)]
+        tasks = []
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            for update_id in range(1, args.messages + 1):
+                chat_id = rng.choice(chats)
+                update = self._user_update(update_id, chat_id, rng.choice(QUESTIONS))
+                tasks.append(asyncio.create_task(self.deliver(session, update, chat_id)))
+                await asyncio.sleep(rng.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+
+            # Esperar las últimas respuestas
+            deadline = time.monotonic() + args.drain
+            while time.monotonic() < deadline and any(self.outstanding.values()):
+                await asyncio.sleep(0.5)
+        self.report()
+
+    def report(self):
+        def fmt(value: Optional[float]) -> str:
+            return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+        unanswered = sum(len(q) for q in self.outstanding.values())
+        print("\n📊 Resultado")
+        print(f"Mensajes enviados:  {self.args.messages} en {self.args.chats} chats")
+        if self.ack_latencies:
+            print(f"Ack del webhook:    p50 {fmt(percentile(self.ack_latencies, 50))}"
+                  f" · p95 {fmt(percentile(self.ack_latencies, 95))}"
+                  f" · p99 {fmt(percentile(self.ack_latencies, 99))}")
+            print(f"Estados del ack:    {dict(self.ack_statuses)}")
+        print(f"Primera respuesta:  p50 {fmt(percentile(self.reply_latencies, 50))}"
+              f" · p95 {fmt(percentile(self.reply_latencies, 95))}"
+              f" · p99 {fmt(percentile(self.reply_latencies, 99))}")
+        print(f"Respondidos:        {len(self.reply_latencies)} · sin respuesta {unanswered}")
+        print(f"Llamadas a la API:  {dict(self.api_calls)}")
+        if self.args.flood_interval:
+            print(f"Rechazos por flood: {self.flood_rejections}")
+
+async def main_async(args):
+    fake = FakeTelegram(args)
+    app = web.Application()
+    # La Bot API es /bot<token>/<método>; el token no se valida
+    app.router.add_post("/bot{token}/{method}", fake.handle_api)
+    app.router.add_get("/bot{token}/{method}", fake.handle_api)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"🤖 Telegram falso en http://{args.host}:{args.port} (TELEGRAM_BASE_URL)")
+    try:
+        await fake.run_senders()
+    finally:
+        await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram falso con estudiantes simulados")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--messages", type=int, default=100, help="Mensajes a enviar")
+    parser.add_argument("--chats", type=int, default=30, help="Chats distintos")
+    parser.add_argument("--rate", type=float, default=5.0, help="Mensajes por segundo (llegadas Poisson)")
+    parser.add_argument("--wait-webhook", action=argparse.BooleanOptionalAction, default=True,
+                        help="Esperar a que el bot llame a setWebhook (--no-wait-webhook para polling)")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Espera inicial en modo polling (s)")
+    parser.add_argument("--drain", type=float, default=30.0, help="Espera máxima de las últimas respuestas (s)")
+    parser.add_argument("--flood-interval", type=float, default=0.0,
+                        help="Responder 429 (retry_after) a envíos al mismo chat más seguidos que esto (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+if __name__ == "__main__":
+    main()